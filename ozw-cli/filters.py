@@ -0,0 +1,124 @@
+import math
+from typing import List, Optional, Tuple
+
+
+"""
+Decides which samples are worth keeping (and exporting), per series.
+
+A sample is kept if it differs enough from the last one we kept: by more
+than an absolute deadband, or by more than a fraction of the last kept
+value (the relative deadband), whichever is larger. Identical readings,
+or jitter within the deadband, are dropped.
+
+For series that only ever go up, like cumulative kWh, a swinging door
+may be used instead: samples are dropped for as long as every one of them
+is within 'swinging_door' of the straight line between the last kept
+sample and the current one. A steady consumption then costs two samples,
+no matter how long it lasts.
+
+Either way, whenever we keep a sample after having dropped some, the
+last dropped one is kept as well. That keeps step changes as steps, rather
+than as a slow ramp from the last kept sample to the new value.
+
+Finally, 'heartbeat' is the longest we go without keeping a sample, even
+if nothing changed, so it's clear the series is still alive. It's only
+checked when a sample arrives; there's no timer of our own.
+"""
+
+
+Sample = Tuple[int, float]
+
+
+class FilterConfig:
+
+    def __init__(self,
+                 deadband: float = 0.0,
+                 deadband_rel: float = 0.0,
+                 heartbeat: Optional[float] = 300.0,
+                 swinging_door: Optional[float] = None):
+        self.deadband = deadband
+        self.deadband_rel = deadband_rel
+        # seconds
+        self.heartbeat = heartbeat
+        # maximum deviation, in the series' units.
+        self.swinging_door = swinging_door
+
+
+class SampleFilter:
+
+    def __init__(self, config: FilterConfig):
+        self.config = config
+        self.heartbeat_ms = \
+            config.heartbeat * 1000 if config.heartbeat else None
+        # last sample kept, and last sample seen if it was dropped.
+        self.kept: Optional[Sample] = None
+        self.held: Optional[Sample] = None
+        # swinging door slopes, from 'kept'.
+        self.slope_min = -math.inf
+        self.slope_max = math.inf
+        self.seen = 0
+        self.stored = 0
+
+    def _in_deadband(self, value: float) -> bool:
+        last = self.kept[1]
+        band = max(self.config.deadband,
+                   abs(last) * self.config.deadband_rel)
+        if band == 0.0:
+            return value == last
+        return abs(value - last) <= band
+
+    def _narrow_door(self, sample: Sample) -> bool:
+        # returns whether the door is still closed, 'sample' included.
+        ts, value = sample
+        kept_ts, kept_value = self.kept
+        if ts <= kept_ts:
+            return abs(value - kept_value) <= self.config.swinging_door
+        dt = ts - kept_ts
+        dev = self.config.swinging_door
+        self.slope_min = max(self.slope_min, (value - dev - kept_value) / dt)
+        self.slope_max = min(self.slope_max, (value + dev - kept_value) / dt)
+        return self.slope_min <= self.slope_max
+
+    def _keep(self, samples: List[Sample]) -> List[Sample]:
+        self.kept = samples[-1]
+        self.held = None
+        self.slope_min = -math.inf
+        self.slope_max = math.inf
+        self.stored += len(samples)
+        return samples
+
+    """
+        Offer a new sample. Returns the samples to keep, oldest first:
+        none, this one, or the one before it, which had been dropped, and
+        maybe this one as well.
+    """
+    def offer(self, timestamp: int, value: float) -> List[Sample]:
+        self.seen += 1
+        sample = (timestamp, value)
+        if self.kept is None:
+            return self._keep([sample])
+
+        is_door = self.config.swinging_door is not None
+        if is_door:
+            is_closed = self._narrow_door(sample)
+        else:
+            is_closed = self._in_deadband(value)
+        is_due = self.heartbeat_ms is not None and \
+            timestamp - self.kept[0] >= self.heartbeat_ms
+
+        if is_closed:
+            if not is_due:
+                self.held = sample
+                return []
+            return self._keep([sample])
+
+        if self.held is None:
+            return self._keep([sample])
+        if is_door and not is_due:
+            # the door opened; the last sample within it ends the segment,
+            # and starts the next one.
+            samples = self._keep([self.held])
+            self._narrow_door(sample)
+            self.held = sample
+            return samples
+        return self._keep([self.held, sample])
@@ -0,0 +1,322 @@
+# A copy of ozw-rest's backend/ingest.py; the tools don't share code,
+# each keeps its own copy of what it has in common with the others.
+# Change them all alike (tests/test_copies.py, in ozw-cli, checks).
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Keeps openzwave's notification thread free from whatever we do with its
+notifications.
+
+The notification thread only copies what matters about an event into an
+IngestEvent and puts it in a bounded queue; a worker thread of our own
+takes it from there. If the worker can't keep up, the queue eventually
+fills, and then it's up to the overflow policy:
+
+  * 'drop_oldest' drops the oldest event in the queue;
+  * 'coalesce' replaces the latest still-pending update for the same
+    value with the newer one, keeping its place in the queue. Only when
+    there's nothing to coalesce with do we drop the oldest event.
+
+Until the queue is full, every event is kept, coalescing key or not:
+intermediate readings matter to whoever's recording them. Only events
+given a coalescing key (by whoever queues them) are ever coalesced; the
+rest are only dropped, if need be.
+
+In 'drop_oldest', enqueueing takes no locks: a deque with a maximum
+length already does the right thing on append, and appending is atomic.
+'coalesce' needs to look things up, so it takes a lock.
+
+Stats are kept as timing.py keeps its histograms: each thread counts into
+counters of its own, merged when read, so no count is lost to another
+thread's. Drops in 'drop_oldest' happen inside the deque, where we can't
+count them as they happen; they're whatever was queued and neither taken
+off the queue nor still in it.
+"""
+
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_COALESCE = 'coalesce'
+
+
+class IngestEvent:
+
+    __slots__ = ['kind', 'signal', 'node_id', 'value_id', 'data',
+                 'timestamp', 'node', 'value', 'network', 'key',
+                 'enqueued_ns']
+
+    def __init__(self, kind: str, signal: str,
+                 node_id: int = None, value_id: int = None, data=None,
+                 node=None, value=None, network=None,
+                 key: Optional[Hashable] = None):
+        self.kind = kind
+        self.signal = signal
+        self.node_id = node_id
+        self.value_id = value_id
+        self.data = data
+        self.timestamp = time.time()
+        # references only; we don't read anything off these on the
+        # notification thread besides what's above.
+        self.node = node
+        self.value = value
+        self.network = network
+        # events with the same key may be coalesced.
+        self.key = key
+        self.enqueued_ns = 0
+
+
+class IngestStats:
+
+    __slots__ = ['enqueued', 'taken', 'processed', 'dropped', 'coalesced',
+                 'failed', 'enqueue_ns_total', 'enqueue_ns_max',
+                 'wait_ns_total', 'wait_ns_max']
+
+    def __init__(self):
+        self.enqueued = 0
+        # taken off the queue by the worker, processed or not yet.
+        self.taken = 0
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.enqueue_ns_total = 0
+        self.enqueue_ns_max = 0
+        self.wait_ns_total = 0
+        self.wait_ns_max = 0
+
+    def merge(self, other: 'IngestStats'):
+        for name in self.__slots__:
+            if name.endswith('_max'):
+                setattr(self, name, max(getattr(self, name),
+                                        getattr(other, name)))
+            else:
+                setattr(self, name, getattr(self, name) +
+                        getattr(other, name))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'enqueue_latency_avg_us':
+                self.enqueue_ns_total / self.enqueued / 1000
+                if self.enqueued else 0.0,
+            'enqueue_latency_max_us': self.enqueue_ns_max / 1000,
+            'queue_latency_avg_ms':
+                self.wait_ns_total / self.processed / 1000000
+                if self.processed else 0.0,
+            'queue_latency_max_ms': self.wait_ns_max / 1000000
+        }
+
+
+class IngestQueue:
+
+    def __init__(self, handler: Callable[[IngestEvent], None],
+                 max_size: int = 10000,
+                 policy: str = POLICY_DROP_OLDEST,
+                 name: str = 'ingest'):
+        if policy not in (POLICY_DROP_OLDEST, POLICY_COALESCE):
+            raise ValueError(f"unknown overflow policy '{policy}'")
+        self.handler = handler
+        self.max_size = max_size
+        self.policy = policy
+        self.name = name
+        # every thread's stats; see 'stats'.
+        self.local = threading.local()
+        self.shards: List[IngestStats] = []
+        self.shards_lock = threading.Lock()
+
+        # drop_oldest
+        self.queue = deque(maxlen=max_size)
+        # coalesce; dicts keep insertion order, which is our queue order.
+        self.pending: Dict[int, IngestEvent] = {}
+        # where the latest pending event for each coalescing key is.
+        self.latest: Dict[Hashable, int] = {}
+        self.pending_lock = threading.Lock()
+        self.seq = 0
+
+        self.wakeup = threading.Event()
+        self.is_waiting = False
+        self.is_running = False
+        self.thread: threading.Thread = None
+
+    """
+        The calling thread's own stats, to count into.
+    """
+    def _local_stats(self) -> IngestStats:
+        stats = getattr(self.local, 'stats', None)
+        if stats is None:
+            stats = self.local.stats = IngestStats()
+            with self.shards_lock:
+                self.shards.append(stats)
+        return stats
+
+    """
+        Every thread's stats, added up.
+    """
+    @property
+    def stats(self) -> IngestStats:
+        total = IngestStats()
+        with self.shards_lock:
+            shards = list(self.shards)
+        for shard in shards:
+            total.merge(shard)
+        if self.policy == POLICY_DROP_OLDEST:
+            # an event counted as enqueued may not be in the queue just
+            # yet; that's not a drop.
+            total.dropped = max(
+                0, total.enqueued - total.taken - len(self.queue))
+        return total
+
+    def __len__(self):
+        if self.policy == POLICY_COALESCE:
+            return len(self.pending)
+        return len(self.queue)
+
+    def _put_coalesce(self, event: IngestEvent, stats: IngestStats):
+        with self.pending_lock:
+            if len(self.pending) >= self.max_size:
+                seq = self.latest.get(event.key) \
+                    if event.key is not None else None
+                if seq is not None:
+                    # keep the older one's enqueue time, it's been
+                    # waiting for that long.
+                    event.enqueued_ns = self.pending[seq].enqueued_ns
+                    self.pending[seq] = event
+                    stats.coalesced += 1
+                    return
+                seq = next(iter(self.pending))
+                old = self.pending.pop(seq)
+                if old.key is not None and self.latest.get(old.key) == seq:
+                    del self.latest[old.key]
+                stats.dropped += 1
+            self.seq += 1
+            self.pending[self.seq] = event
+            if event.key is not None:
+                self.latest[event.key] = self.seq
+
+    def put(self, event: IngestEvent):
+        start = time.perf_counter_ns()
+        event.enqueued_ns = start
+        stats = self._local_stats()
+
+        if self.policy == POLICY_COALESCE:
+            self._put_coalesce(event, stats)
+        else:
+            # the oldest is dropped by the deque itself, if need be.
+            self.queue.append(event)
+
+        if self.is_waiting:
+            self.wakeup.set()
+
+        elapsed = time.perf_counter_ns() - start
+        stats.enqueued += 1
+        stats.enqueue_ns_total += elapsed
+        if elapsed > stats.enqueue_ns_max:
+            stats.enqueue_ns_max = elapsed
+
+    def _take(self, stats: IngestStats):
+        if self.policy == POLICY_COALESCE:
+            with self.pending_lock:
+                events = self.pending
+                self.pending = {}
+                self.latest = {}
+                stats.taken += len(events)
+            return list(events.values())
+
+        events = []
+        while True:
+            # counted before it's off the queue, never after: in between,
+            # it'd look dropped.
+            stats.taken += 1
+            try:
+                events.append(self.queue.popleft())
+            except IndexError:
+                stats.taken -= 1
+                return events
+
+    def _process(self, event: IngestEvent, stats: IngestStats):
+        waited = time.perf_counter_ns() - event.enqueued_ns
+        stats.wait_ns_total += waited
+        if waited > stats.wait_ns_max:
+            stats.wait_ns_max = waited
+        try:
+            self.handler(event)
+        except Exception as e:
+            stats.failed += 1
+            logger.exception(f"{self.name}: error handling event: {e}")
+        stats.processed += 1
+
+    """
+        Process whatever is queued, on the calling thread. Returns how
+        many events were processed.
+    """
+    def drain(self) -> int:
+        stats = self._local_stats()
+        count = 0
+        while True:
+            events = self._take(stats)
+            if not events:
+                return count
+            for event in events:
+                self._process(event, stats)
+            count += len(events)
+
+    def _run(self):
+        while self.is_running:
+            if self.drain() > 0:
+                continue
+            self.is_waiting = True
+            # something may have come in before we said we were waiting.
+            if len(self) == 0 and self.is_running:
+                self.wakeup.wait(0.5)
+            self.wakeup.clear()
+            self.is_waiting = False
+        self.drain()
+
+    """
+        Wait until everything queued so far has been handled. Mostly for
+        the benefit of tests and benchmarks.
+    """
+    def wait_idle(self, timeout: float = 10.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            stats = self.stats
+            if stats.processed + stats.dropped + stats.coalesced >= \
+               stats.enqueued and stats.taken == stats.processed and \
+               len(self) == 0:
+                return True
+            time.sleep(0.001)
+        return False
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run, name=self.name,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.is_running:
+            return
+        self.is_running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = self.stats.to_dict()
+        stats['depth'] = len(self)
+        stats['policy'] = self.policy
+        return stats
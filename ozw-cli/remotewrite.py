@@ -0,0 +1,433 @@
+import http.client
+import random
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+from spool import Spool
+from timeseries import now_ms
+
+
+"""
+An exporter speaking Prometheus' remote write protocol: every sample goes
+out with its own timestamp, rather than only the latest value of each
+series, as the push gateway keeps them.
+
+Samples are spooled first (see spool.py), then drained in batches. Each
+batch is split by series over a few shards, each sending its share in
+parallel as a snappy-compressed protobuf WriteRequest, over a connection
+of its own. A shard failing retries with exponential backoff (and some
+jitter), for as long as we're running, and once stopping, for as long as
+'stop()' is told to wait. A shard whose share was rejected outright (a
+4xx other than 429) drops it: sending it again won't help.
+
+The batch in flight is kept until every shard got its share through, and
+only then does the spool's cursor move; shares already through aren't
+sent again, only those that failed. Delivery is still at least once: a
+batch in flight when we stop (or crash) is read from the spool again, and
+sent whole, next time around. Prometheus takes a sample it already has
+(same series, timestamp and value) as a no-op.
+
+The WriteRequest is encoded by hand; it's only a handful of fields, and
+saves us generating code off prometheus' .proto files.
+"""
+
+
+METRIC_PREFIX = 'home_consumption_'
+
+_DOUBLE = struct.Struct('<d')
+
+
+class RemoteWriteException(Exception):
+    pass
+
+
+def _varint(n: int) -> bytes:
+    if n < 0:
+        n += 1 << 64
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _field(tag: int, payload: bytes) -> bytes:
+    return bytes([tag]) + _varint(len(payload)) + payload
+
+
+"""
+    Labels, as protobuf, for a series; labels sorted by name, as remote
+    write has them.
+"""
+def encode_labels(labels: Dict[str, str]) -> bytes:
+    return b''.join(
+        _field(0x0a, _field(0x0a, name.encode()) +
+               _field(0x12, value.encode()))
+        for name, value in sorted(labels.items()))
+
+
+"""
+    A WriteRequest, out of already encoded labels and each series'
+    samples, as (timestamp, value), oldest first.
+"""
+def encode_write_request(series: Dict[bytes, List[Tuple[int, float]]]
+                         ) -> bytes:
+    out = []
+    for labels, samples in series.items():
+        encoded = b''.join(
+            _field(0x12, b'\x09' + _DOUBLE.pack(value) +
+                   b'\x10' + _varint(timestamp))
+            for timestamp, value in samples)
+        out.append(_field(0x0a, labels + encoded))
+    return b''.join(out)
+
+
+def _read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _read_fields(buf: bytes):
+    pos = 0
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        tag, wire = key >> 3, key & 0x7
+        if wire == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire == 2:
+            length, pos = _read_varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        else:
+            raise RemoteWriteException(f"unexpected wire type {wire}")
+        yield tag, value
+
+
+"""
+    The other way around: a WriteRequest into a list of (labels,
+    samples). For whoever's receiving, as our stand-in does.
+"""
+def decode_write_request(data: bytes
+                         ) -> List[Tuple[Dict[str, str],
+                                         List[Tuple[int, float]]]]:
+    series = []
+    for tag, ts_buf in _read_fields(data):
+        if tag != 1:
+            continue
+        labels, samples = {}, []
+        for ftag, value in _read_fields(ts_buf):
+            if ftag == 1:
+                label = dict(_read_fields(value))
+                labels[label.get(1, b'').decode()] = \
+                    label.get(2, b'').decode()
+            elif ftag == 2:
+                sample = dict(_read_fields(value))
+                timestamp = sample.get(2, 0)
+                if timestamp >= 1 << 63:
+                    timestamp -= 1 << 64
+                samples.append(
+                    (timestamp,
+                     _DOUBLE.unpack(sample.get(1, bytes(8)))[0]))
+        series.append((labels, samples))
+    return series
+
+
+class _Shard:
+
+    def __init__(self, index: int, url: str, timeout: float):
+        self.index = index
+        parts = urlsplit(url)
+        self.scheme = parts.scheme or 'http'
+        self.netloc = parts.netloc
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.timeout = timeout
+        self.conn: Optional[http.client.HTTPConnection] = None
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == 'https' \
+                else http.client.HTTPConnection
+            self.conn = cls(self.netloc, timeout=self.timeout)
+        return self.conn
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    """
+        Send a payload; returns the response's status, or raises if we
+        couldn't get one.
+    """
+    def post(self, payload: bytes, headers: Dict[str, str]) -> int:
+        conn = self._connect()
+        try:
+            conn.request('POST', self.path, body=payload, headers=headers)
+            res = conn.getresponse()
+            res.read()
+        except Exception:
+            # start over on a fresh connection next time.
+            self.close()
+            raise
+        return res.status
+
+
+class RemoteWriteExporter:
+
+    HEADERS = {
+        'Content-Encoding': 'snappy',
+        'Content-Type': 'application/x-protobuf',
+        'User-Agent': 'ozw-cli',
+        'X-Prometheus-Remote-Write-Version': '0.1.0',
+    }
+
+    def __init__(self, url: str,
+                 spool_dir: str = 'spool-remote-write',
+                 batch_size: int = 2000,
+                 flush_interval: float = 5.0,
+                 shards: int = 4,
+                 min_backoff: float = 0.1,
+                 max_backoff: float = 30.0,
+                 timeout: float = 10.0,
+                 job: str = 'home_energy_consumption'):
+
+        if snappy is None:
+            raise RemoteWriteException(
+                "remote write needs python-snappy; please install it")
+        self.url = url
+        self.spool_dir = spool_dir
+        # samples per shard, per request...
+        self.batch_size = batch_size
+        # ... sent at least this often, if there's anything to send.
+        self.flush_interval = flush_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.job = job
+
+        self.shards = [_Shard(i, url, timeout) for i in range(shards)]
+        self.executor: ThreadPoolExecutor = None
+        self.spool: Spool = None
+        # encoded labels, per node and unit.
+        self.labels: Dict[Tuple[str, str], bytes] = {}
+
+        self.lock = Lock()
+        self.pending = 0
+        self.pending_lock = Lock()
+        self.flush_event = Event()
+        self.flush_lock = Lock()
+        # set once stopping: retries go on until 'stop_deadline'.
+        self.stop_event = Event()
+        self.stop_deadline = 0.0
+        self.flusher: Thread = None
+        self.is_running = False
+        # the batch being sent, as read from the spool: where the cursor
+        # goes once it's through, and each shard's share, None once sent.
+        self.in_flight: Optional[Tuple[Any, List[Optional[Dict]]]] = None
+
+        self.requests = 0
+        self.retries = 0
+        self.rejected = 0
+        self.samples_sent = 0
+        self.bytes_sent = 0
+        self.bytes_raw = 0
+        self.send_seconds = 0.0
+
+
+    def start(self):
+        with self.lock:
+            if self.is_running:
+                return
+            if self.spool is None:
+                self.spool = Spool(self.spool_dir)
+            self.spool.start()
+            self.executor = ThreadPoolExecutor(
+                max_workers=len(self.shards),
+                thread_name_prefix='ozw-remote-write')
+            self.stop_event.clear()
+            self.is_running = True
+        self.flusher = Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+
+    """
+        Stop, sending whatever's spooled first; failed sends are retried
+        for up to 'timeout' seconds. Whatever doesn't make it by then stays
+        spooled, for next time.
+    """
+    def stop(self, timeout: float = 30.0):
+        if not self.is_running:
+            return
+        self.stop_deadline = time.monotonic() + timeout
+        self.is_running = False
+        self.stop_event.set()
+        self.flush_event.set()
+        self.flusher.join()
+        self.flusher = None
+        self.flush()
+        self.in_flight = None
+        self.executor.shutdown()
+        self.executor = None
+        for shard in self.shards:
+            shard.close()
+        self.spool.stop()
+
+
+    def handle(self, node: str, unit: str, value: float,
+               timestamp: int = None):
+        if not self.is_running:
+            self.start()
+        self.spool.append(node, unit,
+                          timestamp if timestamp is not None else now_ms(),
+                          value)
+        with self.pending_lock:
+            self.pending += 1
+            pending = self.pending
+        if pending >= self.batch_size * len(self.shards):
+            self.flush_event.set()
+
+
+    def _get_labels(self, node: str, unit: str) -> bytes:
+        key = (node, unit)
+        labels = self.labels.get(key)
+        if labels is None:
+            labels = self.labels[key] = encode_labels({
+                '__name__': METRIC_PREFIX + unit,
+                'job': self.job,
+                'node': node
+            })
+        return labels
+
+
+    """
+        Send one shard's share, retrying for as long as we're running, or
+        until the deadline once stopping. Returns whether it's done with
+        it, one way or the other.
+    """
+    def _send(self, shard: _Shard, series: Dict[bytes, List]) -> bool:
+        raw = encode_write_request(series)
+        payload = snappy.compress(raw)
+        count = sum(len(samples) for samples in series.values())
+        backoff = self.min_backoff
+        while True:
+            start = time.monotonic()
+            try:
+                status = shard.post(payload, self.HEADERS)
+            except Exception as e:
+                status = None
+                error = str(e)
+            else:
+                error = "status {}".format(status)
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.requests += 1
+                self.send_seconds += elapsed
+                if status is not None and status // 100 == 2:
+                    self.samples_sent += count
+                    self.bytes_sent += len(payload)
+                    self.bytes_raw += len(raw)
+                    return True
+                if status is not None and status // 100 == 4 and \
+                        status != 429:
+                    self.rejected += count
+                    print("  [error] --> remote write rejected {} samples:"
+                          " {}".format(count, error))
+                    return True
+                self.retries += 1
+            delay = backoff * random.uniform(0.5, 1.0)
+            print("  [error] --> remote write shard {} failed: {}; retry in"
+                  " {:.1f}s".format(shard.index, error, delay))
+            if self.stop_event.is_set():
+                remaining = self.stop_deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(delay, remaining))
+            else:
+                # stopping cuts the wait short; we retry right away.
+                self.stop_event.wait(delay)
+            backoff = min(self.max_backoff, backoff * 2)
+
+
+    def _read_batch(self):
+        samples, position = self.spool.read(
+            self.batch_size * len(self.shards))
+        if not samples:
+            return None
+        shares: List[Optional[Dict[bytes, List]]] = \
+            [{} for _ in self.shards]
+        for node, unit, timestamp, value in samples:
+            labels = self._get_labels(node, unit)
+            shard = zlib.crc32(labels) % len(shares)
+            shares[shard].setdefault(labels, []).append((timestamp, value))
+        return position, [share if share else None for share in shares]
+
+    """
+        Drain the spool, a batch at a time, each split over the shards.
+        Returns whether it got to the end of it. A batch that didn't get
+        through entirely is picked up where it was left next time, rather
+        than read again.
+    """
+    def flush(self) -> bool:
+        with self.pending_lock:
+            self.pending = 0
+        with self.flush_lock:
+            self.spool.sync()
+            while True:
+                if self.in_flight is None:
+                    self.in_flight = self._read_batch()
+                    if self.in_flight is None:
+                        return True
+                position, shares = self.in_flight
+                futures = {i: self.executor.submit(self._send,
+                                                   self.shards[i], share)
+                           for i, share in enumerate(shares)
+                           if share is not None}
+                for i, future in futures.items():
+                    if future.result():
+                        shares[i] = None
+                if any(share is not None for share in shares):
+                    return False
+                self.spool.commit(position)
+                self.in_flight = None
+
+
+    def _flush_loop(self):
+        while self.is_running:
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+            if not self.is_running:
+                break
+            self.flush()
+
+
+    def get_stats(self):
+        return {
+            'pending': self.pending,
+            'requests': self.requests,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'samples_sent': self.samples_sent,
+            'bytes_sent': self.bytes_sent,
+            'bytes_raw': self.bytes_raw,
+            'send_seconds': self.send_seconds,
+            'spool': self.spool.get_stats() if self.spool else None
+        }
@@ -0,0 +1,195 @@
+import heapq
+import random
+import time
+import threading
+from typing import Callable, Dict, List, Tuple
+
+
+"""
+Refreshes values, each on its own schedule, instead of all of them at
+once every so often.
+
+Every value has a refresh interval. When a value is seen changing, its
+interval shrinks (down to 'min_interval'); when it is seen unchanged, the
+interval grows (up to 'max_interval'). A busy heater ends up refreshed
+often, while an idle plug is mostly left alone.
+
+Values are kept in a heap ordered by when they're next due. Whenever we
+hear from a value (be it because we refreshed it, or because the node
+reported on its own), its next refresh is pushed back by its interval;
+there's no point in asking for something we just got.
+
+Refreshes are paced by a token bucket, so we never send the controller
+more than 'max_rate' commands per second, no matter how many values come
+due at the same time. New values are given a random initial offset within
+their interval, so they don't all come due together to begin with.
+"""
+
+
+class _Entry:
+
+    def __init__(self, value, interval: float, due: float):
+        self.value = value
+        self.interval = interval
+        self.due = due
+        self.last_data = None
+
+
+class RefreshScheduler:
+
+    def __init__(self,
+                 min_interval: float = 10.0,
+                 max_interval: float = 300.0,
+                 initial_interval: float = 30.0,
+                 max_rate: float = 2.0,
+                 speedup: float = 0.5,
+                 backoff: float = 1.5,
+                 change_threshold: float = 0.01,
+                 clock: Callable[[], float] = time.monotonic):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_interval = initial_interval
+        # commands per second we allow ourselves to send.
+        self.max_rate = max_rate
+        self.speedup = speedup
+        self.backoff = backoff
+        # relative change below which a value is considered unchanged.
+        self.change_threshold = change_threshold
+        self.clock = clock
+
+        self.entries: Dict[int, _Entry] = {}
+        # (due, seq, value id); stale items are skipped when popped.
+        self.heap: List[Tuple[float, int, int]] = []
+        self.seq = 0
+        self.tokens = 1.0
+        self.tokens_ts = clock()
+
+        self.cond = threading.Condition()
+        self.thread: threading.Thread = None
+        self.is_running = False
+        self.refreshes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _push(self, value_id: int, entry: _Entry):
+        self.seq += 1
+        heapq.heappush(self.heap, (entry.due, self.seq, value_id))
+
+    def add(self, value):
+        with self.cond:
+            if value.value_id in self.entries:
+                return
+            interval = self.initial_interval
+            due = self.clock() + random.uniform(0, interval)
+            entry = _Entry(value, interval, due)
+            entry.last_data = value.data
+            self.entries[value.value_id] = entry
+            self._push(value.value_id, entry)
+            self.cond.notify()
+
+    def remove(self, value_id: int):
+        with self.cond:
+            self.entries.pop(value_id, None)
+
+    def _has_changed(self, old, new) -> bool:
+        if old is None:
+            return True
+        if isinstance(old, float) or isinstance(new, float):
+            try:
+                base = max(abs(old), abs(new))
+                return base > 0 and abs(new - old) / base > \
+                    self.change_threshold
+            except TypeError:
+                pass
+        return old != new
+
+    """
+        To be called whenever we hear from a value, whether we asked for it
+        or not. Adjusts its interval and pushes its next refresh back.
+    """
+    def observe(self, value, data=None):
+        if data is None:
+            data = value.data
+        with self.cond:
+            entry = self.entries.get(value.value_id)
+            if not entry:
+                return
+            if self._has_changed(entry.last_data, data):
+                entry.interval = max(self.min_interval,
+                                     entry.interval * self.speedup)
+            else:
+                entry.interval = min(self.max_interval,
+                                     entry.interval * self.backoff)
+            entry.last_data = data
+            entry.value = value
+            entry.due = self.clock() + entry.interval
+            self._push(value.value_id, entry)
+
+    def _take_token(self, now: float) -> float:
+        # returns how long until a token is available; 0 if we took one.
+        self.tokens = min(1.0, self.tokens +
+                          (now - self.tokens_ts) * self.max_rate)
+        self.tokens_ts = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.max_rate
+
+    """
+        Refresh whatever is due, within our rate budget. Returns how long
+        until there's something else to do.
+    """
+    def run_pending(self) -> float:
+        due_values = []
+        with self.cond:
+            wait = self.max_interval
+            while self.heap:
+                due, _, value_id = self.heap[0]
+                entry = self.entries.get(value_id)
+                if not entry or entry.due != due:
+                    heapq.heappop(self.heap)
+                    continue
+                now = self.clock()
+                if due > now:
+                    wait = due - now
+                    break
+                token_wait = self._take_token(now)
+                if token_wait > 0:
+                    wait = token_wait
+                    break
+                heapq.heappop(self.heap)
+                # if we don't hear back, try again after a full interval.
+                entry.due = now + entry.interval
+                self._push(value_id, entry)
+                due_values.append(entry.value)
+
+        for value in due_values:
+            try:
+                value.refresh()
+                self.refreshes += 1
+            except Exception as e:
+                print("  [error] --> refresh failed: {}".format(e))
+        return wait
+
+    def _run(self):
+        while self.is_running:
+            wait = self.run_pending()
+            with self.cond:
+                if self.is_running:
+                    self.cond.wait(wait)
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.is_running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,384 @@
+import mmap
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+"""
+An append-only, on-disk store for our time series, one file per series
+(that is, per node and unit).
+
+Files are a sequence of fixed-size blocks. Each block starts with a
+header, holding the number of samples in it, the first and last
+timestamps, and the first value; the remaining samples follow, compressed
+in the fashion of Facebook's Gorilla:
+
+  * timestamps as the delta of their deltas, which for samples arriving
+    at regular intervals is mostly a single bit;
+  * values as the XOR against the previous value, storing only the
+    meaningful bits -- a repeated value costs a single bit.
+
+Blocks are independent from each other, so reading a time range only
+needs to decode the blocks overlapping it. Which blocks those are we know
+from a sparse index (first and last timestamp of each block), built from
+the block headers when the file is opened.
+
+Samples are appended to an in-memory block. Flushing writes that block
+out in place; once it fills up, it's sealed and never written again, and
+a new block is started after it.
+"""
+
+
+BLOCK_SIZE = 4096
+
+_MAGIC = b'OZWS'
+_FLAG_SEALED = 0x1
+# magic, flags, sample count, payload bits, first ts, last ts, first value
+_HEADER = struct.Struct('<4sBHIqqd')
+_PAYLOAD_BITS = (BLOCK_SIZE - _HEADER.size) * 8
+# the most a single sample can take: 4 + 64 bits for the timestamp, and
+# 2 + 5 + 6 + 64 for the value.
+_MAX_SAMPLE_BITS = 145
+
+
+class SegmentException(Exception):
+    pass
+
+
+class BitWriter:
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.acc = 0
+        self.acc_bits = 0
+
+    def __len__(self):
+        return len(self.buf) * 8 + self.acc_bits
+
+    def write(self, value: int, nbits: int):
+        self.acc = (self.acc << nbits) | (value & ((1 << nbits) - 1))
+        self.acc_bits += nbits
+        while self.acc_bits >= 8:
+            self.acc_bits -= 8
+            self.buf.append((self.acc >> self.acc_bits) & 0xff)
+        self.acc &= (1 << self.acc_bits) - 1
+
+    def to_bytes(self) -> bytes:
+        if self.acc_bits == 0:
+            return bytes(self.buf)
+        return bytes(self.buf) + \
+            bytes([(self.acc << (8 - self.acc_bits)) & 0xff])
+
+
+class BitReader:
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def read(self, nbits: int) -> int:
+        start = self.pos >> 3
+        end = (self.pos + nbits + 7) >> 3
+        chunk = int.from_bytes(self.data[start:end], 'big')
+        shift = (end << 3) - (self.pos + nbits)
+        self.pos += nbits
+        return (chunk >> shift) & ((1 << nbits) - 1)
+
+
+def _float_bits(value: float) -> int:
+    return struct.unpack('<Q', struct.pack('<d', value))[0]
+
+
+def _bits_float(bits: int) -> float:
+    return struct.unpack('<d', struct.pack('<Q', bits))[0]
+
+
+def _signed(value: int, nbits: int) -> int:
+    if value & (1 << (nbits - 1)):
+        return value - (1 << nbits)
+    return value
+
+
+# delta-of-delta buckets: (prefix, prefix length, value bits)
+_DOD_BUCKETS = [
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+]
+
+
+class BlockEncoder:
+
+    def __init__(self, timestamp: int, value: float):
+        self.bits = BitWriter()
+        self.first_ts = timestamp
+        self.first_value = value
+        self.last_ts = timestamp
+        self.count = 1
+
+        self.prev_delta = 0
+        self.prev_bits = _float_bits(value)
+        self.prev_leading = 65
+        self.prev_trailing = 0
+
+    def has_room(self) -> bool:
+        return len(self.bits) + _MAX_SAMPLE_BITS <= _PAYLOAD_BITS
+
+    def _write_timestamp(self, timestamp: int):
+        delta = timestamp - self.last_ts
+        dod = delta - self.prev_delta
+        self.prev_delta = delta
+        self.last_ts = timestamp
+
+        if dod == 0:
+            self.bits.write(0, 1)
+            return
+        for prefix, plen, nbits in _DOD_BUCKETS:
+            if -(1 << (nbits - 1)) <= dod < (1 << (nbits - 1)):
+                self.bits.write(prefix, plen)
+                self.bits.write(dod, nbits)
+                return
+        self.bits.write(0b1111, 4)
+        self.bits.write(dod, 64)
+
+    def _write_value(self, value: float):
+        bits = _float_bits(value)
+        xor = bits ^ self.prev_bits
+        self.prev_bits = bits
+        if xor == 0:
+            self.bits.write(0, 1)
+            return
+        self.bits.write(1, 1)
+
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if leading >= self.prev_leading and trailing >= self.prev_trailing:
+            # fits in the previous window.
+            self.bits.write(0, 1)
+            meaningful = 64 - self.prev_leading - self.prev_trailing
+            self.bits.write(xor >> self.prev_trailing, meaningful)
+            return
+
+        meaningful = 64 - leading - trailing
+        self.bits.write(1, 1)
+        self.bits.write(leading, 5)
+        # 64 meaningful bits don't fit in 6 bits; 0 stands for them.
+        self.bits.write(meaningful & 0x3f, 6)
+        self.bits.write(xor >> trailing, meaningful)
+        self.prev_leading = leading
+        self.prev_trailing = trailing
+
+    def append(self, timestamp: int, value: float):
+        self._write_timestamp(timestamp)
+        self._write_value(value)
+        self.count += 1
+
+    def to_bytes(self, sealed: bool = False) -> bytes:
+        payload = self.bits.to_bytes()
+        header = _HEADER.pack(
+            _MAGIC, _FLAG_SEALED if sealed else 0, self.count,
+            len(self.bits), self.first_ts, self.last_ts, self.first_value)
+        return (header + payload).ljust(BLOCK_SIZE, b'\0')
+
+
+class BlockHeader:
+
+    def __init__(self, data: bytes):
+        magic, flags, count, nbits, first_ts, last_ts, first_value = \
+            _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise SegmentException("bad block magic")
+        self.is_sealed = bool(flags & _FLAG_SEALED)
+        self.count = count
+        self.nbits = nbits
+        self.first_ts = first_ts
+        self.last_ts = last_ts
+        self.first_value = first_value
+
+
+def decode_block(data: bytes) -> Tuple[BlockHeader, array, array]:
+    header = BlockHeader(data)
+    timestamps = array('q', [header.first_ts])
+    values = array('d', [header.first_value])
+
+    reader = BitReader(data[_HEADER.size:])
+    ts = header.first_ts
+    delta = 0
+    prev_bits = _float_bits(header.first_value)
+    leading = trailing = 0
+
+    for _ in range(header.count - 1):
+        if reader.read(1) == 0:
+            dod = 0
+        elif reader.read(1) == 0:
+            dod = _signed(reader.read(7), 7)
+        elif reader.read(1) == 0:
+            dod = _signed(reader.read(9), 9)
+        elif reader.read(1) == 0:
+            dod = _signed(reader.read(12), 12)
+        else:
+            dod = _signed(reader.read(64), 64)
+        delta += dod
+        ts += delta
+
+        if reader.read(1) == 1:
+            if reader.read(1) == 1:
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+            else:
+                meaningful = 64 - leading - trailing
+            prev_bits ^= reader.read(meaningful) << trailing
+
+        timestamps.append(ts)
+        values.append(_bits_float(prev_bits))
+
+    return header, timestamps, values
+
+
+class SegmentSeries:
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        # sparse index, one entry per block on disk.
+        self.index_first: List[int] = []
+        self.index_last: List[int] = []
+        # the block being appended to, which lives at 'current_block'.
+        self.current: BlockEncoder = None
+        self.current_block = 0
+        self.is_dirty = False
+
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            self.path.touch()
+        size = self.path.stat().st_size
+        if size % BLOCK_SIZE:
+            # a torn write at the end; drop it.
+            size -= size % BLOCK_SIZE
+            os.truncate(self.path, size)
+
+        nblocks = size // BLOCK_SIZE
+        last = None
+        with open(self.path, 'rb') as f:
+            for i in range(nblocks):
+                f.seek(i * BLOCK_SIZE)
+                last = BlockHeader(f.read(_HEADER.size))
+                self.index_first.append(last.first_ts)
+                self.index_last.append(last.last_ts)
+            if last and not last.is_sealed:
+                # pick up where we left off, on the same block.
+                f.seek((nblocks - 1) * BLOCK_SIZE)
+                _, timestamps, values = decode_block(f.read(BLOCK_SIZE))
+                self.current = BlockEncoder(timestamps[0], values[0])
+                for ts, v in zip(timestamps[1:], values[1:]):
+                    self.current.append(ts, v)
+                self.current_block = nblocks - 1
+                return
+        self.current_block = nblocks
+
+    def _write_current(self, sealed: bool):
+        with open(self.path, 'r+b') as f:
+            f.seek(self.current_block * BLOCK_SIZE)
+            f.write(self.current.to_bytes(sealed=sealed))
+
+    def _update_index(self):
+        if self.current_block < len(self.index_first):
+            self.index_last[self.current_block] = self.current.last_ts
+            return
+        self.index_first.append(self.current.first_ts)
+        self.index_last.append(self.current.last_ts)
+
+    def append(self, timestamp: int, value: float):
+        with self.lock:
+            if self.current and not self.current.has_room():
+                self._write_current(sealed=True)
+                self._update_index()
+                self.current_block += 1
+                self.current = None
+
+            if not self.current:
+                self.current = BlockEncoder(timestamp, value)
+            else:
+                self.current.append(timestamp, value)
+            self.is_dirty = True
+
+    def flush(self):
+        with self.lock:
+            if not self.current or not self.is_dirty:
+                return
+            self._write_current(sealed=False)
+            self._update_index()
+            self.is_dirty = False
+
+    def read(self, start: Optional[int] = None,
+             end: Optional[int] = None) -> Tuple[array, array]:
+        self.flush()
+        timestamps, values = array('q'), array('d')
+
+        with self.lock:
+            nblocks = len(self.index_first)
+            # first block that may hold 'start', and past the last that
+            # may hold 'end'.
+            first = 0 if start is None else \
+                bisect_left(self.index_last, start)
+            last = nblocks if end is None else \
+                bisect_right(self.index_first, end)
+            if first >= last:
+                return timestamps, values
+
+            with open(self.path, 'rb') as f, \
+                 mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for i in range(first, last):
+                    off = i * BLOCK_SIZE
+                    _, ts, vs = decode_block(mm[off:off + BLOCK_SIZE])
+                    timestamps.extend(ts)
+                    values.extend(vs)
+
+        if start is None and end is None:
+            return timestamps, values
+        lo = 0 if start is None else bisect_left(timestamps, start)
+        hi = len(timestamps) if end is None else \
+            bisect_right(timestamps, end)
+        return timestamps[lo:hi], values[lo:hi]
+
+
+class SegmentStore:
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.series: Dict[Tuple[int, str], SegmentSeries] = {}
+        self.lock = threading.Lock()
+
+    def _series_path(self, node_id: int, unit: str) -> Path:
+        return self.path / "{}.{}.seg".format(node_id, unit)
+
+    def get_series(self, node_id: int, unit: str) -> SegmentSeries:
+        key = (node_id, unit)
+        with self.lock:
+            if key not in self.series:
+                self.series[key] = \
+                    SegmentSeries(self._series_path(node_id, unit))
+            return self.series[key]
+
+    def append(self, node_id: int, unit: str,
+               timestamp: int, value: float):
+        self.get_series(node_id, unit).append(timestamp, value)
+
+    def read(self, node_id: int, unit: str,
+             start: Optional[int] = None,
+             end: Optional[int] = None) -> Tuple[array, array]:
+        return self.get_series(node_id, unit).read(start, end)
+
+    def flush(self):
+        with self.lock:
+            series = list(self.series.values())
+        for s in series:
+            s.flush()
@@ -0,0 +1,339 @@
+import json
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+"""
+A durable, append-only, on-disk spool for samples on their way out, so
+that whoever's sending them can be down for a while without us losing
+any, or waiting on it.
+
+Appending only queues a sample in memory; a background thread writes
+queued samples out, and fsyncs them, every so often or once enough of
+them are queued -- one fsync for many samples. Samples are only readable
+once they've been synced.
+
+The spool is a directory of segment files, named after an increasing
+sequence number, each a sequence of records:
+
+  * payload length (2 bytes) and crc32 (4 bytes) of the payload;
+  * the payload: timestamp (ms) and value, then label and unit, as utf-8,
+    separated by a nul.
+
+Whoever drains the spool reads a batch from the cursor on, sends it, and
+only then commits the cursor past it; a crash in between sends that batch
+again. Fully read segments are deleted. Past 'max_bytes', the oldest
+segments are dropped, read or not -- losing the oldest samples beats
+filling up the disk.
+
+A torn record at the end of a segment (we crashed while writing it) is
+truncated away when the spool is opened.
+"""
+
+
+_RECORD = struct.Struct('<HI')
+_SAMPLE = struct.Struct('<qd')
+
+_SEGMENT_SUFFIX = '.spool'
+_CURSOR_FILE = 'cursor'
+
+# label, unit, timestamp (ms), value
+Sample = Tuple[str, str, int, float]
+# segment, offset, and records before that offset in the segment.
+Position = Tuple[int, int, int]
+
+
+class SpoolException(Exception):
+    pass
+
+
+def _encode(label: str, unit: str, timestamp: int, value: float) -> bytes:
+    payload = _SAMPLE.pack(timestamp, value) + \
+        '{}\0{}'.format(label, unit).encode()
+    return _RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+"""
+    Decode records from 'buf', starting at 'offset', up to 'limit' of
+    them. Returns the samples, and the offset right after the last one;
+    stops early at the first torn or corrupt record.
+"""
+def _decode(buf: bytes, offset: int = 0, limit: Optional[int] = None
+            ) -> Tuple[List[Sample], int]:
+    samples = []
+    end = len(buf)
+    while offset + _RECORD.size <= end and \
+            (limit is None or len(samples) < limit):
+        length, crc = _RECORD.unpack_from(buf, offset)
+        start = offset + _RECORD.size
+        if start + length > end:
+            break
+        payload = buf[start:start + length]
+        if length < _SAMPLE.size or zlib.crc32(payload) != crc:
+            break
+        timestamp, value = _SAMPLE.unpack_from(payload)
+        try:
+            label, unit = payload[_SAMPLE.size:].decode().split('\0', 1)
+        except ValueError:
+            break
+        samples.append((label, unit, timestamp, value))
+        offset = start + length
+    return samples, offset
+
+
+class Spool:
+
+    def __init__(self, path: str,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 segment_bytes: int = 4 * 1024 * 1024,
+                 sync_interval: float = 1.0,
+                 sync_batch: int = 1000):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        # drop the oldest segments past this many bytes.
+        self.max_bytes = max_bytes
+        # start a new segment past this many bytes.
+        self.segment_bytes = segment_bytes
+        # sync at least this often, if there's anything to sync...
+        self.sync_interval = sync_interval
+        # ... or sooner, if this many samples are queued.
+        self.sync_batch = sync_batch
+
+        # guards everything below but the file being written to.
+        self.lock = threading.Lock()
+        # only one sync at a time.
+        self.sync_lock = threading.Lock()
+        self.queued: List[bytes] = []
+        # synced bytes and records, per segment.
+        self.sizes: Dict[int, int] = {}
+        self.counts: Dict[int, int] = {}
+        self.cursor: Position = (0, 0, 0)
+        self.file = None
+        self.file_seq: Optional[int] = None
+
+        self.sync_event = threading.Event()
+        self.syncer: threading.Thread = None
+        self.is_running = False
+
+        self.appended = 0
+        self.syncs = 0
+        self.dropped = 0
+        self.truncated = 0
+
+        self._open()
+
+    def _segment_path(self, seq: int) -> Path:
+        return self.path / '{:012d}{}'.format(seq, _SEGMENT_SUFFIX)
+
+    def _open(self):
+        seqs = sorted(int(p.name[:-len(_SEGMENT_SUFFIX)])
+                      for p in self.path.glob('*' + _SEGMENT_SUFFIX)
+                      if p.name[:-len(_SEGMENT_SUFFIX)].isdigit())
+        for seq in seqs:
+            path = self._segment_path(seq)
+            buf = path.read_bytes()
+            samples, size = _decode(buf)
+            if size < len(buf):
+                # whatever follows a torn record can't be trusted.
+                self.truncated += 1
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+            self.sizes[seq] = size
+            self.counts[seq] = len(samples)
+
+        cursor = None
+        try:
+            with open(self.path / _CURSOR_FILE) as f:
+                cursor = tuple(json.load(f))
+        except (OSError, ValueError, TypeError):
+            pass
+        if cursor and len(cursor) == 3 and cursor[0] in self.sizes and \
+                cursor[1] <= self.sizes[cursor[0]]:
+            self.cursor = cursor
+        elif seqs:
+            self.cursor = (seqs[0], 0, 0)
+        # anything before the cursor's segment was already sent.
+        for seq in seqs:
+            if seq < self.cursor[0]:
+                self._delete_segment(seq)
+
+        seq = seqs[-1] + 1 if seqs else 0
+        if not seqs:
+            self.cursor = (seq, 0, 0)
+        self._new_segment(seq)
+
+    def _new_segment(self, seq: int):
+        if self.file:
+            self.file.close()
+        self.file = open(self._segment_path(seq), 'ab')
+        self.file_seq = seq
+        self.sizes[seq] = 0
+        self.counts[seq] = 0
+
+    def _delete_segment(self, seq: int):
+        self.sizes.pop(seq, None)
+        self.counts.pop(seq, None)
+        try:
+            os.unlink(self._segment_path(seq))
+        except OSError:
+            pass
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self.syncer = threading.Thread(
+            target=self._sync_loop, name='ozw-spool-sync', daemon=True)
+        self.syncer.start()
+
+    def stop(self):
+        if self.is_running:
+            self.is_running = False
+            self.sync_event.set()
+            self.syncer.join()
+            self.syncer = None
+        self.sync()
+        with self.sync_lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def _sync_loop(self):
+        while self.is_running:
+            self.sync_event.wait(self.sync_interval)
+            self.sync_event.clear()
+            if not self.is_running:
+                break
+            self.sync()
+
+    """
+        Queue a sample; it's written out on the next sync. Cheap enough to
+        be called from whatever thread the sample comes from.
+    """
+    def append(self, label: str, unit: str, timestamp: int, value: float):
+        record = _encode(label, unit, timestamp, value)
+        with self.lock:
+            self.queued.append(record)
+            queued = len(self.queued)
+        if queued >= self.sync_batch:
+            self.sync_event.set()
+
+    """
+        Write out, and fsync, whatever is queued.
+    """
+    def sync(self):
+        with self.sync_lock:
+            with self.lock:
+                queued, self.queued = self.queued, []
+            if not queued or self.file is None:
+                return
+            while queued:
+                # as much as fits in the current segment; at least one.
+                room = self.segment_bytes - self.sizes[self.file_seq]
+                n, size = 0, 0
+                while n < len(queued) and (n == 0 or
+                                           size + len(queued[n]) <= room):
+                    size += len(queued[n])
+                    n += 1
+                self.file.write(b''.join(queued[:n]))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                with self.lock:
+                    seq = self.file_seq
+                    self.sizes[seq] += size
+                    self.counts[seq] += n
+                    self.appended += n
+                    if self.sizes[seq] >= self.segment_bytes:
+                        self._new_segment(seq + 1)
+                    self._enforce_cap()
+                queued = queued[n:]
+            self.syncs += 1
+
+    def _enforce_cap(self):
+        total = sum(self.sizes.values())
+        for seq in sorted(self.sizes):
+            if total <= self.max_bytes or seq == self.file_seq:
+                break
+            total -= self.sizes[seq]
+            cursor_seq, _, read = self.cursor
+            if seq > cursor_seq:
+                self.dropped += self.counts[seq]
+            elif seq == cursor_seq:
+                self.dropped += self.counts[seq] - read
+                self.cursor = (seq + 1, 0, 0)
+            self._delete_segment(seq)
+
+    """
+        Up to 'limit' samples from the cursor on, along with where the
+        cursor goes once they've been dealt with (see 'commit').
+    """
+    def read(self, limit: int) -> Tuple[List[Sample], Position]:
+        samples: List[Sample] = []
+        with self.lock:
+            seq, offset, read = self.cursor
+            segments = sorted((s, self.sizes[s])
+                              for s in self.sizes if s >= seq)
+        for s, size in segments:
+            if s != seq:
+                seq, offset, read = s, 0, 0
+            if offset >= size:
+                continue
+            try:
+                with open(self._segment_path(s), 'rb') as f:
+                    f.seek(offset)
+                    buf = f.read(size - offset)
+            except OSError:
+                # dropped from under us, past the cap.
+                continue
+            got, end = _decode(buf, 0, limit - len(samples))
+            samples.extend(got)
+            offset += end
+            read += len(got)
+            if len(samples) >= limit:
+                break
+        return samples, (seq, offset, read)
+
+    """
+        Move the cursor to 'position', as returned by 'read', deleting
+        segments we're done with.
+    """
+    def commit(self, position: Position):
+        with self.lock:
+            if position[0] < self.cursor[0] or \
+                    (position[0] not in self.sizes):
+                # dropped past the cap in the meantime.
+                return
+            self.cursor = position
+            for seq in [s for s in self.sizes if s < position[0]]:
+                self._delete_segment(seq)
+            tmp = self.path / (_CURSOR_FILE + '.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(list(position), f)
+            os.replace(tmp, self.path / _CURSOR_FILE)
+
+    """
+        Synced samples not yet committed.
+    """
+    def get_backlog(self) -> int:
+        with self.lock:
+            seq, _, read = self.cursor
+            return sum(count for s, count in self.counts.items()
+                       if s >= seq) - read
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            queued = len(self.queued)
+            size = sum(self.sizes.values())
+        return {
+            'queued': queued,
+            'backlog': self.get_backlog(),
+            'bytes': size,
+            'appended': self.appended,
+            'syncs': self.syncs,
+            'dropped': self.dropped,
+            'truncated': self.truncated
+        }
@@ -1,13 +1,23 @@
+import os
 import time
 import json
-from datetime import datetime as dt, timedelta
-from typing import Dict, List
+from datetime import datetime as dt, timedelta, timezone
+from typing import Dict, List, Tuple
 import pprint
-from threading import Lock
+from threading import Lock, Event, Thread
+
+# setting OZW_CLI_SIMULATE (e.g., to 'nodes=40,values=8,rate=10') runs us
+# against a simulated network, as OZW_REST_SIMULATE does for ozw-rest.
+# Must happen before anything pulls openzwave.
+import sim
+simulation = os.environ.get('OZW_CLI_SIMULATE')
+if simulation is not None:
+    sim.install(force=True)
 
 from pydispatch import dispatcher
 
-from prometheus_client import CollectorRegistry, Gauge, pushadd_to_gateway
+from prometheus_client import CollectorRegistry, Counter, Gauge, Summary, \
+                              pushadd_to_gateway
 
 from openzwave.controller import ZWaveController
 from openzwave.network import ZWaveNetwork
@@ -15,6 +25,15 @@ from openzwave.option import ZWaveOption
 from openzwave.node import ZWaveNode
 from openzwave.value import ZWaveValue
 
+from timeseries import RingSeries, now_ms
+from segments import SegmentStore
+from energy import EnergyAccounts
+from spool import Spool
+from remotewrite import RemoteWriteExporter
+from scheduler import RefreshScheduler
+from filters import FilterConfig, SampleFilter
+from ingest import IngestQueue, IngestEvent, POLICY_COALESCE
+
 
 registry = CollectorRegistry()
 
@@ -131,8 +150,52 @@ class PrometheusExporter:
     gateway_url: str = '172.20.20.96:9091'
     lock = Lock()
 
-
-    def __init__(self):
+    # Updates only ever set gauges, in memory; nothing leaves until we're
+    # started. 'sync' then pushes on every single update, from whatever
+    # thread is handling it (that usually being openzwave's). 'async'
+    # leaves the pushing to a background flusher: once per flush_interval,
+    # or as soon as batch_size updates are pending -- but only the once
+    # per interval, however many come in.
+    #
+    # The gateway only ever has one value per series to be scraped, so
+    # what's pushed is each series' latest; what was in between is not,
+    # nor are the samples' own timestamps. For every sample, with its
+    # timestamp, use remote write instead (see remotewrite.py).
+    #
+    # A push that fails spools what it was to push, on disk, so it's not
+    # lost if we don't make it to the next one; that one pushes it anyway,
+    # gauges holding on to what they're set to. While the gateway is down,
+    # intervals double, up to max_retry_interval.
+    MODE_SYNC = 'sync'
+    MODE_ASYNC = 'async'
+
+
+    def __init__(self, mode: str = MODE_ASYNC,
+                 flush_interval: float = 15.0,
+                 batch_size: int = 100,
+                 spool_dir: str = 'spool',
+                 max_retry_interval: float = 300.0):
+
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # where what failed to be pushed waits for the next push.
+        self.spool_dir = spool_dir
+        self.max_retry_interval = max_retry_interval
+
+        self.spool: Spool = None
+        # (node, unit) -> (timestamp, value), set since the last push.
+        self.dirty: Dict[Tuple[str, str], Tuple[int, float]] = {}
+        self.pending = 0
+        self.pending_lock = Lock()
+        self.flush_event = Event()
+        self.flush_lock = Lock()
+        self.flusher: Thread = None
+        self.is_running = False
+        self.retry_interval = 0.0
+        self.pushes = 0
+        self.push_seconds = 0.0
+        self.failures = 0
 
         self.gauges: Dict[str, Gauge] = {}
         for unit in ['kWh', 'W', 'V', 'A']:
@@ -145,63 +208,228 @@ class PrometheusExporter:
                 labelnames=['node'])
             self.gauges[unit] = gauge
 
-    
-    def handle(self, node: str, unit: str, value: float):
-        self.lock.acquire()
-        if unit not in self.gauges:
-            print("  [error] --> unrecognized unit: {}".format(unit))
-            self.lock.release()
-            return
-        gauge = self.gauges[unit]
-        gauge.labels(node).set(value)
-
-        print("[push] node={}, unit={}, value={}".format(
-            node, unit, value
-        ))
-        pushadd_to_gateway(
-            self.gateway_url,
-            job="home_energy_consumption",
+        # these go out along with everything else.
+        self.pending_gauge = Gauge(
+            name="exporter_pending_updates",
+            documentation='updates waiting to be pushed',
+            namespace='home',
+            registry=self.registry)
+        self.push_latency = Summary(
+            name="exporter_push_latency_seconds",
+            documentation='time taken pushing to the gateway',
+            namespace='home',
+            registry=self.registry)
+        self.push_failures = Counter(
+            name="exporter_push_failures",
+            documentation='failed pushes to the gateway',
+            namespace='home',
             registry=self.registry)
-        self.lock.release()
 
 
-prometheus: PrometheusExporter = PrometheusExporter()
+    def start(self):
+        with self.lock:
+            if self.is_running:
+                return
+            if self.spool is None:
+                self.spool = Spool(self.spool_dir)
+                self._restore_spooled()
+            self.spool.start()
+            self.is_running = True
+        self.flusher = Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
 
-class DataValue:
 
-    timestamp: dt = None
-    node_id: int = None
-    node_name: str = None
-    unit: str = None
-    value: float = None
+    def stop(self):
+        if not self.is_running:
+            return
+        self.is_running = False
+        self.flush_event.set()
+        self.flusher.join()
+        self.flusher = None
+        # whatever is left goes now, if it can; or stays spooled, for the
+        # next time.
+        self.flush()
+        self.spool.stop()
+
+
+    """
+        What failed to be pushed last time we ran, back into the gauges;
+        unless we've been told something newer since.
+    """
+    def _restore_spooled(self):
+        samples, _ = self.spool.read(self.spool.get_backlog())
+        with self.pending_lock:
+            for node, unit, ts, value in samples:
+                if unit not in self.gauges:
+                    continue
+                known = self.dirty.get((node, unit))
+                if known is not None and known[0] > ts:
+                    continue
+                self.gauges[unit].labels(node).set(value)
+                self.dirty[(node, unit)] = (ts, value)
+            self.pending = len(self.dirty)
+        if samples:
+            print("[push] {} spooled updates to push".format(len(samples)))
+
+
+    def _push(self):
+        start = time.monotonic()
+        try:
+            pushadd_to_gateway(
+                self.gateway_url,
+                job="home_energy_consumption",
+                registry=self.registry)
+        finally:
+            elapsed = time.monotonic() - start
+            self.push_latency.observe(elapsed)
+            self.pushes += 1
+            self.push_seconds += elapsed
+
+
+    """
+        Push what was set since the last push, if anything was. Returns
+        whether it went through, or there was nothing to push.
+    """
+    def flush(self) -> bool:
+        with self.flush_lock:
+            return self._flush()
+
+
+    def _flush(self) -> bool:
+        with self.pending_lock:
+            dirty, self.dirty = self.dirty, {}
+            pending, self.pending = self.pending, 0
+        if not dirty:
+            return True
+        self.pending_gauge.set(pending)
+        try:
+            self._push()
+        except Exception as e:
+            print("  [error] --> push failed: {}".format(e))
+            self.push_failures.inc()
+            self.failures += 1
+            with self.pending_lock:
+                # anything set since is newer.
+                for key, sample in dirty.items():
+                    self.dirty.setdefault(key, sample)
+                self.pending += pending
+            for (node, unit), (ts, value) in dirty.items():
+                self.spool.append(node, unit, ts, value)
+            return False
+        # gauges hold whatever's spooled, or something newer; pushed.
+        self.spool.sync()
+        backlog = self.spool.get_backlog()
+        if backlog:
+            _, position = self.spool.read(backlog)
+            self.spool.commit(position)
+        return True
 
-    def __init__(self, node: ZWaveNode, value: ZWaveValue):
-        self.node_id = node.node_id
-        self.node_name = node.name
-        self.unit = value.units
-        self.value = value.data
-        self.timestamp = dt.utcnow()
 
-    def __str__(self):
-        return "[{}] -- node #{} name '{}': {} = {}".format(
-            self.timestamp,
-            self.node_id, self.node_name, self.unit, self.value
-        )
+    def _flush_loop(self):
+        interval_end = time.monotonic() + self.flush_interval
+        pushed = False
+        while self.is_running:
+            self.flush_event.wait(max(0.0, interval_end - time.monotonic()))
+            self.flush_event.clear()
+            if not self.is_running:
+                break
+            if time.monotonic() >= interval_end:
+                # no point in hurrying while the gateway is down.
+                interval_end = time.monotonic() + \
+                    (self.retry_interval or self.flush_interval)
+                pushed = False
+            elif pushed or self.pending < self.batch_size:
+                # this interval's had its push, or it isn't due yet.
+                continue
+            with self.pending_lock:
+                if not self.dirty:
+                    continue
+            pushed = True
+            if self.flush():
+                self.retry_interval = 0.0
+            else:
+                self.retry_interval = min(
+                    self.max_retry_interval,
+                    max(self.flush_interval, self.retry_interval * 2))
+
+
+    def get_stats(self):
+        return {
+            'pending': self.pending,
+            'pushes': self.pushes,
+            'push_seconds': self.push_seconds,
+            'failures': self.failures,
+            'retry_interval': self.retry_interval,
+            'spool': self.spool.get_stats() if self.spool else None
+        }
 
+    
+    def handle(self, node: str, unit: str, value: float,
+               timestamp: int = None):
+        if unit not in self.gauges:
+            print("  [error] --> unrecognized unit: {}".format(unit))
+            return
+
+        self.gauges[unit].labels(node).set(value)
+        with self.pending_lock:
+            self.dirty[(node, unit)] = (
+                timestamp if timestamp is not None else now_ms(), value)
+            self.pending += 1
+            pending = self.pending
+        if not self.is_running or self.retry_interval:
+            return
+
+        if self.mode == self.MODE_SYNC:
+            if self.flush_lock.acquire(blocking=False):
+                try:
+                    print("[push] node={}, unit={}, value={}".format(
+                        node, unit, value
+                    ))
+                    if not self._flush():
+                        self.retry_interval = self.flush_interval
+                finally:
+                    self.flush_lock.release()
+        elif pending >= self.batch_size:
+            self.flush_event.set()
 
-class DataNode:
-    node: ZWaveNode = None
-    values: List[ZWaveValue]  # use this solely to trigger updates
-    values_per_unit: Dict[str, List[DataValue]] # our time series
-    last_values_timestamp: Dict[str, dt]
 
+prometheus: PrometheusExporter = PrometheusExporter()
+# every sample, with its own timestamp, to a remote write endpoint; set
+# from OZW_CLI_REMOTE_WRITE (say, 'http://prometheus:9090/api/v1/write').
+remote_write: RemoteWriteExporter = None
 
-    def __init__(self, node):
+class DataNode:
+    node: ZWaveNode = None
+    values: Dict[int, ZWaveValue]  # use this solely to trigger updates
+    values_per_unit: Dict[str, RingSeries] # our time series
+    filters_per_unit: Dict[str, SampleFilter]
+
+    # how many samples we keep per unit; once full, the oldest ones go.
+    # At one sample every 5 seconds, the default is a day's worth.
+    default_retention: int = 17280
+    retention: Dict[str, int] = {}
+
+    # which samples are worth keeping, per unit; see filters.py.
+    default_filter: FilterConfig = FilterConfig(heartbeat=300)
+    filters: Dict[str, FilterConfig] = {
+        'W': FilterConfig(deadband=1.0, deadband_rel=0.01, heartbeat=300),
+        'V': FilterConfig(deadband_rel=0.005, heartbeat=300),
+        'A': FilterConfig(deadband=0.01, deadband_rel=0.01, heartbeat=300),
+        'kWh': FilterConfig(swinging_door=0.01, heartbeat=900),
+    }
+
+
+    def __init__(self, node, segments: SegmentStore = None,
+                 energy: EnergyAccounts = None):
         self.node = node
-        self.init_from_node(node)
+        # where samples end up on disk, if anywhere.
+        self.segments = segments
+        # what accounts for the energy consumed, if anything.
+        self.energy = energy
         self.values_per_unit = {}
-        self.values = []
-        self.last_values_timestamp = {}
+        self.filters_per_unit = {}
+        self.values = {}
+        self.init_from_node(node)
     
 
     def init_from_node(self, node):
@@ -210,11 +438,26 @@ class DataNode:
         for value in values.values():
             if not want_this_value(value):
                 continue
-            self.values.append(value)
+            self.values[value.value_id] = value
             self.update_value(value)
 
 
-    def handle_value(self, value: ZWaveValue):
+    def get_series(self, unit: str) -> RingSeries:
+        if unit not in self.values_per_unit:
+            capacity = self.retention.get(unit, self.default_retention)
+            self.values_per_unit[unit] = RingSeries(capacity)
+        return self.values_per_unit[unit]
+
+
+    def get_filter(self, unit: str) -> SampleFilter:
+        if unit not in self.filters_per_unit:
+            config = self.filters.get(unit, self.default_filter)
+            self.filters_per_unit[unit] = SampleFilter(config)
+        return self.filters_per_unit[unit]
+
+
+    def handle_value(self, value: ZWaveValue, data=None,
+                     timestamp: int = None):
         if not want_this_value(value):
             return
 
@@ -222,46 +465,65 @@ class DataNode:
             print("  [error!] node id mismatch!")
             return
 
-        units = value.units
-        if units not in self.values_per_unit:
-            self.values_per_unit[units] = []
-
         print("[handle] node #{}, unit = '{}', value = {}".format(
-            value.node.node_id, value.units, value.data
+            value.node.node_id, value.units,
+            data if data is not None else value.data
         ))
-        self.update_value(value)
+        self.update_value(value, data, timestamp)
 
 
-    def update_value(self, value: ZWaveValue):
-        unit = value.units
-        if unit not in self.values_per_unit:
-            self.values_per_unit[unit] = []
-
-        datavalue = DataValue(self.node, value)
-        print("[update] {}".format(datavalue))
-        if unit in self.last_values_timestamp:
-            last_update = self.last_values_timestamp[unit]
-            td = datavalue.timestamp - last_update
-            if td < timedelta(seconds=5):
-                # assume repeat
-                return
-        self.last_values_timestamp[unit] = datavalue.timestamp
-        self.values_per_unit[unit].append(datavalue)
-        self.values.append(value)
+    """
+        Take in a reading of 'value': 'data', as it was at 'timestamp'
+        (ms), when we're told; what 'value' holds now, otherwise.
+    """
+    def update_value(self, value: ZWaveValue, data=None,
+                     timestamp: int = None):
+        unit = str(value.units)
+        self.values[value.value_id] = value
+
+        if data is None:
+            data = value.data
+        if timestamp is None:
+            timestamp = now_ms()
+        print("[update] node #{}: {} = {}".format(
+            self.node.node_id, unit, data))
+        # energy accounting wants every reading, not just those we keep.
+        if self.energy:
+            self.energy.feed(self.node.node_id, unit, float(data),
+                             timestamp, value.instance)
+        samples = self.get_filter(unit).offer(timestamp, float(data))
+        if not samples:
+            return
+
+        series = self.get_series(unit)
+        for ts, data in samples:
+            series.append(data, ts)
+            if self.segments:
+                self.segments.append(self.node.node_id, unit, ts, data)
 
         node_str = 'node_{}'.format(self.node.node_id)
-        unit = str(value.units)
-        value = float(value.data)
-        prometheus.handle(node_str, unit, value)
+        for ts, data in samples:
+            prometheus.handle(node_str, unit, data, ts)
+            if remote_write:
+                remote_write.handle(node_str, unit, data, ts)
 
 
 
 class DataStore:
 
     datastore: Dict[int, DataNode] = {}
-    is_evicting: bool = False
 
-    def __init__(self):
+    def __init__(self, data_dir: str = 'data',
+                 scheduler: RefreshScheduler = None):
+        self.segments = SegmentStore(data_dir)
+        self.energy = EnergyAccounts()
+        # refreshes the values we track, each at its own pace.
+        self.scheduler = scheduler if scheduler else RefreshScheduler()
+        # signal handlers only queue events; we handle them on our own
+        # thread, away from openzwave's notification loop.
+        self.ingest = IngestQueue(self._dispatch, policy=POLICY_COALESCE,
+                                  name='ozw-cli-ingest')
+        self.ingest.start()
         dispatcher.connect(self.handle_value, ZWaveNetwork.SIGNAL_VALUE)
         dispatcher.connect(self.handle_node_event, ZWaveNetwork.SIGNAL_NODE_ADDED)
         dispatcher.connect(self.handle_node_event, ZWaveNetwork.SIGNAL_NODE_NEW)
@@ -292,41 +554,46 @@ class DataStore:
     def dump_to_stdout(self):
         for node_id, datanode in self.datastore.items():
             print("--> node #{}".format(node_id))
-
-            for values in datanode.values_per_unit.values():
-                value: DataValue
-                for value in values:
+            meter = self.energy.get_meter(node_id)
+            if meter:
+                current = meter.totals.current()
+                print("  [energy] {:.3f} kWh today, {:.3f} kWh this month"
+                      " ({} resets, {} wraps, {} glitches)".format(
+                          current['day'], current['month'], meter.resets,
+                          meter.wraps, meter.glitches))
+
+            for unit, series in datanode.values_per_unit.items():
+                for timestamp, value in series:
                     print("  [{}]  {} = {}".format(
-                        value.timestamp, value.unit, value.value
+                        dt.utcfromtimestamp(timestamp / 1000), unit, value
                     ))
         return
 
 
     def dump_to_disk(self):
+        # samples are appended as they come; all that's left for us is to
+        # make sure whatever is still in memory makes it to disk.
+        print("  [write] --> {} series".format(len(self.segments.series)))
+        self.segments.flush()
+        return
 
-        for node_id, datanode in self.datastore.items():
-            print("  [write] --> node {}".format(node_id))
-
-            ts = dt.utcnow()
-            #filename = "{}_{}.{}.log".format(ts.isoformat(), node_id, unit)
-
-            for unit, values in datanode.values_per_unit.items():
-                value_lst = []
-                value: DataValue
-                filename = "{}_{}.{}.log".format(ts.isoformat(), node_id, unit)
-                for value in values:
-                    print("         `-- {}, value: {}".format(unit, str(value)))
-                    value_lst.append({
-                        'node': value.node_id,
-                        'name': value.node_name,
-                        'unit': value.unit,
-                        'value': value.value
-                    })
-                #pprint.pprint(value_lst)
-                with open(filename, 'a') as f:
-                    json.dump(value_lst, f)
 
-        return
+    def read_from_disk(self, node_id: int, unit: str,
+                       start: dt = None, end: dt = None):
+        def _ms(d):
+            return int(d.replace(tzinfo=timezone.utc).timestamp() * 1000) \
+                if d else None
+        return self.segments.read(node_id, unit, _ms(start), _ms(end))
+
+
+    def get_filter_stats(self) -> Dict[str, Dict[str, int]]:
+        stats = {}
+        for datanode in list(self.datastore.values()):
+            for unit, f in list(datanode.filters_per_unit.items()):
+                s = stats.setdefault(unit, {'seen': 0, 'stored': 0})
+                s['seen'] += f.seen
+                s['stored'] += f.stored
+        return stats
 
 
     def dump(self, stdout=False, disk=False):
@@ -337,37 +604,32 @@ class DataStore:
             self.dump_to_disk()
 
 
-    def evict(self):
-        # this is probably overkill, and most definitely not safe ;)
-        self.is_evicting = True
-        self.datastore = {}
-        self.is_evicting = False
-
-
-    def refresh(self):
-        #self.dump(stdout=True, disk=False)
-
-        # clear in-memory cache first
-        ds = self.datastore
-        self.evict()
+    def handle_value(self, signal, **kwargs):
+        # print("--> handling value ({}): {}".format(signal, kwargs))
+        node: ZWaveNode = kwargs['node']
+        value: ZWaveValue = kwargs['value']
+        self.ingest.put(IngestEvent(
+            'value', signal, node_id=node.node_id, value_id=value.value_id,
+            data=value.data, node=node, value=value, key=value.value_id))
 
-        node: DataNode
-        for node in ds.values():
-            value: ZWaveValue
-            for value in node.values:
-                value.refresh()
 
-        pass
+    def handle_node_event(self, signal, **kwargs):
+        node: ZWaveNode = kwargs['node']
+        self.ingest.put(IngestEvent(
+            'node', signal, node_id=node.node_id, node=node))
 
 
-    def handle_value(self, signal, **kwargs):
-        # print("--> handling value ({}): {}".format(signal, kwargs))
+    def _dispatch(self, event: IngestEvent):
+        if event.kind == 'value':
+            # what the value was when we were told, not what it is now.
+            self._handle_value(event.node, event.value, event.data,
+                               int(event.timestamp * 1000))
+        elif event.kind == 'node':
+            self._handle_node_event(event.signal, event.node)
 
-        if self.is_evicting: # don't handle while evicting
-            return
 
-        node: ZWaveNode = kwargs['node']
-        value: ZWaveValue = kwargs['value']
+    def _handle_value(self, node: ZWaveNode, value: ZWaveValue, data=None,
+                      timestamp: int = None):
 
         if not self.do_we_care(node, value):
             return
@@ -376,16 +638,15 @@ class DataStore:
             return
 
         print("[changed] --> node #{}: units '{}' = {}".format(
-            node.node_id, value.units, value.data
+            node.node_id, value.units,
+            data if data is not None else value.data
         ))
-        return self.datastore[node.node_id].handle_value(value)
-
+        self.scheduler.observe(value, data)
+        return self.datastore[node.node_id].handle_value(
+            value, data, timestamp)
 
-    def handle_node_event(self, signal, **kwargs):
-        if self.is_evicting: # don't handle while evicting
-            return
 
-        node: ZWaveNode = kwargs['node']
+    def _handle_node_event(self, signal, node: ZWaveNode):
         if not self.do_we_care(node):
             return
 
@@ -398,13 +659,18 @@ class DataStore:
             print("   [node] --- known node; ignore.")
             return
         
-        datanode = DataNode(node)
+        datanode = DataNode(node, self.segments, self.energy)
         self.datastore[node.node_id] = datanode
+        for value in datanode.values.values():
+            self.scheduler.add(value)
 
 
 if __name__ == '__main__':
 
-    options = ZWaveOption(device='/dev/ttyACM0')
+    if simulation is not None:
+        options = ZWaveOption(config=sim.SimConfig.from_str(simulation))
+    else:
+        options = ZWaveOption(device='/dev/ttyACM0')
     options.set_log_file('test.log')
     options.set_append_log_file(True)
     options.set_console_output(False)
@@ -438,11 +704,25 @@ if __name__ == '__main__':
     init_end = dt.utcnow()
     print("-- initialization took {}".format(init_end - init_start))        
 
+    # where what the gateway couldn't take waits for it, if not './spool'.
+    prometheus.spool_dir = os.environ.get('OZW_CLI_SPOOL',
+                                          prometheus.spool_dir)
+    prometheus.start()
+    if os.environ.get('OZW_CLI_REMOTE_WRITE'):
+        remote_write = RemoteWriteExporter(os.environ['OZW_CLI_REMOTE_WRITE'])
+        remote_write.start()
+    ds.scheduler.start()
+
     backoff = 30 # seconds
-    while True:
-        ds.dump_to_disk()
-        ds.refresh()
-        time.sleep(backoff)
+    try:
+        while True:
+            ds.dump_to_disk()
+            time.sleep(backoff)
+    finally:
+        ds.scheduler.stop()
+        prometheus.stop()
+        if remote_write:
+            remote_write.stop()
 
     import code
     code.interact(local=locals())
\ No newline at end of file
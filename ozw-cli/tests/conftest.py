@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# ozw-cli's modules are plain files, imported as such.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,22 @@
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent.parent
+BACKEND = ROOT / 'ozw-rest' / 'backend'
+
+
+# the tools don't share code: each keeps its own copy of what it has in
+# common with ozw-rest. Copies start with a note saying so, then are the
+# same, to the byte.
+@pytest.mark.parametrize('copy', [
+    'ozw-cli/sim.py', 'ozw-cli/energy.py', 'ozw-cli/ingest.py',
+    'ozw-tui/sim.py',
+])
+def test_copy_is_the_same(copy):
+    copied = (ROOT / copy).read_text()
+    original = (BACKEND / Path(copy).name).read_text()
+    note, sep, body = copied.partition('\n\n')
+    assert sep and note.startswith('# A copy of ')
+    assert body == original, \
+        f"{copy} differs from ozw-rest's; change them all alike"
@@ -0,0 +1,161 @@
+import http.server
+import importlib.util
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+# test.py pulls openzwave; have it pull the simulated one.
+os.environ.setdefault('OZW_CLI_SIMULATE', '')
+_spec = importlib.util.spec_from_file_location(
+    'ozw_cli', Path(__file__).resolve().parent.parent / 'test.py')
+cli = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(cli)
+
+
+class _GatewayHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        gateway = self.server.gateway
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with gateway.lock:
+            gateway.pushes.append(body.decode())
+        self.send_response(gateway.status)
+        self.end_headers()
+
+    do_PUT = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Gateway:
+
+    def __init__(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _GatewayHandler)
+        self.server.gateway = self
+        self.lock = threading.Lock()
+        self.pushes = []
+        self.status = 200
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        host, port = self.server.server_address
+        return f"{host}:{port}"
+
+    def pushed(self, node: str, unit: str, value: float) -> bool:
+        line = f'home_consumption_{unit}{{node="{node}"}} {value}'
+        return line in self.pushes[-1].split('\n')
+
+
+@pytest.fixture
+def gateway():
+    gateway = _Gateway()
+    yield gateway
+    gateway.server.shutdown()
+
+
+@pytest.fixture
+def make_exporter(tmp_path, gateway):
+    exporters = []
+
+    def make(**kwargs):
+        # a registry of its own, as gauges can't be registered twice.
+        cls = type('Exporter', (cli.PrometheusExporter,), {
+            'registry': CollectorRegistry(),
+            'gateway_url': gateway.address})
+        kwargs.setdefault('spool_dir', str(tmp_path / 'spool'))
+        kwargs.setdefault('flush_interval', 3600.0)
+        exporter = cls(**kwargs)
+        exporters.append(exporter)
+        return exporter
+
+    yield make
+    for exporter in exporters:
+        exporter.stop()
+
+
+def test_nothing_leaves_until_started(tmp_path, gateway, make_exporter):
+    exporter = make_exporter()
+    exporter.handle('node_2', 'W', 10.0, 1000)
+    exporter.handle('node_2', 'W', 12.5, 2000)
+    assert not gateway.pushes
+    assert not (tmp_path / 'spool').exists()
+
+    exporter.start()
+    assert exporter.flush()
+    assert len(gateway.pushes) == 1
+    assert gateway.pushed('node_2', 'W', 12.5)
+    # nothing new, nothing to push.
+    assert exporter.flush()
+    assert len(gateway.pushes) == 1
+
+
+def test_async_pushes_at_most_once_per_interval(gateway, make_exporter):
+    exporter = make_exporter(flush_interval=0.3, batch_size=10)
+    exporter.start()
+    start = time.monotonic()
+    for i in range(300):
+        exporter.handle(f"node_{i % 4}", 'W', float(i), 1000 + i)
+        time.sleep(0.003)
+    elapsed = time.monotonic() - start
+    pushes = len(gateway.pushes)
+    # a full batch brings an interval's push forward, once.
+    assert 1 <= pushes <= int(elapsed / 0.3) + 1
+    exporter.stop()
+    assert gateway.pushed('node_3', 'W', 299.0)
+    assert exporter.spool.get_stats()['appended'] == 0
+
+
+def test_failed_push_spools_the_latest(gateway, make_exporter):
+    exporter = make_exporter()
+    exporter.start()
+    gateway.status = 500
+    for i in range(5):
+        exporter.handle('node_2', 'kWh', 1.0 + i, 1000 + i)
+    exporter.handle('node_3', 'W', 40.0, 1000)
+    assert not exporter.flush()
+    exporter.spool.sync()
+    assert exporter.spool.get_backlog() == 2
+
+    gateway.status = 200
+    exporter.handle('node_3', 'W', 41.0, 2000)
+    assert exporter.flush()
+    assert gateway.pushed('node_2', 'kWh', 5.0)
+    assert gateway.pushed('node_3', 'W', 41.0)
+    assert exporter.spool.get_backlog() == 0
+
+
+def test_spooled_is_pushed_after_a_restart(gateway, make_exporter):
+    exporter = make_exporter()
+    exporter.start()
+    gateway.status = 500
+    exporter.handle('node_2', 'kWh', 7.5, 1000)
+    exporter.handle('node_3', 'kWh', 2.0, 1000)
+    exporter.stop()
+
+    gateway.status = 200
+    restarted = make_exporter()
+    # newer than what's spooled; stays.
+    restarted.handle('node_3', 'kWh', 2.5, 2000)
+    restarted.start()
+    assert restarted.flush()
+    assert gateway.pushed('node_2', 'kWh', 7.5)
+    assert gateway.pushed('node_3', 'kWh', 2.5)
+    assert restarted.spool.get_backlog() == 0
+
+
+def test_sync_pushes_every_update(gateway, make_exporter):
+    exporter = make_exporter(mode=cli.PrometheusExporter.MODE_SYNC)
+    exporter.start()
+    for i in range(3):
+        exporter.handle('node_2', 'A', float(i), 1000 + i)
+    assert len(gateway.pushes) == 3
+    assert gateway.pushed('node_2', 'A', 2.0)
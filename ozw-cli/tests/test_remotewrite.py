@@ -0,0 +1,231 @@
+import http.server
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+snappy = pytest.importorskip('snappy')
+
+from remotewrite import METRIC_PREFIX, RemoteWriteExporter, \
+                        decode_write_request, encode_labels, \
+                        encode_write_request
+
+
+class _ReceiverHandler(http.server.BaseHTTPRequestHandler):
+
+    # keeps connections open, as shards expect.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        series = decode_write_request(snappy.decompress(payload))
+        status = receiver.respond(series)
+        with receiver.lock:
+            receiver.headers.append(dict(self.headers))
+            if status // 100 == 2:
+                receiver.received.extend(series)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+"""
+A remote write endpoint, in process. Answers with whatever 'statuses' has
+next, or with what 'fail' says for a request, if anything; 200 otherwise.
+Keeps what it took in.
+"""
+class _Receiver:
+
+    def __init__(self, statuses=(), fail=None):
+        self.statuses = list(statuses)
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.received = []
+        self.headers = []
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _ReceiverHandler)
+        self.server.receiver = self
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/api/v1/write"
+
+    def respond(self, series) -> int:
+        with self.lock:
+            if self.statuses:
+                return self.statuses.pop(0)
+            if self.fail:
+                return self.fail(series) or 200
+        return 200
+
+    def samples(self) -> Counter:
+        with self.lock:
+            return Counter((labels['node'], labels['__name__'], ts, value)
+                           for labels, samples in self.received
+                           for ts, value in samples)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def make_receiver():
+    receivers = []
+
+    def make(*args, **kwargs):
+        receiver = _Receiver(*args, **kwargs)
+        receivers.append(receiver)
+        return receiver
+
+    yield make
+    for receiver in receivers:
+        receiver.close()
+
+
+@pytest.fixture
+def make_exporter(tmp_path):
+    exporters = []
+
+    def make(url, **kwargs):
+        kwargs.setdefault('spool_dir', str(tmp_path / 'spool'))
+        kwargs.setdefault('flush_interval', 3600.0)
+        kwargs.setdefault('min_backoff', 0.01)
+        kwargs.setdefault('max_backoff', 0.05)
+        exporter = RemoteWriteExporter(url, **kwargs)
+        exporters.append(exporter)
+        return exporter
+
+    yield make
+    for exporter in exporters:
+        exporter.stop(timeout=0.0)
+
+
+def _feed(exporter, count: int, nodes: int = 5):
+    units = ['kWh', 'W', 'V', 'A']
+    expected = Counter()
+    for i in range(count):
+        node, unit = f"node_{i % nodes}", units[i % len(units)]
+        exporter.handle(node, unit, i * 0.5, 1_600_000_000_000 + i)
+        expected[(node, METRIC_PREFIX + unit,
+                  1_600_000_000_000 + i, i * 0.5)] += 1
+    return expected
+
+
+def test_encoding_is_protobuf():
+    labels = encode_labels({'node': 'n', '__name__': 'm'})
+    # Label {name, value}, as TimeSeries.labels (1); sorted by name.
+    assert labels == b'\x0a\x0d\x0a\x08__name__\x12\x01m' \
+                     b'\x0a\x09\x0a\x04node\x12\x01n'
+    request = encode_write_request({labels: [(1000, 1.5)]})
+    # Sample {value (1, double), timestamp (2, varint)}.
+    sample = b'\x09' + b'\x00\x00\x00\x00\x00\x00\xf8\x3f' + b'\x10\xe8\x07'
+    assert request == b'\x0a' + bytes([len(labels) + 2 + len(sample)]) + \
+        labels + b'\x12' + bytes([len(sample)]) + sample
+
+
+def test_encode_decode():
+    samples = [(1_600_000_000_000, 1.5), (-1, -0.25), (0, 0.0),
+               (2 ** 62, 1e300)]
+    request = encode_write_request({
+        encode_labels({'__name__': 'home_consumption_W', 'node': 'n1'}):
+            samples,
+        encode_labels({'__name__': 'home_consumption_A', 'node': 'n2'}):
+            [(5, 2.0)]})
+    assert decode_write_request(request) == [
+        ({'__name__': 'home_consumption_W', 'node': 'n1'}, samples),
+        ({'__name__': 'home_consumption_A', 'node': 'n2'}, [(5, 2.0)])]
+
+
+def test_every_sample_once(make_receiver, make_exporter):
+    receiver = make_receiver()
+    exporter = make_exporter(receiver.url, batch_size=50)
+    exporter.start()
+    expected = _feed(exporter, 1000)
+    exporter.stop()
+    assert receiver.samples() == expected
+    labels = {tuple(sorted(labels)) for labels, _ in receiver.received}
+    assert labels == {('__name__', 'job', 'node')}
+    headers = receiver.headers[0]
+    assert headers['Content-Encoding'] == 'snappy'
+    assert headers['Content-Type'] == 'application/x-protobuf'
+    assert headers['X-Prometheus-Remote-Write-Version'] == '0.1.0'
+    # each series' samples, oldest first.
+    for _, samples in receiver.received:
+        assert samples == sorted(samples)
+    assert exporter.spool.get_backlog() == 0
+
+
+@pytest.mark.parametrize('status', [503, 429])
+def test_retries_until_through(make_receiver, make_exporter, status):
+    receiver = make_receiver(statuses=[status] * 3)
+    exporter = make_exporter(receiver.url, shards=1)
+    exporter.start()
+    expected = _feed(exporter, 100)
+    assert exporter.flush()
+    assert receiver.samples() == expected
+    stats = exporter.get_stats()
+    assert (stats['retries'], stats['requests']) == (3, 4)
+    assert stats['rejected'] == 0
+
+
+def test_failing_shard_costs_no_duplicates(make_receiver, make_exporter):
+    failures = {'left': 5}
+
+    def fail(series):
+        # whichever shard has node_1's series fails, for a while.
+        if any(labels['node'] == 'node_1' for labels, _ in series) and \
+           failures['left'] > 0:
+            failures['left'] -= 1
+            return 503
+        return None
+
+    receiver = make_receiver(fail=fail)
+    exporter = make_exporter(receiver.url, batch_size=20, shards=4)
+    exporter.start()
+    expected = _feed(exporter, 400)
+    exporter.stop()
+    received = receiver.samples()
+    assert received == expected
+    assert max(received.values()) == 1
+    assert exporter.get_stats()['retries'] == 5
+
+
+def test_rejected_is_dropped(make_receiver, make_exporter):
+    receiver = make_receiver(statuses=[400])
+    exporter = make_exporter(receiver.url, shards=1)
+    exporter.start()
+    _feed(exporter, 10)
+    assert exporter.flush()
+    assert not receiver.received
+    stats = exporter.get_stats()
+    assert (stats['rejected'], stats['retries']) == (10, 0)
+    assert exporter.spool.get_backlog() == 0
+
+
+def test_stop_gives_up_at_the_deadline(make_receiver, make_exporter):
+    down = make_receiver(fail=lambda series: 503)
+    exporter = make_exporter(down.url, shards=2)
+    exporter.start()
+    expected = _feed(exporter, 50)
+    start = time.monotonic()
+    exporter.stop(timeout=0.3)
+    assert time.monotonic() - start < 2.0
+    assert not down.received
+    assert exporter.spool.get_backlog() == 50
+
+    # what didn't make it is sent next time around.
+    up = make_receiver()
+    restarted = make_exporter(up.url, shards=2)
+    restarted.start()
+    restarted.stop()
+    assert up.samples() == expected
@@ -0,0 +1,151 @@
+import math
+import random
+import struct
+
+import pytest
+
+from segments import BLOCK_SIZE, BitReader, BitWriter, BlockEncoder, \
+                     BlockHeader, SegmentSeries, SegmentStore, \
+                     SegmentException, decode_block, _HEADER
+
+
+def _roundtrip(samples):
+    encoder = BlockEncoder(*samples[0])
+    for ts, v in samples[1:]:
+        encoder.append(ts, v)
+    data = encoder.to_bytes()
+    assert len(data) == BLOCK_SIZE
+    header, timestamps, values = decode_block(data)
+    assert header.count == len(samples)
+    return list(timestamps), list(values), encoder
+
+
+def test_bits_roundtrip():
+    writer = BitWriter()
+    fields = [(1, 1), (0b101, 3), (0x1234, 16), (2 ** 64 - 1, 64), (0, 7)]
+    for value, nbits in fields:
+        writer.write(value, nbits)
+    assert len(writer) == sum(n for _, n in fields)
+    reader = BitReader(writer.to_bytes())
+    assert [reader.read(n) for _, n in fields] == [v for v, _ in fields]
+
+
+def test_regular_timestamps_and_repeated_values_are_cheap():
+    samples = [(1_600_000_000_000 + i * 1000, 230.0) for i in range(100)]
+    timestamps, values, encoder = _roundtrip(samples)
+    assert timestamps == [ts for ts, _ in samples]
+    assert values == [v for _, v in samples]
+    # a bit for the delta of deltas and one for the value, mostly.
+    assert len(encoder.bits) < 100 * 2 + 64
+
+
+@pytest.mark.parametrize('dod', [0, 1, -1, 63, -64, 64, 255, -256, 256,
+                                 2047, -2048, 2048, 10 ** 12, -10 ** 12])
+def test_delta_of_delta_buckets(dod):
+    base = 1_600_000_000_000
+    samples = [(base, 1.0), (base + 1000, 2.0),
+               (base + 2000 + dod, 3.0), (base + 3000 + dod, 4.0)]
+    timestamps, values, _ = _roundtrip(samples)
+    assert timestamps == [ts for ts, _ in samples]
+    assert values == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_values_roundtrip_bit_for_bit():
+    rng = random.Random(7)
+    special = [0.0, -0.0, 1.0, -1.0, math.inf, -math.inf, 5e-324,
+               1.7976931348623157e308, 0.1, 230.1, 230.2]
+    vals = special + [rng.uniform(-1e6, 1e6) for _ in range(100)] + \
+        [struct.unpack('<d', struct.pack('<Q', rng.getrandbits(63)))[0]
+         for _ in range(50)]
+    samples = [(i * 10, v) for i, v in enumerate(vals)]
+    _, values, _ = _roundtrip(samples)
+    assert [struct.pack('<d', v) for v in values] == \
+        [struct.pack('<d', v) for v in vals]
+
+
+def test_nan_roundtrips():
+    _, values, _ = _roundtrip([(0, 1.0), (1, math.nan), (2, 1.0)])
+    assert values[0] == 1.0 and math.isnan(values[1]) and values[2] == 1.0
+
+
+def test_header_layout():
+    encoder = BlockEncoder(1000, 2.5)
+    encoder.append(2000, 3.5)
+    data = encoder.to_bytes(sealed=True)
+    assert data[:4] == b'OZWS'
+    header = BlockHeader(data)
+    assert header.is_sealed
+    assert (header.count, header.first_ts, header.last_ts,
+            header.first_value) == (2, 1000, 2000, 2.5)
+    assert header.nbits == len(encoder.bits)
+    assert data[_HEADER.size + (header.nbits + 7) // 8:] == \
+        bytes(BLOCK_SIZE - _HEADER.size - (header.nbits + 7) // 8)
+
+
+def test_bad_magic():
+    with pytest.raises(SegmentException):
+        BlockHeader(bytes(BLOCK_SIZE))
+
+
+def _fill(series: SegmentSeries, count: int, start: int = 0):
+    rng = random.Random(start)
+    samples = [(1_600_000_000_000 + i * 1000 + rng.randint(-50, 50),
+                round(rng.uniform(0, 3000), 1))
+               for i in range(start, start + count)]
+    for ts, v in samples:
+        series.append(ts, v)
+    return samples
+
+
+def test_series_spans_blocks_and_survives_reopening(tmp_path):
+    path = tmp_path / 's.seg'
+    series = SegmentSeries(path)
+    samples = _fill(series, 3000)
+    series.flush()
+    assert path.stat().st_size % BLOCK_SIZE == 0
+    nblocks = path.stat().st_size // BLOCK_SIZE
+    assert nblocks > 1
+    # every block but the one being appended to is sealed.
+    with open(path, 'rb') as f:
+        headers = [BlockHeader(f.read(BLOCK_SIZE)) for _ in range(nblocks)]
+    assert [h.is_sealed for h in headers] == [True] * (nblocks - 1) + [False]
+    assert sum(h.count for h in headers) == len(samples)
+
+    reopened = SegmentSeries(path)
+    more = _fill(reopened, 10, 3000)
+    timestamps, values = reopened.read()
+    assert list(zip(timestamps, values)) == samples + more
+
+
+def test_series_range_read(tmp_path):
+    series = SegmentSeries(tmp_path / 's.seg')
+    samples = _fill(series, 2000)
+    start, end = samples[500][0], samples[1500][0]
+    timestamps, values = series.read(start, end)
+    assert list(zip(timestamps, values)) == samples[500:1501]
+    assert list(series.read(end=samples[0][0] - 1)[0]) == []
+    assert list(series.read(start=samples[-1][0] + 1)[0]) == []
+
+
+def test_torn_block_is_dropped(tmp_path):
+    path = tmp_path / 's.seg'
+    series = SegmentSeries(path)
+    samples = _fill(series, 10)
+    series.flush()
+    with open(path, 'ab') as f:
+        f.write(b'\xff' * 100)
+
+    reopened = SegmentSeries(path)
+    assert path.stat().st_size == BLOCK_SIZE
+    assert list(zip(*reopened.read())) == samples
+
+
+def test_store_keeps_series_apart(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    store.append(2, 'W', 1000, 10.0)
+    store.append(2, 'kWh', 1000, 1.0)
+    store.append(3, 'W', 1000, 20.0)
+    store.flush()
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['2.W.seg', '2.kWh.seg', '3.W.seg']
+    assert list(SegmentStore(str(tmp_path)).read(2, 'W')[1]) == [10.0]
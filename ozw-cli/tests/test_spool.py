@@ -0,0 +1,155 @@
+import json
+
+from spool import Spool, _RECORD, _decode, _encode
+
+
+def _spool(path, **kwargs) -> Spool:
+    kwargs.setdefault('sync_interval', 3600.0)
+    return Spool(str(path), **kwargs)
+
+
+def _fill(spool: Spool, count: int, start: int = 0):
+    for i in range(start, start + count):
+        spool.append(f"node_{i % 3}", 'W', 1000 + i, float(i))
+    spool.sync()
+
+
+def _segments(path):
+    return sorted(path.glob('*.spool'))
+
+
+def test_encode_decode():
+    buf = _encode('node_1', 'kWh', 1234, 1.5) + _encode('n', 'W', -1, 0.0)
+    samples, end = _decode(buf)
+    assert samples == [('node_1', 'kWh', 1234, 1.5), ('n', 'W', -1, 0.0)]
+    assert end == len(buf)
+
+
+def test_decode_stops_at_corrupt_record():
+    good = _encode('a', 'W', 1, 1.0)
+    bad = bytearray(_encode('b', 'W', 2, 2.0))
+    bad[-1] ^= 0xff
+    samples, end = _decode(good + bytes(bad) + _encode('c', 'W', 3, 3.0))
+    assert samples == [('a', 'W', 1, 1.0)]
+    assert end == len(good)
+
+
+def test_decode_limit():
+    buf = b''.join(_encode('a', 'W', i, float(i)) for i in range(5))
+    samples, end = _decode(buf, 0, 2)
+    assert [s[2] for s in samples] == [0, 1]
+    assert _decode(buf, end)[0][0][2] == 2
+
+
+def test_only_synced_samples_are_read(tmp_path):
+    spool = _spool(tmp_path)
+    spool.append('a', 'W', 1, 1.0)
+    assert spool.read(10)[0] == []
+    spool.sync()
+    assert spool.read(10)[0] == [('a', 'W', 1, 1.0)]
+    spool.stop()
+
+
+def test_read_commit(tmp_path):
+    spool = _spool(tmp_path)
+    _fill(spool, 10)
+    samples, position = spool.read(4)
+    assert [s[2] for s in samples] == [1000, 1001, 1002, 1003]
+    # not committed: read again.
+    assert spool.read(4)[0] == samples
+    spool.commit(position)
+    assert spool.get_backlog() == 6
+    samples, position = spool.read(100)
+    assert [s[2] for s in samples] == list(range(1004, 1010))
+    spool.commit(position)
+    assert spool.get_backlog() == 0
+    assert spool.read(100)[0] == []
+    spool.stop()
+
+
+def test_cursor_survives_reopening(tmp_path):
+    spool = _spool(tmp_path)
+    _fill(spool, 10)
+    spool.commit(spool.read(7)[1])
+    spool.stop()
+
+    spool = _spool(tmp_path)
+    assert spool.get_backlog() == 3
+    assert [s[2] for s in spool.read(100)[0]] == [1007, 1008, 1009]
+    spool.stop()
+
+
+def test_bad_cursor_starts_over(tmp_path):
+    spool = _spool(tmp_path)
+    _fill(spool, 5)
+    spool.stop()
+    (tmp_path / 'cursor').write_text(json.dumps([999, 0, 0]))
+
+    spool = _spool(tmp_path)
+    assert len(spool.read(100)[0]) == 5
+    spool.stop()
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    spool = _spool(tmp_path)
+    _fill(spool, 3)
+    spool.stop()
+    segment = _segments(tmp_path)[-1]
+    size = segment.stat().st_size
+    # half a record, as if we crashed while writing it.
+    with open(segment, 'ab') as f:
+        f.write(_encode('torn', 'W', 9, 9.0)[:_RECORD.size + 3])
+
+    spool = _spool(tmp_path)
+    assert spool.truncated == 1
+    assert segment.stat().st_size == size
+    assert [s[0] for s in spool.read(100)[0]] == \
+        ['node_0', 'node_1', 'node_2']
+    # and appending after it works as usual.
+    _fill(spool, 1, 3)
+    assert len(spool.read(100)[0]) == 4
+    spool.stop()
+
+
+def test_segments_roll_over_and_are_deleted_once_read(tmp_path):
+    record = len(_encode('node_0', 'W', 1000, 0.0))
+    spool = _spool(tmp_path, segment_bytes=record * 4)
+    _fill(spool, 10)
+    assert len(_segments(tmp_path)) >= 3
+    samples, position = spool.read(100)
+    assert len(samples) == 10
+    spool.commit(position)
+    assert len(_segments(tmp_path)) == 1
+    spool.stop()
+
+
+def test_cap_drops_oldest(tmp_path):
+    record = len(_encode('node_0', 'W', 1000, 0.0))
+    spool = _spool(tmp_path, segment_bytes=record * 4,
+                   max_bytes=record * 8)
+    _fill(spool, 20)
+    stats = spool.get_stats()
+    assert stats['bytes'] <= record * 8 + record * 4
+    assert stats['dropped'] > 0
+    samples, _ = spool.read(100)
+    # what's left is the newest, in order, and accounted for.
+    assert [s[2] for s in samples] == \
+        list(range(1020 - len(samples), 1020))
+    assert len(samples) + stats['dropped'] == 20
+    assert spool.get_backlog() == len(samples)
+    spool.stop()
+
+
+def test_cap_moves_the_cursor_past_dropped_samples(tmp_path):
+    record = len(_encode('node_0', 'W', 1000, 0.0))
+    spool = _spool(tmp_path, segment_bytes=record * 4,
+                   max_bytes=record * 8)
+    _fill(spool, 4)
+    # read two, but don't get to commit before they're dropped.
+    _, stale = spool.read(2)
+    _fill(spool, 16, 4)
+    spool.commit(stale)
+    samples, _ = spool.read(100)
+    assert samples[-1][2] == 1019
+    assert samples[0][2] > 1001
+    spool.stop()
@@ -0,0 +1,109 @@
+import time
+from array import array
+from bisect import bisect_left
+from typing import Iterator, List, Tuple
+
+
+"""
+A fixed-capacity time series, backed by two flat arrays: one for the
+timestamps (milliseconds since the epoch) and one for the values. Once
+full, the oldest samples get overwritten.
+
+Memory is allocated up front, and never grows: 16 bytes per sample,
+regardless of how many samples we've seen. Appending is O(1); slicing by
+count or by time is O(log n) to find where to start, plus whatever we
+return.
+
+Timestamps are expected to be appended in non-decreasing order, which
+holds as long as there's a single writer using a sane clock.
+"""
+class RingSeries:
+
+    def __init__(self, capacity: int):
+        assert capacity > 0
+        self.capacity = capacity
+        self.timestamps = array('q', [0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        # where the next sample will be written to.
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self) -> Iterator[Tuple[int, float]]:
+        for i in range(self.count):
+            idx = self._index(i)
+            yield self.timestamps[idx], self.values[idx]
+
+    @property
+    def nbytes(self) -> int:
+        return self.timestamps.itemsize * self.capacity + \
+               self.values.itemsize * self.capacity
+
+    def _index(self, i: int) -> int:
+        # position, in the arrays, of the i-th oldest sample.
+        return (self.head - self.count + i) % self.capacity
+
+    def append(self, value: float, timestamp: int = None):
+        if timestamp is None:
+            timestamp = now_ms()
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    @property
+    def last_timestamp(self) -> int:
+        if self.count == 0:
+            return None
+        return self.timestamps[self._index(self.count - 1)]
+
+    @property
+    def last_value(self) -> float:
+        if self.count == 0:
+            return None
+        return self.values[self._index(self.count - 1)]
+
+    """
+        Return the samples from the i-th oldest on, as two arrays
+        (timestamps, values). At most two array slices get copied.
+    """
+    def _from(self, i: int) -> Tuple[array, array]:
+        if i >= self.count:
+            return array('q'), array('d')
+        start = self._index(i)
+        end = self._index(self.count - 1) + 1
+        if start < end:
+            return self.timestamps[start:end], self.values[start:end]
+        return self.timestamps[start:] + self.timestamps[:end], \
+               self.values[start:] + self.values[:end]
+
+    def last(self, n: int) -> Tuple[array, array]:
+        return self._from(max(0, self.count - n))
+
+    def since(self, timestamp: int) -> Tuple[array, array]:
+        # binary search over the logical (oldest first) positions.
+        class _View:
+            def __len__(_):
+                return self.count
+
+            def __getitem__(_, i):
+                return self.timestamps[self._index(i)]
+
+        return self._from(bisect_left(_View(), timestamp))
+
+    def to_arrays(self) -> Tuple[array, array]:
+        return self._from(0)
+
+    def to_list(self) -> List[Tuple[int, float]]:
+        return list(self)
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1000000
@@ -1,58 +1,78 @@
 import logging
+from typing import Optional
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from ..state import State, state
-from ..network import NetworkController, NetworkRunningException, \
-                      NetworkNotReadyException
+from ..network import NetworkController, NetworkException, \
+                      NetworkRunningException, NetworkNotReadyException
+from .jobs import job_accepted
 
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-@router.put('/node/add')
-def add_node():
-    pass
+def _submit(what: str, submit, response: Response, *args):
+    logger.info(f"controller > {what}")
+    try:
+        job = submit(*args)
+    except (NetworkRunningException, NetworkNotReadyException) as e:
+        logger.info(f"unable to {what}: {e}")
+        raise HTTPException(status_code=428, detail=str(e))
+    except NetworkException as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return job_accepted(response, job)
 
 
-@router.put('/node/rm')
-def remove_node():
-    pass
+@router.put('/node/add', status_code=202)
+def add_node(response: Response, secure: bool = False):
+    netctrl = state.get_network_controller()
+    return _submit("add node", netctrl.add_node, response, secure)
 
 
-@router.put('/heal')
-def heal_network():
-    logger.info("controller > heal network")
-    try:
-        netctrl = state.get_network_controller()
-        netctrl.heal()
-    except (NetworkRunningException, NetworkNotReadyException) as e:
-        logger.info("unable to heal network: "+str(e))
-        raise HTTPException(status_code=428, detail=str(e))
-    pass
+@router.put('/node/rm', status_code=202)
+def remove_node(response: Response):
+    netctrl = state.get_network_controller()
+    return _submit("remove node", netctrl.remove_node, response)
 
 
-@router.put('/neighbors/update')
-def update_neighbors():
-    logger.info("controller > update neighbors")
-    pass
+@router.put('/heal', status_code=202)
+def heal_network(response: Response):
+    netctrl = state.get_network_controller()
+    return _submit("heal network", netctrl.heal, response)
 
 
-@router.put('/refresh')
-def refresh_information():
-    logger.info("controller > refresh informations")
-    pass
+@router.put('/neighbors/update', status_code=202)
+def update_neighbors(response: Response, node_id: Optional[int] = None):
+    netctrl = state.get_network_controller()
+    return _submit("update neighbors", netctrl.update_neighbors, response,
+                   node_id)
 
 
-def _get_neighbors(node_id=None):
-    logger.info(f"controller > get neighbors, node: {node_id}")
-    pass
+@router.put('/refresh', status_code=202)
+def refresh_information(response: Response, node_id: Optional[int] = None):
+    netctrl = state.get_network_controller()
+    return _submit("refresh informations", netctrl.refresh, response,
+                   node_id)
+
+
+def _get_neighbor_graph():
+    netctrl = state.get_network_controller()
+    try:
+        return netctrl.get_neighbor_graph()
+    except (NetworkRunningException, NetworkNotReadyException) as e:
+        raise HTTPException(status_code=428, detail=str(e))
 
 
 @router.get('/neighbors')
 def get_neighbors():
-    return _get_neighbors()
+    graph = _get_neighbor_graph()
+    return Response(content=graph.encoded, media_type='application/json')
 
 
 @router.get('/neighbors/{node_id}')
-def get_node_neighbors(node_id: int = None):
-    return _get_neighbors(node_id)
\ No newline at end of file
+def get_node_neighbors(node_id: int):
+    graph = _get_neighbor_graph()
+    if not graph.has_node(node_id):
+        raise HTTPException(status_code=404,
+                            detail=f"node {node_id} not found")
+    return graph.node_to_dict(node_id)
@@ -0,0 +1,36 @@
+import logging
+from fastapi import APIRouter, HTTPException, Query, Response
+
+from .. import timing
+from ..profiler import ProfilerBusyException, SamplingProfiler, profiler
+
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+@router.get('/stats')
+def get_stats():
+    return timing.get_stats()
+
+
+@router.delete('/stats')
+def reset_stats():
+    timing.reset()
+    return True
+
+
+"""
+    Profile everything for 'seconds', and answer with collapsed stacks.
+    Takes as long as asked for; one at a time.
+"""
+@router.post('/profile')
+def profile(seconds: float = Query(5.0, gt=0, le=60),
+            interval_ms: float = Query(5.0, ge=1, le=1000)):
+    try:
+        stacks = profiler.run(seconds, interval_ms / 1000)
+    except ProfilerBusyException as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(content=SamplingProfiler.collapse(stacks),
+                    media_type='text/plain')
@@ -0,0 +1,47 @@
+import logging
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from ..energy import PERIODS
+from ..state import State, state
+
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+"""
+    This hour's, day's and month's consumption (kWh), in all and per node,
+    along with each node's channels' power, counter and how well behaved
+    they've been.
+"""
+@router.get('/')
+def get_energy():
+    return state.energy.get_summary()
+
+
+"""
+    'network''s consumption per 'period'. Shared with the routes serving
+    more than one network.
+"""
+def energy_totals_response(network: State, period: str,
+                           node_id: Optional[int] = None,
+                           last: Optional[int] = None):
+    if period not in PERIODS:
+        raise HTTPException(status_code=404,
+                            detail=f"unknown period '{period}'")
+    if node_id is not None and not network.energy.get_meter(node_id):
+        raise HTTPException(status_code=404,
+                            detail=f"no energy readings for node {node_id}")
+    return network.energy.get_totals(period, node_id, last)
+
+
+"""
+    Consumption (kWh) per 'period' ('hour', 'day' or 'month'), in all or
+    for 'node_id'; only the 'last' so many, if asked.
+"""
+@router.get('/{period}')
+def get_energy_totals(period: str, node_id: Optional[int] = None,
+                      last: Optional[int] = Query(None, ge=1)):
+    return energy_totals_response(state, period, node_id, last)
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from typing import List
+
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import StreamingResponse
+
+from ..state import state
+from ..stream import Subscriber, format_sse
+
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# how often we poke idle clients, so proxies don't cut them off.
+KEEPALIVE_SECS = 15.0
+# most events we hold for a slow client; past that, the oldest go.
+MAX_BUFFER = 4096
+
+
+@router.get('')
+async def get_events(request: Request,
+                     node: List[int] = Query(None),
+                     unit: List[str] = Query(None),
+                     buffer: int = Query(256, ge=1, le=MAX_BUFFER)):
+    logger.info(f"events > subscribe, nodes: {node}, units: {unit}")
+
+    sub = Subscriber(asyncio.get_running_loop(),
+                     nodes=set(node) if node else None,
+                     units=set(unit) if unit else None,
+                     max_pending=buffer)
+    state.stream.subscribe(sub)
+
+    async def _stream():
+        try:
+            yield ": connected\n\n"
+            while not await request.is_disconnected():
+                events = await sub.get(KEEPALIVE_SECS)
+                if not events:
+                    yield ": keepalive\n\n"
+                    continue
+                if sub.dropped:
+                    yield format_sse({'type': 'dropped',
+                                      'count': sub.dropped})
+                    sub.dropped = 0
+                for event in events:
+                    yield format_sse(event)
+        finally:
+            logger.info("events > unsubscribe")
+            state.stream.unsubscribe(sub)
+
+    return StreamingResponse(_stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
@@ -0,0 +1,42 @@
+import logging
+
+from fastapi import APIRouter, HTTPException, Response
+from ..jobs import Job
+from ..networks import networks
+
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+
+"""
+    For the routes kicking jobs off: answer with 202, pointing at where
+    the job can be checked on.
+"""
+def job_accepted(response: Response, job: Job):
+    response.headers['Location'] = f"/api/jobs/{job.id}"
+    return job.to_dict()
+
+
+# job ids are unique across networks; any job may be asked for here,
+# whichever network it's on.
+
+@router.get('/')
+def get_jobs():
+    return [job.to_dict() for job in networks.get_jobs()]
+
+
+@router.get('/{job_id}')
+def get_job(job_id: int):
+    job = networks.find_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job.to_dict()
+
+
+@router.delete('/{job_id}')
+def cancel_job(job_id: int):
+    job = networks.cancel_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job.to_dict()
@@ -0,0 +1,19 @@
+import logging
+from fastapi import APIRouter, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+from ..state import state
+from ..metrics import create_registry
+
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+registry = create_registry(state.snapshot)
+
+
+@router.get('')
+def get_metrics():
+    return Response(content=generate_latest(registry),
+                    media_type=CONTENT_TYPE_LATEST)
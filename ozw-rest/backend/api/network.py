@@ -1,8 +1,9 @@
 import logging
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from ..state import State, state
 from ..network import NetworkController, NetworkRunningException, \
                       DeviceNotSetException, TryAgainLaterException
+from .jobs import job_accepted
                       
 
 logger = logging.getLogger(__name__)
@@ -14,19 +15,14 @@ network_ctrl: NetworkController = state.get_network_controller()
 @router.get('/status')
 def get_network_status():
     assert network_ctrl
-    server_state = {
-        'is_running': network_ctrl.is_server_running(),
-        'is_starting': network_ctrl.is_server_starting(),
-        'is_stopping': network_ctrl.is_server_stopping(),
-        'device': network_ctrl.get_device()
-    }
-    network_state = network_ctrl.get_network_state().to_dict()
-    return {
-        'server': server_state,
-        'network': network_state
-    }
+    return network_ctrl.get_status()
     
 
+@router.get('/ingest')
+def get_network_ingest():
+    return state.get_ingest_stats()
+
+
 @router.get('/device')
 def get_network_device():
     assert network_ctrl
@@ -50,27 +46,27 @@ def put_network_device(device: str):
     return True
 
 
-@router.put('/start')
-def network_start():
+@router.put('/start', status_code=202)
+def network_start(response: Response):
     logger.info("starting network...")
     assert network_ctrl
     try:
-        network_ctrl.start()
+        job = network_ctrl.start()
     except DeviceNotSetException:
         raise HTTPException(status_code=428, detail="network device not set")
     except NetworkRunningException:
         # be idempotent. it's running, so we achieved our purposes!
-        pass
+        response.status_code = 200
+        return True
     except TryAgainLaterException as e:
-        raise HTTPException(status=503, detail=str(e))
-    return True
+        raise HTTPException(status_code=503, detail=str(e))
+    return job_accepted(response, job)
 
-@router.put('/stop')
-def network_stop():
+@router.put('/stop', status_code=202)
+def network_stop(response: Response):
     logger.info("stopping network...")
     # we'll always succeed because
     #   1) if it was running it will be stopped; and
     #   2) if it was not running we achieved our purpose.
     assert network_ctrl
-    network_ctrl.stop()
-    return True
\ No newline at end of file
+    return job_accepted(response, network_ctrl.stop())
\ No newline at end of file
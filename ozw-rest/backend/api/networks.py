@@ -0,0 +1,160 @@
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from ..encoding import join_dict, join_list
+from ..network import DeviceNotSetException, NetworkRunningException, \
+                      NetworkNotReadyException, TryAgainLaterException
+from ..networks import networks, node_key, parse_node_key, \
+                       UnknownNetworkException
+from ..state import State
+from .energy import energy_totals_response
+from .jobs import job_accepted
+from .nodes import _check_readable, _json_response, node_history_response, \
+                   node_values_response
+
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+def _get_network(key: str) -> State:
+    try:
+        return networks.get(key)
+    except UnknownNetworkException as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+"""
+    Say which networks had nothing to give, if any did; if none had
+    anything, there's nothing to serve.
+"""
+def _check_errors(response: Response, results: Dict, errors: Dict):
+    if not errors:
+        return
+    for key, e in errors.items():
+        if not isinstance(e, (NetworkRunningException,
+                              NetworkNotReadyException)):
+            logger.error(f"network {key}: {e}")
+    if not results:
+        raise HTTPException(status_code=428, detail="no network available")
+    response.headers['X-Networks-Unavailable'] = ','.join(errors.keys())
+
+
+@router.get('/')
+def get_networks():
+    results, _ = networks.fan_out(
+        lambda network: network.get_network_controller().get_status())
+    return results
+
+
+"""
+    Every network's nodes, as '/api/nodes' has them, keyed by
+    '<network>:<node id>'.
+"""
+@router.get('/nodes')
+def get_networks_nodes(response: Response):
+    def get_nodes(network: State) -> Tuple[bool, Dict[str, bytes]]:
+        is_stale = network.check_readable()
+        return is_stale, \
+            {node_key(network, snap.info.node_id): snap.get_info_bytes()
+             for snap in network.snapshot.query_nodes([])}
+
+    results, errors = networks.fan_out(get_nodes)
+    _check_errors(response, results, errors)
+    merged = {}
+    for is_stale, nodes in results.values():
+        if is_stale:
+            response.headers['X-Snapshot-Stale'] = 'true'
+        merged.update(nodes)
+    return _json_response(response, join_dict(merged))
+
+
+@router.get('/nodes/{key}/values')
+def get_networks_node_values(request: Request, response: Response,
+                             key: str, scope: Optional[str] = None,
+                             units: Optional[str] = None,
+                             command_class: Optional[int] = None):
+    try:
+        network_key, node_id = parse_node_key(key)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return node_values_response(_get_network(network_key), request,
+                                response, node_id, scope, units,
+                                command_class)
+
+
+@router.get('/ingest')
+def get_networks_ingest():
+    results, _ = networks.fan_out(
+        lambda network: network.get_ingest_stats())
+    return results
+
+
+@router.get('/{key}')
+def get_network(key: str):
+    return _get_network(key).get_network_controller().get_status()
+
+
+@router.get('/{key}/nodes')
+def get_network_nodes(response: Response, key: str):
+    network = _get_network(key)
+    _check_readable(response, network)
+    return _json_response(
+        response, join_list(network.snapshot.get_nodes_simple_bytes()))
+
+
+@router.get('/{key}/nodes/{node_id}/history')
+def get_network_node_history(response: Response, key: str, node_id: int,
+                             unit: str,
+                             start: Optional[datetime] = Query(None,
+                                                               alias='from'),
+                             end: Optional[datetime] = Query(None,
+                                                             alias='to'),
+                             step: Optional[str] = None,
+                             instance: Optional[int] = Query(None, ge=1)):
+    return node_history_response(_get_network(key), response, node_id, unit,
+                                 start, end, step, instance)
+
+
+@router.get('/{key}/energy')
+def get_network_energy(key: str):
+    return _get_network(key).energy.get_summary()
+
+
+@router.get('/{key}/energy/{period}')
+def get_network_energy_totals(key: str, period: str,
+                              node_id: Optional[int] = None,
+                              last: Optional[int] = Query(None, ge=1)):
+    return energy_totals_response(_get_network(key), period, node_id, last)
+
+
+@router.get('/{key}/jobs')
+def get_network_jobs(key: str):
+    netctrl = _get_network(key).get_network_controller()
+    return [job.to_dict() for job in netctrl.get_jobs()]
+
+
+@router.put('/{key}/start', status_code=202)
+def network_start(response: Response, key: str):
+    netctrl = _get_network(key).get_network_controller()
+    logger.info(f"starting network {key}...")
+    try:
+        job = netctrl.start()
+    except DeviceNotSetException:
+        raise HTTPException(status_code=428, detail="network device not set")
+    except NetworkRunningException:
+        response.status_code = 200
+        return True
+    except TryAgainLaterException as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return job_accepted(response, job)
+
+
+@router.put('/{key}/stop', status_code=202)
+def network_stop(response: Response, key: str):
+    netctrl = _get_network(key).get_network_controller()
+    logger.info(f"stopping network {key}...")
+    return job_accepted(response, netctrl.stop())
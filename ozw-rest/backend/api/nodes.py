@@ -1,6 +1,14 @@
+import base64
+import json
 import logging
-from fastapi import APIRouter, HTTPException
-from ..state import State, state
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from ..encoding import encode, join_list
+from ..history import HistoryException, parse_step
+from ..snapshot import NodeSnapshot, SnapshotStore
+from ..state import State, state, UnknownFieldException
 from ..network import NetworkRunningException, NetworkNotReadyException
 
 logger = logging.getLogger(__name__)
@@ -8,92 +16,346 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-@router.get('/')
-def get_nodes(all: bool = False):
+"""
+    Set the response's ETag, and tell whether the client already has what
+    it identifies. Tags are built from the snapshot's generation counters,
+    which only change when something does.
+"""
+def _check_etag(request: Request, response: Response, etag: str) -> bool:
+    response.headers['ETag'] = etag
+    wanted = request.headers.get('if-none-match')
+    if not wanted:
+        return False
+    return wanted.strip() == '*' or \
+        etag in [t.strip() for t in wanted.split(',')]
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={'ETag': etag})
+
+
+"""
+    Send already-encoded json as is, along with whatever headers were set
+    on 'response'.
+"""
+def _json_response(response: Response, content: bytes) -> Response:
+    res = Response(content=content, media_type='application/json')
+    for k, v in response.headers.items():
+        if k != 'content-length':
+            res.headers[k] = v
+    return res
+
+
+"""
+    Raise if there's nothing to serve. If what we'd serve is what we
+    remember rather than what we've seen, say so.
+"""
+def _check_readable(response: Response, network: State = state):
     try:
-        if all:
-            return state.get_nodes_dict()
-        nodes = state.get_nodes_simple()
+        is_stale = network.check_readable()
     except (NetworkRunningException, NetworkNotReadyException) as e:
         raise HTTPException(status_code=428, detail=str(e))
+    if is_stale:
+        response.headers['X-Snapshot-Stale'] = 'true'
 
-    logger.info("get nodes: {}".format(nodes))
-    return nodes
 
-@router.get('/roles')
-def get_nodes_roles():
+def _encode_cursor(sort: str, order: str, key: Tuple[Any, int]) -> str:
+    raw = json.dumps([sort, order, key[0], key[1]]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def _decode_cursor(cursor: str, sort: str, order: str) -> Tuple[Any, int]:
     try:
-        nodes = state.get_nodes()
-    except (NetworkRunningException, NetworkNotReadyException) as e:
-        raise HTTPException(status_code=428, detail=str(e))
-    
-    logger.info("get node roles: nodes = {}".format(nodes))
-    roles = {}
-    for n in nodes.values():
-        roles[n.node_id] = n.role
+        c_sort, c_order, key, node_id = \
+            json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="bad cursor")
+    if c_sort != sort or c_order != order:
+        raise HTTPException(status_code=400,
+                            detail="cursor is for a different sort order")
+    # keys are compared against the nodes' own, as SnapshotStore.sort_key
+    # makes them: ints sorting by id, strings otherwise.
+    key_type = int if sort == 'id' else str
+    if not all(type(k) is t for k, t in [(key, key_type), (node_id, int)]):
+        raise HTTPException(status_code=400, detail="bad cursor")
+    return (key, node_id)
 
-    return roles
 
-@router.get('/types')
-def get_nodes_types():
+"""
+    Filter, sort and page through the nodes, as told by the query's
+    parameters:
+
+      state, type, product, role: only nodes with these;
+      capabilities: comma-separated flags nodes must all have, with or
+        without their 'is_' prefix (e.g., 'routing,listening');
+      sort: one of SnapshotStore.SORT_KEYS; order: 'asc' or 'desc';
+      limit: at most this many nodes; if there might be more, the
+        X-Next-Cursor header says how to ask for them, via 'cursor'.
+
+    Filtering goes through the snapshot's indexes, never over every node.
+"""
+def _query_nodes(response: Response,
+                 node_state: Optional[str], node_type: Optional[str],
+                 product: Optional[str], role: Optional[str],
+                 capabilities: Optional[str], sort: str, order: str,
+                 cursor: Optional[str], limit: Optional[int]
+                 ) -> List[NodeSnapshot]:
+    if sort not in SnapshotStore.SORT_KEYS:
+        raise HTTPException(status_code=400,
+                            detail=f"can't sort by '{sort}'")
+    if order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400,
+                            detail=f"unknown order '{order}'")
+
+    filters = [(name, key) for name, key in [('state', node_state),
+                                             ('type', node_type),
+                                             ('product', product),
+                                             ('role', role)]
+               if key is not None]
+    if capabilities:
+        for cap in capabilities.split(','):
+            cap = cap.strip()
+            if cap:
+                filters.append(('capability',
+                                cap if cap.startswith('is_') else 'is_' + cap))
+
+    after = _decode_cursor(cursor, sort, order) if cursor else None
+    _check_readable(response)
+    # one more than asked for, to know whether there's a next page.
+    snaps = state.query_nodes(filters, sort, order == 'desc', after,
+                              limit + 1 if limit else None)
+    if limit and len(snaps) > limit:
+        snaps = snaps[:limit]
+        response.headers['X-Next-Cursor'] = _encode_cursor(
+            sort, order, SnapshotStore.sort_key(snaps[-1].info, sort))
+    return snaps
+
+
+"""
+    The tag for a query's answer, known before running it: the same query
+    over the same nodes gets the same answer. Checked first, so a client
+    that already has it costs us no query.
+"""
+def _query_etag(request: Request, what: str) -> str:
+    return '"{}-{}-{:08x}"'.format(
+        what, state.snapshot.info_generation,
+        zlib.crc32(str(request.url.query).encode()))
+
+
+@router.get('/')
+def get_nodes(request: Request, response: Response, all: bool = False,
+              fields: Optional[str] = None,
+              node_state: Optional[str] = Query(None, alias='state'),
+              node_type: Optional[str] = Query(None, alias='type'),
+              product: Optional[str] = None,
+              role: Optional[str] = None,
+              capabilities: Optional[str] = None,
+              sort: Optional[str] = None,
+              order: str = 'asc',
+              cursor: Optional[str] = None,
+              limit: Optional[int] = Query(None, ge=1)):
+    is_query = not all and fields is None and \
+        any(p is not None for p in [node_state, node_type, product, role,
+                                    capabilities, sort, cursor, limit])
+    if is_query:
+        etag = _query_etag(request, 'nodes-query')
+        if _check_etag(request, response, etag):
+            return _not_modified(etag)
+        snaps = _query_nodes(response, node_state, node_type, product,
+                             role, capabilities, sort if sort else 'id',
+                             order, cursor, limit)
+        return _json_response(
+            response, join_list(snap.get_info_bytes() for snap in snaps))
+
+    # 'fields' is a comma-separated list of what to get for each node,
+    # implying 'all'; the rest is neither read nor sent.
+    wanted = None
+    if fields is not None:
+        wanted = [f.strip() for f in fields.split(',') if f.strip()]
+        all = True
+
     try:
-        nodes = state.get_nodes()
+        if all:
+            state.get_network_controller().check_available()
+        else:
+            _check_readable(response)
+        if all:
+            etag = '"nodes-all-{}-{}"'.format(
+                state.snapshot.generation,
+                ','.join(wanted) if wanted is not None else '')
+        else:
+            # values don't show up in here; their changes don't matter.
+            etag = '"nodes-simple-{}"'.format(
+                state.snapshot.info_generation)
+        if _check_etag(request, response, etag):
+            return _not_modified(etag)
+
+        if all:
+            content = state.get_nodes_dict_bytes(wanted)
+        else:
+            content = state.get_nodes_simple_bytes()
     except (NetworkRunningException, NetworkNotReadyException) as e:
         raise HTTPException(status_code=428, detail=str(e))
-    logger.info("get node types: nodes = {}".format(nodes))
-    types = {}
-    for n in nodes.values():
-        types[n.node_id] = n.type
-    return types
+    except UnknownFieldException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    logger.info("get nodes: {} bytes".format(len(content)))
+    return _json_response(response, content)
+
+@router.get('/roles')
+def get_nodes_roles(request: Request, response: Response,
+                    node_state: Optional[str] = Query(None, alias='state'),
+                    node_type: Optional[str] = Query(None, alias='type'),
+                    product: Optional[str] = None,
+                    role: Optional[str] = None,
+                    capabilities: Optional[str] = None,
+                    sort: str = 'id', order: str = 'asc',
+                    cursor: Optional[str] = None,
+                    limit: Optional[int] = Query(None, ge=1)):
+    etag = _query_etag(request, 'nodes-roles')
+    if _check_etag(request, response, etag):
+        return _not_modified(etag)
+    snaps = _query_nodes(response, node_state, node_type, product, role,
+                         capabilities, sort, order, cursor, limit)
+    return {snap.info.node_id: getattr(snap.info, 'role', None)
+            for snap in snaps}
+
+@router.get('/types')
+def get_nodes_types(request: Request, response: Response,
+                    node_state: Optional[str] = Query(None, alias='state'),
+                    node_type: Optional[str] = Query(None, alias='type'),
+                    product: Optional[str] = None,
+                    role: Optional[str] = None,
+                    capabilities: Optional[str] = None,
+                    sort: str = 'id', order: str = 'asc',
+                    cursor: Optional[str] = None,
+                    limit: Optional[int] = Query(None, ge=1)):
+    etag = _query_etag(request, 'nodes-types')
+    if _check_etag(request, response, etag):
+        return _not_modified(etag)
+    snaps = _query_nodes(response, node_state, node_type, product, role,
+                         capabilities, sort, order, cursor, limit)
+    return {snap.info.node_id: snap.info.node_type for snap in snaps}
 
 @router.get('/{node_id}/scope/{scope}')
-def get_node_scope(node_id: int, scope: str):
+def get_node_scope(request: Request, response: Response,
+                   node_id: int, scope: str):
     logger.info("get scope '{}' for node id = {}".format(
         scope, node_id
     ))
 
-    return get_node_values(node_id, scope)
+    return get_node_values(request, response, node_id, scope)
  
 
 @router.get('/{node_id}/values')
-def get_node_values(node_id: int, scope: str = None):
+def get_node_values(request: Request, response: Response,
+                    node_id: int, scope: Optional[str] = None,
+                    units: Optional[str] = None,
+                    command_class: Optional[int] = None):
     logger.info(f"get values for node id = {node_id} (scope: {scope})")
+    return node_values_response(state, request, response, node_id, scope,
+                                units, command_class)
 
-    # we are skipping openzwave's lib's get_values() function because
-    # it kept returning a whole bunch of nothing for whatever genre we
-    # tried. Thus, we're grabbing the values outselves.
-
-    try:
-        nodes = state.get_nodes()
-    except (NetworkRunningException, NetworkNotReadyException) as e:
-        raise HTTPException(status_code=428, detail=str(e))
-    if node_id not in nodes:
-        raise HTTPException(status_code=404, detail="node not found")
-
-    node = nodes[node_id]
-    all_values = node.get_values()
 
+"""
+    A node's values, off 'network''s snapshot. Shared with the routes
+    serving more than one network.
+"""
+def node_values_response(network: State, request: Request,
+                         response: Response, node_id: int,
+                         scope: Optional[str] = None,
+                         units: Optional[str] = None,
+                         command_class: Optional[int] = None):
     genres = ['user', 'config', 'system']
     wanted = scope.lower() if scope else None
     if wanted and wanted not in genres:
         # these also happen to be the ones we're supporting ;)
         raise HTTPException(status_code=404, detail="scope not found")
 
-    values = []
-    value: ZWaveValue
-    for value in all_values.values():
-        if wanted and value.genre.lower() != wanted:
-            continue
-
-        # we are not interested in all the k/v in the dictionary.
-        # let's parse out what we need.
-        value_raw = value.to_dict(extras=[])
-        value_proper = {
-            'label': str(value_raw.get('label', '')),
-            'units': str(value_raw.get('units', '')),
-            'data':  str(value_raw.get('data', '')),
-            'genre': str(value_raw.get('genre', '')).lower()
-        }
-        values.append(value_proper)
-
-    return values
\ No newline at end of file
+    _check_readable(response, network)
+
+    generation = network.snapshot.get_generation(node_id)
+    if generation is None:
+        raise HTTPException(status_code=404, detail="node not found")
+
+    etag = '"node-{}-{}-{}-{}-{}-{}"'.format(
+        network.get_key(), node_id, generation, wanted if wanted else 'all',
+        units if units is not None else '',
+        command_class if command_class is not None else '')
+    if _check_etag(request, response, etag):
+        return _not_modified(etag)
+
+    # values come from the node's snapshot, indexed by genre, units and
+    # command class; libopenzwave is not involved.
+    found = network.snapshot.find_values(
+        node_id, genre=wanted, units=units, command_class=command_class)
+    if found is None:
+        raise HTTPException(status_code=404, detail="node not found")
+
+    return _json_response(
+        response, join_list(vsnap.to_api_bytes() for vsnap in found))
+
+
+def _ms(d: datetime) -> int:
+    # naive means UTC, as everything else we serve.
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=timezone.utc)
+    return int(d.timestamp() * 1000)
+
+
+"""
+    Past readings of a node's values in 'unit', bucketed by 'step' (as in
+    '30s', '15m', '1h'), from 'from' to 'to' (ISO 8601, or seconds since
+    the epoch). Defaults to the last day, at whatever step gives a
+    reasonable number of buckets. Nodes with more than one channel in
+    'unit' need to be told which, by 'instance'.
+"""
+@router.get('/{node_id}/history')
+def get_node_history(response: Response, node_id: int, unit: str,
+                     start: Optional[datetime] = Query(None, alias='from'),
+                     end: Optional[datetime] = Query(None, alias='to'),
+                     step: Optional[str] = None,
+                     instance: Optional[int] = Query(None, ge=1)):
+    return node_history_response(state, response, node_id, unit, start, end,
+                                 step, instance)
+
+
+"""
+    A node's history, off 'network''s. Shared with the routes serving
+    more than one network.
+"""
+def node_history_response(network: State, response: Response, node_id: int,
+                          unit: str, start: Optional[datetime] = None,
+                          end: Optional[datetime] = None,
+                          step: Optional[str] = None,
+                          instance: Optional[int] = None):
+    instances = network.history.get_instances(node_id, unit)
+    if not instances:
+        units = network.history.get_units(node_id)
+        raise HTTPException(
+            status_code=404,
+            detail=f"no history for node {node_id} in '{unit}'; "
+                   f"there is for: {units}")
+    if instance is None:
+        if len(instances) > 1:
+            raise HTTPException(
+                status_code=400,
+                detail=f"node {node_id} has '{unit}' on instances "
+                       f"{instances}; which one?")
+        instance = instances[0]
+    elif instance not in instances:
+        raise HTTPException(
+            status_code=404,
+            detail=f"no history for node {node_id} in '{unit}' on instance "
+                   f"{instance}; there is for: {instances}")
+    if end is None:
+        end = datetime.now(timezone.utc)
+    if start is None:
+        start = end - timedelta(days=1)
+    try:
+        res = network.history.query(node_id, unit, _ms(start), _ms(end),
+                                    parse_step(step) if step else None,
+                                    instance)
+    except HistoryException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _json_response(response, encode(res))
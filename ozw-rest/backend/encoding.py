@@ -0,0 +1,51 @@
+import json
+from datetime import datetime as dt
+from typing import Any, Dict, Iterable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+"""
+JSON encoding for what we serve, to bytes, so it can be kept around and
+put together with other already-encoded bits rather than encoded again.
+
+We use orjson if it's around, and fall back to the standard library's
+json otherwise. Either way, sets go out as lists and objects we know
+nothing about as their attributes, as fastapi would have had it.
+"""
+
+
+def _default(obj: Any):
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, dt):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return obj.decode(errors='replace')
+    if hasattr(obj, '__dict__'):
+        return vars(obj)
+    raise TypeError(f"can't encode {type(obj).__name__}")
+
+
+def encode(obj: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default,
+                      separators=(',', ':')).encode()
+
+
+def join_list(fragments: Iterable[bytes]) -> bytes:
+    return b'[' + b','.join(fragments) + b']'
+
+
+"""
+    An object out of already-encoded values. Keys are encoded here; there
+    are never that many of them.
+"""
+def join_dict(fragments: Dict[Any, bytes]) -> bytes:
+    return b'{' + b','.join(
+        encode(str(k)) + b':' + v for k, v in fragments.items()) + b'}'
@@ -0,0 +1,480 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Energy accounting, as readings come in: per node, and for all of them,
+how much was consumed each hour, day and month.
+
+Meters report a cumulative kWh counter, and most also report power (W).
+Consumption is taken from the counter whenever a node has one: the delta
+between two readings is what was consumed in between, and the delta over
+the time between them is the average power. Counters aren't as well
+behaved as we'd like, though:
+
+  * a counter going down a little is jitter, and is ignored;
+  * a counter going from close to a power of ten to close to zero has
+    wrapped around, and what was consumed is what it took to get to the
+    wrap point, plus whatever it's at now;
+  * a counter otherwise going down has been reset (by whoever, for
+    whatever reason), and starts again from zero;
+  * a counter going up by more than a plausible power would allow is a
+    glitch; it's taken as the new baseline, and not accounted for;
+  * a reading older than the last one came in out of order, and is
+    dropped; rebasing on it would count again what's been counted.
+
+Nodes without a counter have their power integrated over time instead.
+
+Meters with more than one channel (clamps, outlets) report each on its
+own instance; each channel is accounted for on its own, as their readings
+interleave, and a node's consumption is that of its channels added up.
+
+Each reading costs O(1): totals are kept per period, and are only ever
+added to. A delta spanning more than one hour is spread over the hours
+it spans, pro rata -- which costs one step per hour, but only happens
+after a node's been quiet for a while. A delta spanning more than we
+keep days for can't be placed with any confidence, and is counted as
+unattributed instead. Periods are in local time; hours kept for 31 days,
+days for 400, months forever.
+"""
+
+
+HOUR_MS = 3_600_000
+# longest a delta may span and still be spread over the hours it spans.
+MAX_SPREAD_MS = 400 * 24 * HOUR_MS
+
+PERIOD_HOUR = 'hour'
+PERIOD_DAY = 'day'
+PERIOD_MONTH = 'month'
+PERIODS = [PERIOD_HOUR, PERIOD_DAY, PERIOD_MONTH]
+
+UNIT_ENERGY = 'kWh'
+UNIT_POWER = 'W'
+
+
+"""
+    The hour, day and month an hour starting at 'hour_start' (ms) falls
+    in, in local time.
+"""
+def _period_keys(hour_start: int) -> Tuple[str, str, str]:
+    t = time.localtime(hour_start / 1000)
+    return (time.strftime('%Y-%m-%dT%H', t),
+            time.strftime('%Y-%m-%d', t),
+            time.strftime('%Y-%m', t))
+
+
+class Totals:
+
+    # how many of each period we keep; None for all of them.
+    retention: Dict[str, Optional[int]] = {
+        PERIOD_HOUR: 31 * 24,
+        PERIOD_DAY: 400,
+        PERIOD_MONTH: None,
+    }
+
+    def __init__(self):
+        self.periods: Dict[str, Dict[str, float]] = \
+            {period: OrderedDict() for period in PERIODS}
+        # the hour we last added to, and its keys; saves working out the
+        # keys for every reading.
+        self.hour_start: Optional[int] = None
+        self.keys: Tuple[str, str, str] = None
+
+    def _keys(self, hour_start: int) -> Tuple[str, str, str]:
+        if hour_start != self.hour_start:
+            self.hour_start = hour_start
+            self.keys = _period_keys(hour_start)
+        return self.keys
+
+    def add(self, hour_start: int, kwh: float):
+        for period, key in zip(PERIODS, self._keys(hour_start)):
+            totals = self.periods[period]
+            if key in totals:
+                totals[key] += kwh
+                continue
+            is_older = bool(totals) and key < next(reversed(totals))
+            totals[key] = kwh
+            if is_older:
+                # spread back in time, past newer ones; keep them in
+                # order, oldest first, so the oldest goes first.
+                totals = self.periods[period] = \
+                    OrderedDict(sorted(totals.items()))
+            limit = self.retention[period]
+            if limit is not None and len(totals) > limit:
+                totals.popitem(last=False)
+
+    """
+        Add shares of many periods at once, as in {period: {key: kWh}};
+        for spreading over a long span, where adding hour by hour would
+        have us sorting over and over.
+    """
+    def merge(self, shares: Dict[str, Dict[str, float]]):
+        for period in PERIODS:
+            added = shares.get(period)
+            if not added:
+                continue
+            totals = self.periods[period]
+            newest = next(reversed(totals)) if totals else None
+            for key, kwh in added.items():
+                totals[key] = totals.get(key, 0.0) + kwh
+            if newest is not None and min(added) < newest:
+                totals = self.periods[period] = \
+                    OrderedDict(sorted(totals.items()))
+            limit = self.retention[period]
+            while limit is not None and len(totals) > limit:
+                totals.popitem(last=False)
+
+    def get(self, period: str, last: Optional[int] = None
+            ) -> Dict[str, float]:
+        items = list(self.periods[period].items())
+        if last is not None:
+            items = items[-last:]
+        return dict(items)
+
+    """
+        This hour's, day's and month's, so far.
+    """
+    def current(self) -> Dict[str, float]:
+        now = int(time.time() * 1000)
+        keys = self._keys(now - now % HOUR_MS)
+        return {period: self.periods[period].get(key, 0.0)
+                for period, key in zip(PERIODS, keys)}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {period: dict(totals)
+                for period, totals in self.periods.items()}
+
+    def load(self, d: Dict[str, Any]):
+        for period in PERIODS:
+            self.periods[period] = OrderedDict(sorted(
+                d.get(period, {}).items()))
+
+
+"""
+    Spread 'kwh', consumed between 'start' and 'end' (ms), over the hours
+    in between, adding to every one of 'totals'.
+"""
+def _spread(totals: List[Totals], start: int, end: int, kwh: float):
+    hour = end - end % HOUR_MS
+    if start >= hour:
+        # all in the one hour.
+        for t in totals:
+            t.add(hour, kwh)
+        return
+    shares: Dict[str, Dict[str, float]] = {period: {} for period in PERIODS}
+    span = end - start
+    at = start
+    while at < end:
+        hour = at - at % HOUR_MS
+        until = min(end, hour + HOUR_MS)
+        share = kwh * (until - at) / span
+        for period, key in zip(PERIODS, _period_keys(hour)):
+            shares[period][key] = shares[period].get(key, 0.0) + share
+        at = until
+    for t in totals:
+        t.merge(shares)
+
+
+"""
+One channel of a node's meter: the readings of one instance.
+"""
+class ChannelMeter:
+
+    # below this, a counter going down is jitter (kWh).
+    jitter = 0.01
+    # above this, a counter going up is a glitch (W, on average) -- as
+    # long as it went up by more than 'glitch_min' (kWh), as readings
+    # close together make for silly averages.
+    max_power = 50_000.0
+    glitch_min = 1.0
+    # how close to a power of ten a counter must be, before dropping to
+    # close to zero, for us to take it as having wrapped around.
+    wrap_margin = 0.1
+
+    def __init__(self, node_id: int, instance: int = 1):
+        self.node_id = node_id
+        self.instance = instance
+        # last counter reading, and when.
+        self.counter: Optional[float] = None
+        self.counter_ts: Optional[int] = None
+        # average power between the last two counter readings.
+        self.derived_power: Optional[float] = None
+        # last power reading, and when.
+        self.power: Optional[float] = None
+        self.power_ts: Optional[int] = None
+        self.resets = 0
+        self.wraps = 0
+        self.glitches = 0
+        self.consumed = 0.0
+        # consumed over too long a span to say when.
+        self.unattributed = 0.0
+
+    def has_counter(self) -> bool:
+        return self.counter is not None
+
+    @classmethod
+    def _wrap_point(cls, last: float, reading: float) -> Optional[float]:
+        if last <= 0:
+            return None
+        wrap = 10.0
+        while wrap <= last:
+            wrap *= 10
+        if last >= wrap * (1 - cls.wrap_margin) and \
+           reading <= wrap * cls.wrap_margin:
+            return wrap
+        return None
+
+    """
+        A counter reading. Returns what was consumed since the last one,
+        as far as we can tell, and since when.
+    """
+    def add_counter(self, ts: int, kwh: float) -> Tuple[float, int]:
+        last, last_ts = self.counter, self.counter_ts
+        if last is None:
+            self.counter, self.counter_ts = kwh, ts
+            return 0.0, ts
+        if ts <= last_ts:
+            # out of order, or a repeat; keep the baseline we have.
+            return 0.0, last_ts
+
+        delta = kwh - last
+        if delta < 0:
+            if -delta <= self.jitter:
+                # keep the higher reading as baseline.
+                return 0.0, last_ts
+            wrap = self._wrap_point(last, kwh)
+            if wrap is not None:
+                self.wraps += 1
+                delta = wrap - last + kwh
+            else:
+                self.resets += 1
+                delta = kwh
+
+        hours = (ts - last_ts) / HOUR_MS
+        power = delta * 1000 / hours
+        self.counter, self.counter_ts = kwh, ts
+        if power > self.max_power and delta > self.glitch_min:
+            self.glitches += 1
+            return 0.0, ts
+        self.derived_power = power
+        return delta, last_ts
+
+    """
+        A power reading. Returns what was consumed since the last one, by
+        the last one's power, if we should account for it; that is, if
+        we have no counter to go by.
+    """
+    def add_power(self, ts: int, watts: float) -> Tuple[float, int]:
+        last, last_ts = self.power, self.power_ts
+        if last is not None and ts <= last_ts:
+            return 0.0, last_ts
+        self.power, self.power_ts = watts, ts
+        if self.has_counter() or last is None:
+            return 0.0, ts
+        return last * (ts - last_ts) / HOUR_MS / 1000, last_ts
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'instance': self.instance,
+            'source': 'counter' if self.has_counter() else 'power',
+            'counter': self.counter,
+            'power': self.power,
+            'derived_power': self.derived_power,
+            'consumed': self.consumed,
+            'unattributed': self.unattributed,
+            'resets': self.resets,
+            'wraps': self.wraps,
+            'glitches': self.glitches
+        }
+
+    def dump(self) -> Dict[str, Any]:
+        return {
+            'counter': self.counter, 'counter_ts': self.counter_ts,
+            'resets': self.resets, 'wraps': self.wraps,
+            'glitches': self.glitches, 'consumed': self.consumed,
+            'unattributed': self.unattributed
+        }
+
+    def restore(self, d: Dict[str, Any]):
+        self.counter = d.get('counter')
+        self.counter_ts = d.get('counter_ts')
+        self.resets = d.get('resets', 0)
+        self.wraps = d.get('wraps', 0)
+        self.glitches = d.get('glitches', 0)
+        self.consumed = d.get('consumed', 0.0)
+        self.unattributed = d.get('unattributed', 0.0)
+
+
+"""
+A node's meter: its channels, by instance, and what they've consumed
+between them.
+"""
+class NodeMeter:
+
+    def __init__(self, node_id: int):
+        self.node_id = node_id
+        self.channels: Dict[int, ChannelMeter] = {}
+        self.totals = Totals()
+
+    def get_channel(self, instance: int) -> ChannelMeter:
+        channel = self.channels.get(instance)
+        if channel is None:
+            channel = self.channels[instance] = \
+                ChannelMeter(self.node_id, instance)
+        return channel
+
+    def _sum(self, attr: str):
+        return sum(getattr(channel, attr)
+                   for channel in self.channels.values())
+
+    @property
+    def consumed(self) -> float:
+        return self._sum('consumed')
+
+    @property
+    def unattributed(self) -> float:
+        return self._sum('unattributed')
+
+    @property
+    def resets(self) -> int:
+        return self._sum('resets')
+
+    @property
+    def wraps(self) -> int:
+        return self._sum('wraps')
+
+    @property
+    def glitches(self) -> int:
+        return self._sum('glitches')
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'node_id': self.node_id,
+            'consumed': self.consumed,
+            'unattributed': self.unattributed,
+            'resets': self.resets,
+            'wraps': self.wraps,
+            'glitches': self.glitches,
+            'current': self.totals.current(),
+            'channels': {instance: channel.to_dict() for instance, channel
+                         in sorted(self.channels.items())}
+        }
+
+    def dump(self) -> Dict[str, Any]:
+        return {
+            'channels': {str(instance): channel.dump()
+                         for instance, channel in self.channels.items()},
+            'totals': self.totals.to_dict()
+        }
+
+    def restore(self, d: Dict[str, Any]):
+        channels = d.get('channels')
+        if channels is None:
+            # saved before channels were: all of it was the one.
+            channels = {'1': d}
+        for instance, cd in channels.items():
+            self.get_channel(int(instance)).restore(cd)
+        self.totals.load(d.get('totals', {}))
+
+
+class EnergyAccounts:
+
+    def __init__(self):
+        self.meters: Dict[int, NodeMeter] = {}
+        # every node's, added up.
+        self.totals = Totals()
+        self.lock = threading.Lock()
+
+    def get_meter(self, node_id: int) -> Optional[NodeMeter]:
+        return self.meters.get(node_id)
+
+    """
+        A reading of a node's 'instance'; only kWh and W matter, anything
+        else is ignored. Timestamps are ms since the epoch.
+    """
+    def feed(self, node_id: int, unit: str, value: float,
+             ts: Optional[int] = None, instance: int = 1):
+        if unit != UNIT_ENERGY and unit != UNIT_POWER:
+            return
+        if ts is None:
+            ts = int(time.time() * 1000)
+        with self.lock:
+            meter = self.meters.get(node_id)
+            if meter is None:
+                meter = self.meters[node_id] = NodeMeter(node_id)
+            channel = meter.get_channel(instance)
+            if unit == UNIT_ENERGY:
+                kwh, since = channel.add_counter(ts, value)
+            else:
+                kwh, since = channel.add_power(ts, value)
+            if kwh > 0:
+                channel.consumed += kwh
+                if ts - since > MAX_SPREAD_MS:
+                    channel.unattributed += kwh
+                else:
+                    _spread([meter.totals, self.totals], since, ts, kwh)
+
+    def get_totals(self, period: str, node_id: Optional[int] = None,
+                   last: Optional[int] = None) -> Dict[str, float]:
+        with self.lock:
+            if node_id is None:
+                return self.totals.get(period, last)
+            meter = self.meters.get(node_id)
+            return meter.totals.get(period, last) if meter else {}
+
+    def get_summary(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'current': self.totals.current(),
+                'nodes': {node_id: meter.to_dict()
+                          for node_id, meter in self.meters.items()}
+            }
+
+    def dump(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'totals': self.totals.to_dict(),
+                'nodes': {str(node_id): meter.dump()
+                          for node_id, meter in self.meters.items()}
+            }
+
+    def save(self, path: str) -> bool:
+        dumped = self.dump()
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(dumped, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"unable to save energy accounts to {path}: {e}")
+            return False
+        return True
+
+    def load(self, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path) as f:
+                self.restore(json.load(f))
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"unable to load energy accounts from {path}: {e}")
+            return False
+        logger.info(f"loaded energy accounts of {len(self.meters)} nodes "
+                    f"from {path}")
+        return True
+
+    def restore(self, d: Dict[str, Any]):
+        with self.lock:
+            self.totals.load(d.get('totals', {}))
+            for node_id, md in d.get('nodes', {}).items():
+                meter = NodeMeter(int(node_id))
+                meter.restore(md)
+                self.meters[meter.node_id] = meter
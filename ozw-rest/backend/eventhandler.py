@@ -1,4 +1,5 @@
 import logging
+import time
 from abc import ABC, abstractmethod
 
 # requirerments for openzwave integration
@@ -10,13 +11,27 @@ from openzwave.value import ZWaveValue
 # requirement for catching events from openzwave lib
 from pydispatch import dispatcher
 
+from .ingest import IngestQueue, IngestEvent, POLICY_COALESCE
+from .timing import histogram
+
 
 logger = logging.getLogger(__name__)
 
 
+"""
+Signal handlers run on openzwave's notification thread, and only ever
+queue events up. The actual handling, by whoever implements the abstract
+'_handle_*' methods, happens on our ingestion worker.
+"""
 class EventHandler(ABC):
 
-    def __init__(self):
+    def __init__(self, max_queue: int = 10000,
+                 overflow_policy: str = POLICY_COALESCE,
+                 name: str = 'ozw-ingest'):
+
+        self.ingest = IngestQueue(self._dispatch, max_size=max_queue,
+                                  policy=overflow_policy, name=name)
+        self.ingest.start()
 
         dispatcher.connect(self.handle_value, ZWaveNetwork.SIGNAL_VALUE_ADDED)
         dispatcher.connect(self.handle_value, ZWaveNetwork.SIGNAL_VALUE_CHANGED)
@@ -28,40 +43,116 @@ class EventHandler(ABC):
                            ZWaveNetwork.SIGNAL_NODE_ADDED)
         dispatcher.connect(self.handle_node_event,
                            ZWaveNetwork.SIGNAL_NODE_NEW)
+        dispatcher.connect(self.handle_node_event,
+                           ZWaveNetwork.SIGNAL_NODE_REMOVED)
+        dispatcher.connect(self.handle_node_event,
+                           ZWaveNetwork.SIGNAL_NODE_NAMING)
+        dispatcher.connect(self.handle_node_event,
+                           ZWaveNetwork.SIGNAL_NODE_PROTOCOL_INFO)
+        dispatcher.connect(self.handle_node_event,
+                           ZWaveNetwork.SIGNAL_ESSENTIAL_NODE_QUERIES_COMPLETE)
+        dispatcher.connect(self.handle_node_event,
+                           ZWaveNetwork.SIGNAL_NODE_QUERIES_COMPLETE)
+
+        dispatcher.connect(self.handle_network_event,
+                           ZWaveNetwork.SIGNAL_NETWORK_STARTED)
+        dispatcher.connect(self.handle_network_event,
+                           ZWaveNetwork.SIGNAL_NETWORK_AWAKED)
+        dispatcher.connect(self.handle_network_event,
+                           ZWaveNetwork.SIGNAL_NETWORK_READY)
+        dispatcher.connect(self.handle_network_event,
+                           ZWaveNetwork.SIGNAL_NETWORK_FAILED)
+        dispatcher.connect(self.handle_network_event,
+                           ZWaveNetwork.SIGNAL_NETWORK_RESETTED)
+        dispatcher.connect(self.handle_network_event,
+                           ZWaveNetwork.SIGNAL_NETWORK_STOPPED)
 
         dispatcher.connect(self.handle_controller_cmd,
                            ZWaveNetwork.SIGNAL_CONTROLLER_COMMAND)
 
 
-    def handle_value(self, signal, node, value):
-
-        logger.info("node value: signal = {}, node = {}, value = {}".format(
-            signal, node, value
-        ))
+    """
+        Whether a signal from 'network' is for us to handle. Signals are
+        sent to every handler, whichever network they come from.
+    """
+    def _is_ours(self, network, node=None, value=None) -> bool:
+        return True
 
-        #self._handle_value(node.node_id, node, value)
+    def handle_value(self, signal, node, value, network=None):
+        # keep it short; this is on the notification thread.
+        if not self._is_ours(network, node, value):
+            return
+        value_id = value.value_id
+        # only plain updates may be coalesced; a value being added or
+        # removed must be seen as such.
+        key = value_id if signal in (ZWaveNetwork.SIGNAL_VALUE_CHANGED,
+                                     ZWaveNetwork.SIGNAL_VALUE_REFRESHED) \
+            else None
+        self.ingest.put(IngestEvent(
+            'value', signal, node_id=node.node_id, value_id=value_id,
+            data=value.data, node=node, value=value, key=key))
 
     def handle_node_event(self, signal, **kwargs):
 
-        logger.info("node event: signal = {}, kwargs = {}".format(
-            signal, kwargs))
-
-        if 'node' not in kwargs:
+        if 'node' not in kwargs or \
+           not self._is_ours(kwargs.get('network'), kwargs['node']):
             return
 
-        node: ZWaveNode = kwargs['node'] 
-        self._handle_node(node.node_id, node)
-        
+        node: ZWaveNode = kwargs['node']
+        self.ingest.put(IngestEvent(
+            'node', signal, node_id=node.node_id, node=node))
+
+    def handle_network_event(self, signal, **kwargs):
+        if not self._is_ours(kwargs.get('network')):
+            return
+        self.ingest.put(IngestEvent(
+            'network', signal, network=kwargs.get('network')))
+
+    def _dispatch(self, event: IngestEvent):
+        start = time.perf_counter()
+        try:
+            self._dispatch_event(event)
+        finally:
+            histogram(f'ingest.{event.kind}').observe(
+                time.perf_counter() - start)
+
+    def _dispatch_event(self, event: IngestEvent):
+        if event.kind == 'value':
+            self._handle_value(event.signal, event.node_id, event.node,
+                               event.value, event.data, event.timestamp)
+        elif event.kind == 'node':
+            logger.info("node event: signal = {}, node = {}".format(
+                event.signal, event.node_id))
+            self._handle_node(event.signal, event.node_id, event.node)
+        elif event.kind == 'network':
+            logger.info(f"network event: signal = {event.signal}")
+            self._handle_network(event.signal, event.network)
+
+    def get_ingest_stats(self):
+        return self.ingest.get_stats()
 
     def handle_controller_cmd(self, signal, **kwargs):
-        logger.info("controller cmd > signal = {}, kwargs = {}".format(
-            signal, kwargs
-        ))
+        # rare enough, and whoever's waiting on it wants it now; no need
+        # to go through the queue.
+        if not self._is_ours(kwargs.get('network')):
+            return
+        logger.info("controller cmd > state = {}, node = {}".format(
+            kwargs.get('state'), kwargs.get('node_id')))
+        self._handle_controller_cmd(**kwargs)
+
+    @abstractmethod
+    def _handle_value(self, signal, node_id, node, value, data,
+                      timestamp: float = None):
+        pass
 
     @abstractmethod
-    def _handle_value(self, node, value):
+    def _handle_node(self, signal, node_id, node):
         pass
 
     @abstractmethod
-    def _handle_node(self, node):
-        pass
\ No newline at end of file
+    def _handle_network(self, signal, network):
+        pass
+
+    @abstractmethod
+    def _handle_controller_cmd(self, **kwargs):
+        pass
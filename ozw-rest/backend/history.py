@@ -0,0 +1,410 @@
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Past readings of every node's user values, per node, unit and instance
+(channel, for nodes with more than one of a unit), for charts.
+
+Each series keeps its raw samples for a while, and rollups -- min, max,
+sum, count and last, per minute, per 15 minutes, per hour -- for much
+longer. Rollups are kept up to date as samples come in, one open bucket
+per rollup, so nothing is ever rolled up after the fact.
+
+Queries are answered off the coarsest source that fits the step asked
+for: a month at 1h steps reads 720 hourly rows rather than half a million
+samples. Buckets are then reduced with numpy, in one go per column.
+Finer sources are kept for less time, though, and a source that doesn't
+reach back to the start of a query isn't used for it: a week at 5m steps
+can't be answered off minutes kept for two days. A step no source
+reaching back that far can serve is refused.
+
+Everything's kept in numpy arrays, oldest first, which only ever grow up
+to their retention; past that, the oldest quarter is dropped to make room.
+"""
+
+
+RAW = 'raw'
+# name, period (ms); finest first.
+ROLLUPS: List[Tuple[str, int]] = [
+    ('1m', 60_000),
+    ('15m', 900_000),
+    ('1h', 3_600_000),
+]
+
+RAW_DTYPE = np.dtype([('ts', 'i8'), ('value', 'f8')])
+ROLLUP_DTYPE = np.dtype([('ts', 'i8'), ('min', 'f8'), ('max', 'f8'),
+                         ('sum', 'f8'), ('count', 'i8'), ('last', 'f8')])
+
+# steps we round up to, when not told one (ms).
+NICE_STEPS = [1_000, 5_000, 10_000, 30_000, 60_000, 300_000, 900_000,
+              1_800_000, 3_600_000, 10_800_000, 21_600_000, 43_200_000,
+              86_400_000]
+
+_STEP_UNITS = {'ms': 1, 's': 1_000, 'm': 60_000, 'h': 3_600_000,
+               'd': 86_400_000}
+
+
+class HistoryException(Exception):
+    pass
+
+
+"""
+    Parse a step, as '5s', '15m', '1h', '1d', or plain seconds, into ms.
+"""
+def parse_step(step: str) -> int:
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h|d)?\s*', step)
+    if not m:
+        raise HistoryException(f"malformed step '{step}'")
+    ms = float(m.group(1)) * _STEP_UNITS[m.group(2) or 's']
+    if ms < 1:
+        raise HistoryException(f"step '{step}' too small")
+    return int(ms)
+
+
+"""
+    The other way around: ms into the largest unit that fits, as '15m'.
+"""
+def format_step(ms: int) -> str:
+    for unit, size in reversed(list(_STEP_UNITS.items())):
+        if ms % size == 0:
+            return f"{ms // size}{unit}"
+    return f"{ms}ms"
+
+
+class _Table:
+
+    def __init__(self, dtype: np.dtype, capacity: int):
+        self.capacity = capacity
+        self.rows = np.empty(min(capacity, 1024), dtype=dtype)
+        self.n = 0
+
+    def append(self, row: Tuple):
+        if self.n == len(self.rows):
+            if len(self.rows) < self.capacity:
+                grown = np.empty(min(self.capacity, len(self.rows) * 2),
+                                 dtype=self.rows.dtype)
+                grown[:self.n] = self.rows[:self.n]
+                self.rows = grown
+            else:
+                drop = max(1, self.capacity // 4)
+                self.rows[:self.n - drop] = self.rows[drop:self.n]
+                self.n -= drop
+        self.rows[self.n] = row
+        self.n += 1
+
+    def view(self) -> np.ndarray:
+        return self.rows[:self.n]
+
+    def first_ts(self) -> Optional[int]:
+        return int(self.rows['ts'][0]) if self.n else None
+
+    def load(self, rows: np.ndarray):
+        rows = rows[-self.capacity:]
+        self.rows = np.empty(max(len(rows), min(self.capacity, 1024)),
+                             dtype=self.rows.dtype)
+        self.rows[:len(rows)] = rows
+        self.n = len(rows)
+
+
+class _Rollup:
+
+    def __init__(self, name: str, period: int, capacity: int):
+        self.name = name
+        self.period = period
+        self.table = _Table(ROLLUP_DTYPE, capacity)
+        # the bucket samples are going into: [ts, min, max, sum, count,
+        # last], or None.
+        self.open: Optional[List] = None
+
+    def add(self, ts: int, value: float):
+        start = ts - ts % self.period
+        bucket = self.open
+        if bucket is not None and bucket[0] == start:
+            if value < bucket[1]:
+                bucket[1] = value
+            if value > bucket[2]:
+                bucket[2] = value
+            bucket[3] += value
+            bucket[4] += 1
+            bucket[5] = value
+            return
+        if bucket is not None:
+            self.table.append(tuple(bucket))
+        self.open = [start, value, value, value, 1, value]
+
+    """
+        Buckets starting from 'start' up to 'end', the open one included,
+        copied.
+    """
+    def rows(self, start: Optional[int] = None,
+             end: Optional[int] = None) -> np.ndarray:
+        rows = self.table.view()
+        if start is not None:
+            lo, hi = np.searchsorted(rows['ts'], [start, end])
+            rows = rows[lo:hi]
+        is_open = self.open is not None and \
+            (start is None or start <= self.open[0] < end)
+        if not is_open:
+            return rows.copy()
+        return np.concatenate(
+            [rows, np.array([tuple(self.open)], dtype=ROLLUP_DTYPE)])
+
+    def first_ts(self) -> Optional[int]:
+        if self.table.n:
+            return self.table.first_ts()
+        return self.open[0] if self.open is not None else None
+
+    def load(self, rows: np.ndarray):
+        # the last row was the open bucket when saved.
+        if len(rows):
+            self.open = list(rows[-1].tolist())
+            rows = rows[:-1]
+        self.table.load(rows)
+
+
+class Series:
+
+    def __init__(self, retention: Dict[str, int]):
+        self.lock = threading.Lock()
+        self.raw = _Table(RAW_DTYPE, retention[RAW])
+        self.rollups = [_Rollup(name, period, retention[name])
+                        for name, period in ROLLUPS]
+
+    def add(self, ts: int, value: float):
+        with self.lock:
+            self.raw.append((ts, value))
+            for rollup in self.rollups:
+                rollup.add(ts, value)
+
+    """
+        Sources that reach back to 'start', finest first, as (rollup,
+        period); raw samples being rollup None, of period 1. A source
+        reaches back if it starts no later than 'start', or if it holds
+        all there is: it starts within a bucket of where the coarsest
+        rollup, kept the longest, starts.
+    """
+    def _covering(self, start: int) -> List[Tuple[Optional[_Rollup], int]]:
+        sources = [(None, 1, self.raw.first_ts())] + \
+            [(rollup, rollup.period, rollup.first_ts())
+             for rollup in self.rollups]
+        earliest = next((first + period
+                         for _, period, first in reversed(sources)
+                         if first is not None), None)
+        return [(source, period) for source, period, first in sources
+                if first is not None and
+                (first <= start or first < earliest)]
+
+    """
+        The finest step we can serve from 'start' on (ms); steps must be
+        a multiple of it.
+    """
+    def min_step(self, start: int) -> int:
+        with self.lock:
+            covering = self._covering(start)
+        return covering[0][1] if covering else 1
+
+    """
+        Where to read 'step' buckets from: the coarsest source reaching
+        back to 'start' whose buckets fit evenly in a step.
+    """
+    def _pick_source(self, step: int, start: int) -> Optional[_Rollup]:
+        covering = self._covering(start)
+        for source, period in reversed(covering):
+            if step % period == 0:
+                return source
+        if not covering:
+            # nothing at all; raw samples answer that as well as any.
+            return None
+        raise HistoryException(
+            f"no data that old at a {format_step(step)} step; the step "
+            f"must be a multiple of {format_step(covering[0][1])}")
+
+    def query(self, start: int, end: int, step: int
+              ) -> Tuple[str, Dict[str, np.ndarray]]:
+        with self.lock:
+            source = self._pick_source(step, start)
+            if source is None:
+                rows = self.raw.view()
+                lo, hi = np.searchsorted(rows['ts'], [start, end])
+                rows = rows[lo:hi].copy()
+            else:
+                rows = source.rows(start, end)
+
+        if source is None:
+            ts = rows['ts']
+            mins = maxs = sums = lasts = rows['value']
+            counts = np.ones(len(rows), dtype='i8')
+        else:
+            ts = rows['ts']
+            mins, maxs, sums = rows['min'], rows['max'], rows['sum']
+            counts, lasts = rows['count'], rows['last']
+
+        if not len(ts):
+            empty = np.empty(0)
+            return (source.name if source else RAW,
+                    {'ts': np.empty(0, dtype='i8'), 'min': empty,
+                     'max': empty, 'avg': empty, 'last': empty,
+                     'count': np.empty(0, dtype='i8')})
+
+        buckets = (ts - start) // step
+        starts = np.concatenate(
+            ([0], np.flatnonzero(np.diff(buckets)) + 1))
+        ends = np.concatenate((starts[1:], [len(ts)]))
+        count = np.add.reduceat(counts, starts)
+        return (source.name if source else RAW, {
+            'ts': start + buckets[starts] * step,
+            'min': np.minimum.reduceat(mins, starts),
+            'max': np.maximum.reduceat(maxs, starts),
+            'avg': np.add.reduceat(sums, starts) / count,
+            'last': lasts[ends - 1],
+            'count': count
+        })
+
+
+class HistoryStore:
+
+    # rows kept per series: raw samples (a day's worth at one every 5
+    # seconds), then per rollup (2 days of minutes, 35 days of quarters,
+    # 400 days of hours). Worst case, about 1MB per series.
+    retention: Dict[str, int] = {
+        RAW: 17280,
+        '1m': 2880,
+        '15m': 3360,
+        '1h': 9600,
+    }
+    # most buckets a query may ask for, and how many we aim for when not
+    # told a step.
+    max_points = 10000
+    default_points = 500
+
+    def __init__(self):
+        self.series: Dict[Tuple[int, str, int], Series] = {}
+        self.lock = threading.Lock()
+        # bumped on every sample; tells whether there's anything to save.
+        self.generation = 0
+        self.saved_generation: Optional[int] = None
+
+    def record(self, node_id: int, unit: str, value: float,
+               timestamp: Optional[int] = None, instance: int = 1):
+        key = (node_id, unit, instance)
+        series = self.series.get(key)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(key, Series(self.retention))
+        series.add(timestamp if timestamp is not None
+                   else int(time.time() * 1000), value)
+        self.generation += 1
+
+    def get_units(self, node_id: int) -> List[str]:
+        return sorted({unit for n, unit, _ in list(self.series)
+                       if n == node_id})
+
+    def get_instances(self, node_id: int, unit: str) -> List[int]:
+        return sorted(i for n, u, i in list(self.series)
+                      if n == node_id and u == unit)
+
+    def has_series(self, node_id: int, unit: str, instance: int = 1) -> bool:
+        return (node_id, unit, instance) in self.series
+
+    """
+        Buckets of 'step' ms, from 'start' to 'end' (ms since the epoch),
+        with the min, max, average and last of the samples in each; only
+        buckets with samples are returned. Without a step, one is picked
+        for about 'default_points' buckets.
+    """
+    def query(self, node_id: int, unit: str, start: int, end: int,
+              step: Optional[int] = None, instance: int = 1
+              ) -> Dict[str, Any]:
+        series = self.series.get((node_id, unit, instance))
+        if series is None:
+            raise HistoryException(
+                f"no history for node {node_id} in '{unit}' "
+                f"on instance {instance}")
+        if end <= start:
+            raise HistoryException("nothing between 'from' and 'to'")
+        if step is None:
+            # as fine as we can serve, for about 'default_points'.
+            wanted = (end - start) / self.default_points
+            finest = series.min_step(start)
+            step = next((s for s in NICE_STEPS
+                         if s >= wanted and s % finest == 0),
+                        max(NICE_STEPS[-1], finest))
+        if (end - start) / step > self.max_points:
+            raise HistoryException(
+                f"too many buckets; at most {self.max_points}")
+        # buckets start at multiples of the step, so they line up with
+        # the rollups'.
+        start -= start % step
+        source, columns = series.query(start, end, step)
+        return {
+            'node_id': node_id,
+            'unit': unit,
+            'instance': instance,
+            'from': start,
+            'to': end,
+            'step': step,
+            'source': source,
+            **{k: v.tolist() for k, v in columns.items()}
+        }
+
+    def save(self, path: str) -> bool:
+        generation = self.generation
+        if generation == self.saved_generation:
+            return False
+        arrays = {}
+        for (node_id, unit, instance), series in list(self.series.items()):
+            prefix = f"{node_id}|{unit}|{instance}"
+            with series.lock:
+                arrays[f"{prefix}|{RAW}"] = series.raw.view().copy()
+                for rollup in series.rollups:
+                    arrays[f"{prefix}|{rollup.name}"] = rollup.rows()
+        path = Path(path)
+        tmp = path.with_name(path.name + '.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"unable to save history to {path}: {e}")
+            return False
+        self.saved_generation = generation
+        logger.debug(f"saved {len(self.series)} series to {path}")
+        return True
+
+    def load(self, path: str) -> bool:
+        if not Path(path).exists():
+            return False
+        try:
+            with np.load(path) as data:
+                for name in data.files:
+                    parts = name.rsplit('|', 3)
+                    if len(parts) == 3:
+                        # saved before instances were kept.
+                        parts.insert(2, '1')
+                    node_id, unit, instance, source = parts
+                    key = (int(node_id), unit, int(instance))
+                    series = self.series.setdefault(
+                        key, Series(self.retention))
+                    if source == RAW:
+                        series.raw.load(data[name])
+                        continue
+                    for rollup in series.rollups:
+                        if rollup.name == source:
+                            rollup.load(data[name])
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"unable to load history from {path}: {e}")
+            return False
+        self.saved_generation = self.generation
+        logger.info(f"loaded {len(self.series)} series from {path}")
+        return True
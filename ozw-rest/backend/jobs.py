@@ -0,0 +1,309 @@
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Runs long operations, one at a time, on a worker thread of our own, so
+whoever asks for them (usually an API request) gets a job to check on
+instead of waiting.
+
+Jobs are run in the order they were submitted. A job may be given a key;
+submitting a job with the same key as one still queued or running yields
+that job rather than a new one -- asking for a heal while one is ongoing
+just joins it.
+
+Some operations are only done when the controller says so. Those jobs
+wait for a report (see 'report()'), which is what we get out of the
+controller command notifications, and record each one as progress.
+"""
+
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+
+class JobException(Exception):
+    pass
+
+class JobCancelledException(JobException):
+    pass
+
+class JobTimeoutException(JobException):
+    pass
+
+
+class Job:
+
+    def __init__(self, job_id: int, kind: str,
+                 fn: Callable[['Job'], Any],
+                 key: Optional[str] = None,
+                 params: Optional[Dict[str, Any]] = None,
+                 on_cancel: Optional[Callable[[], None]] = None):
+        self.id = job_id
+        self.kind = kind
+        self.fn = fn
+        self.key = key
+        self.params = params if params else {}
+        self.on_cancel = on_cancel
+
+        self.status = JOB_QUEUED
+        self.created = time.time()
+        self.started: float = None
+        self.finished: float = None
+        self.result: Any = None
+        self.error: str = None
+
+        # (steps done, steps total), if we know.
+        self.steps_done = 0
+        self.steps_total: int = None
+        self.progress: List[Dict[str, Any]] = []
+        self.max_progress = 100
+
+        self.is_cancelled = False
+        self.report_cond = threading.Condition()
+        # final reports not yet waited for, oldest first; a job asking
+        # for many things at once may get several before it gets to them.
+        self.reports = deque()
+
+    def is_finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+    def set_steps(self, done: int, total: int = None):
+        self.steps_done = done
+        if total is not None:
+            self.steps_total = total
+
+    def add_progress(self, **kwargs):
+        kwargs['timestamp'] = time.time()
+        self.progress.append(kwargs)
+        if len(self.progress) > self.max_progress:
+            del self.progress[0]
+
+    """
+        Called from the job itself, right before asking the controller for
+        something, so only reports from then on count.
+    """
+    def expect_report(self):
+        with self.report_cond:
+            self.reports.clear()
+
+    """
+        Called from the job itself, once it has asked the controller for
+        something. Waits for the controller to report it done, returning
+        that report; reports come out in the order they came in.
+    """
+    def wait_for_report(self, timeout: float) -> Dict[str, Any]:
+        deadline = time.monotonic() + timeout
+        with self.report_cond:
+            while not self.reports:
+                if self.is_cancelled:
+                    raise JobCancelledException("job cancelled")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise JobTimeoutException(
+                        f"no answer from controller after {timeout}s")
+                self.report_cond.wait(remaining)
+            return self.reports.popleft()
+
+    def report(self, is_final: bool, **kwargs):
+        self.add_progress(**kwargs)
+        if not is_final:
+            return
+        with self.report_cond:
+            self.reports.append(kwargs)
+            self.report_cond.notify_all()
+
+    def cancel(self):
+        self.is_cancelled = True
+        with self.report_cond:
+            self.report_cond.notify_all()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'params': self.params,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'steps_done': self.steps_done,
+            'steps_total': self.steps_total,
+            'progress': list(self.progress),
+            'result': self.result,
+            'error': self.error
+        }
+
+
+class JobManager:
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name: str = 'jobs', max_finished: int = 100):
+        self.name = name
+        # how many finished jobs we remember.
+        self.max_finished = max_finished
+        self.jobs: Dict[int, Job] = OrderedDict()
+        self.by_key: Dict[str, Job] = {}
+        self.queue = deque()
+        self.current: Job = None
+        self.cond = threading.Condition()
+        self.thread: threading.Thread = None
+        self.is_running = False
+
+    def _prune(self):
+        finished = [j for j in self.jobs.values() if j.is_finished()]
+        for job in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job.id]
+
+    def submit(self, kind: str, fn: Callable[[Job], Any],
+               key: Optional[str] = None,
+               params: Optional[Dict[str, Any]] = None,
+               on_cancel: Optional[Callable[[], None]] = None) -> Job:
+        with self.cond:
+            if key is not None and key in self.by_key:
+                job = self.by_key[key]
+                logger.info(f"{self.name}: joining job {job.id} ({kind})")
+                return job
+            job = Job(next(self._ids), kind, fn, key, params, on_cancel)
+            self.jobs[job.id] = job
+            if key is not None:
+                self.by_key[key] = job
+            self.queue.append(job)
+            self._prune()
+            self.cond.notify()
+        logger.info(f"{self.name}: queued job {job.id} ({kind})")
+        self.start()
+        return job
+
+    def get(self, job_id: int) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def get_jobs(self) -> List[Job]:
+        with self.cond:
+            return list(self.jobs.values())
+
+    def _finish(self, job: Job, status: str):
+        job.status = status
+        job.finished = time.time()
+        with self.cond:
+            if job.key is not None and self.by_key.get(job.key) is job:
+                del self.by_key[job.key]
+
+    """
+        Cancel a job. If it is still queued it's simply dropped; if it's
+        running, it's told to stop waiting for the controller, and its
+        'on_cancel' called.
+    """
+    def cancel(self, job_id: int) -> Optional[Job]:
+        job = self.get(job_id)
+        if not job or job.is_finished():
+            return job
+        with self.cond:
+            is_queued = job in self.queue
+            if is_queued:
+                self.queue.remove(job)
+        job.cancel()
+        if is_queued:
+            self._finish(job, JOB_CANCELLED)
+            return job
+        if job.on_cancel:
+            try:
+                job.on_cancel()
+            except Exception as e:
+                logger.error(f"{self.name}: error cancelling job "
+                             f"{job.id}: {e}")
+        return job
+
+    def cancel_all(self, kinds: Optional[List[str]] = None):
+        for job in self.get_jobs():
+            if kinds is None or job.kind in kinds:
+                self.cancel(job.id)
+
+    """
+        Hand a controller report to whichever job is running. Returns
+        whether anyone got it.
+    """
+    def report(self, is_final: bool, **kwargs) -> bool:
+        job = self.current
+        if not job:
+            return False
+        job.report(is_final, **kwargs)
+        return True
+
+    def _run_job(self, job: Job):
+        job.status = JOB_RUNNING
+        job.started = time.time()
+        logger.info(f"{self.name}: running job {job.id} ({job.kind})")
+        try:
+            job.result = job.fn(job)
+        except JobCancelledException:
+            self._finish(job, JOB_CANCELLED)
+        except Exception as e:
+            logger.error(f"{self.name}: job {job.id} ({job.kind}) "
+                         f"failed: {e}")
+            job.error = str(e)
+            self._finish(job, JOB_FAILED)
+        else:
+            self._finish(job, JOB_CANCELLED if job.is_cancelled else JOB_DONE)
+        logger.info(f"{self.name}: job {job.id} ({job.kind}) {job.status}")
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.is_running and not self.queue:
+                    self.cond.wait()
+                if not self.is_running:
+                    return
+                job = self.queue.popleft()
+                self.current = job
+            self._run_job(job)
+            self.current = None
+
+    def start(self):
+        with self.cond:
+            if self.is_running:
+                return
+            self.is_running = True
+            self.thread = threading.Thread(target=self._run, name=self.name,
+                                           daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            if not self.is_running:
+                return
+            self.is_running = False
+            self.cond.notify()
+            # nothing's going to run these; say so, rather than leave them
+            # queued for ever.
+            queued, self.queue = list(self.queue), deque()
+        for job in queued:
+            job.cancel()
+            self._finish(job, JOB_CANCELLED)
+        if self.current:
+            self.cancel(self.current.id)
+        self.thread.join()
+        self.thread = None
+
+    """
+        Wait for a job to finish. Mostly for the benefit of tests, and of
+        those that can afford to wait.
+    """
+    def wait(self, job: Job, timeout: float = 10.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while not job.is_finished():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
@@ -0,0 +1,67 @@
+import logging
+import re
+from typing import Dict
+
+from prometheus_client import CollectorRegistry
+from prometheus_client.core import GaugeMetricFamily
+
+from .snapshot import SnapshotStore
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Renders every numeric User value we know of as a gauge, straight from the
+node snapshot. A scrape is nothing more than a pass over what we already
+have in memory; libopenzwave is never bothered.
+
+Gauges are named after the value's units (e.g., 'home_consumption_kWh'),
+matching what ozw-cli pushes to the gateway, so dashboards work with
+either. A node may have more than one value of a kind -- a meter with a
+few clamps has a 'Power' per clamp -- so samples are labelled with the
+value's instance and index as well, which tell them apart.
+"""
+class SnapshotCollector:
+
+    namespace: str = 'home'
+    name: str = 'consumption'
+
+    def __init__(self, snapshot: SnapshotStore):
+        self.snapshot = snapshot
+
+    def _metric_name(self, units: str) -> str:
+        units = re.sub(r'[^a-zA-Z0-9_]', '_', units)
+        if not units:
+            return f"{self.namespace}_{self.name}"
+        return f"{self.namespace}_{self.name}_{units}"
+
+    def collect(self):
+        families: Dict[str, GaugeMetricFamily] = {}
+
+        for node_id, value in self.snapshot.get_values(genre='user'):
+            data = value.data
+            if isinstance(data, bool) or \
+               not isinstance(data, (int, float)):
+                continue
+
+            name = self._metric_name(value.units)
+            if name not in families:
+                families[name] = GaugeMetricFamily(
+                    name, f"node {value.units} consumption",
+                    labels=['node', 'label', 'instance', 'index'])
+            families[name].add_metric(
+                [f"node_{node_id}", value.label, str(value.instance),
+                 str(value.index)], float(data))
+
+        return families.values()
+
+    def describe(self):
+        # we don't know what we'll have until we're asked for it.
+        return []
+
+
+def create_registry(snapshot: SnapshotStore) -> CollectorRegistry:
+    registry = CollectorRegistry(auto_describe=False)
+    registry.register(SnapshotCollector(snapshot))
+    return registry
@@ -0,0 +1,142 @@
+import logging
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, Set
+
+from .encoding import encode
+from .timing import histogram
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+The mesh, as the nodes' neighbor lists tell it, along with what we'd like
+to know about it: how many hops apart any two nodes are, how well
+connected each one is, and which nodes everything else depends on to be
+reached (articulation points -- lose one of those and the mesh splits).
+
+Neighbor lists only change on the controller's say-so (a heal, a neighbor
+update, a node added or removed), so a graph is built once those are
+done -- for a heal, once the nodes reported back, not when it's merely
+started -- with everything computed up front, and then served as is. A
+graph is never modified; a new one replaces it.
+
+Links are taken to go both ways: a node listing another as neighbor is
+enough for both to be neighbors of each other.
+"""
+class NeighborGraph:
+
+    def __init__(self, neighbors: Dict[int, Iterable[int]]):
+        self.built = time.time()
+        adjacency: Dict[int, Set[int]] = {n: set() for n in neighbors}
+        for node_id, others in neighbors.items():
+            for other in others:
+                if other == node_id:
+                    continue
+                adjacency[node_id].add(other)
+                adjacency.setdefault(other, set()).add(node_id)
+        self.adjacency: Dict[int, List[int]] = \
+            {n: sorted(adjacency[n]) for n in sorted(adjacency)}
+        self.degree: Dict[int, int] = \
+            {n: len(others) for n, others in self.adjacency.items()}
+        self.hops: Dict[int, Dict[int, int]] = \
+            {n: self._bfs(n) for n in self.adjacency}
+        self.articulation_points: List[int] = self._articulation_points()
+        self._articulation_set = set(self.articulation_points)
+        self.encoded: bytes = encode(self.to_dict())
+
+    def _bfs(self, start: int) -> Dict[int, int]:
+        hops = {start: 0}
+        queue = deque([start])
+        while queue:
+            node_id = queue.popleft()
+            for other in self.adjacency[node_id]:
+                if other not in hops:
+                    hops[other] = hops[node_id] + 1
+                    queue.append(other)
+        return hops
+
+    def _articulation_points(self) -> List[int]:
+        # Hopcroft-Tarjan, iteratively: a mesh can be deep enough to run
+        # into python's recursion limit.
+        disc: Dict[int, int] = {}
+        low: Dict[int, int] = {}
+        points: Set[int] = set()
+        counter = 0
+        for root in self.adjacency:
+            if root in disc:
+                continue
+            disc[root] = low[root] = counter
+            counter += 1
+            root_children = 0
+            stack = [(root, None, iter(self.adjacency[root]))]
+            while stack:
+                node_id, parent, others = stack[-1]
+                for other in others:
+                    if other == parent:
+                        continue
+                    if other in disc:
+                        low[node_id] = min(low[node_id], disc[other])
+                        continue
+                    disc[other] = low[other] = counter
+                    counter += 1
+                    if node_id == root:
+                        root_children += 1
+                    stack.append((other, node_id,
+                                  iter(self.adjacency[other])))
+                    break
+                else:
+                    stack.pop()
+                    if parent is None:
+                        continue
+                    low[parent] = min(low[parent], low[node_id])
+                    if parent != root and low[node_id] >= disc[parent]:
+                        points.add(parent)
+            if root_children > 1:
+                points.add(root)
+        return sorted(points)
+
+    def has_node(self, node_id: int) -> bool:
+        return node_id in self.adjacency
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'built': self.built,
+            'nodes': len(self.adjacency),
+            'neighbors': self.adjacency,
+            'degree': self.degree,
+            'hops': self.hops,
+            'articulation_points': self.articulation_points
+        }
+
+    def node_to_dict(self, node_id: int) -> Dict[str, Any]:
+        return {
+            'built': self.built,
+            'node_id': node_id,
+            'neighbors': self.adjacency[node_id],
+            'degree': self.degree[node_id],
+            'hops': self.hops[node_id],
+            'is_articulation_point': node_id in self._articulation_set
+        }
+
+    """
+        Build a graph out of the nodes' neighbor lists.
+    """
+    @classmethod
+    def obtain(cls, nodes: Dict[int, Any]) -> 'NeighborGraph':
+        start = time.perf_counter()
+        neighbors = {}
+        read_neighbors = histogram('ozw.read_neighbors')
+        for node_id, node in list(nodes.items()):
+            try:
+                with read_neighbors.time():
+                    neighbors[node_id] = list(node.neighbors or [])
+            except Exception as e:
+                logger.error(f"unable to obtain neighbors of node "
+                             f"{node_id}: {e}")
+                neighbors[node_id] = []
+        graph = cls(neighbors)
+        logger.info("built neighbor graph of {} nodes in {:.3f}s".format(
+            len(graph.adjacency), time.perf_counter() - start))
+        return graph
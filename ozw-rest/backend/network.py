@@ -1,9 +1,18 @@
 import logging
 from pathlib import Path
 import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+from openzwave.controller import ZWaveController
 from openzwave.option import ZWaveOption
 from openzwave.network import ZWaveNetwork
+from pydispatch import dispatcher
+
+from . import sim
+from .jobs import Job, JobManager, JobTimeoutException
+from .neighbors import NeighborGraph
+from .timing import timed
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +32,26 @@ class TryAgainLaterException(NetworkException):
 class NetworkNotReadyException(NetworkException):
     pass
 
+class ControllerCommandException(NetworkException):
+    pass
+
+
+# controller command states after which there's nothing else coming.
+COMMAND_FINAL_STATES = [
+    ZWaveController.STATE_COMPLETED,
+    ZWaveController.STATE_FAILED,
+    ZWaveController.STATE_ERROR,
+    ZWaveController.STATE_CANCEL,
+    ZWaveController.STATE_NODEOK,
+    ZWaveController.STATE_NODEFAILED
+]
+COMMAND_SUCCESS_STATES = [
+    ZWaveController.STATE_COMPLETED,
+    ZWaveController.STATE_NODEOK
+]
+# what a heal reports for a node that got through its queries again.
+NODE_QUERIES_COMPLETE = 'NodeQueriesComplete'
+
 
 """
 We are defining the state as a series of booleans, mutually exclusive,
@@ -30,26 +59,30 @@ not for our benefit but for the consumer's. This way they don't have to
 have intimate knowledge of our internal representation for values, nor
 are they obligated to handle strings. They get a set of booleans and do
 whatever they wish with them.
+
+A NetworkState is never modified once created. When the network changes
+state, a new one is made, carrying the history of transitions that led
+to it, and replaces the old one wholesale. Whoever holds a reference to
+one holds a consistent view of the network's state at some point.
 """
 class NetworkState:
 
-    def __init__(self):
+    # how many transitions we remember.
+    max_history: int = 32
+
+    def __init__(self, state: int = None, state_str: str = None,
+                 timestamp: float = None, history: Tuple = ()):
+        self.state: int         = state
         self.is_stopped: bool   = False
         self.is_failed: bool    = False
         self.is_resetted: bool  = False
         self.is_started: bool   = False
         self.is_awake: bool     = False
         self.is_ready: bool     = False
-        self.state_str: str     = None
-        
-        
-    def update(self, network: ZWaveNetwork):
-        state = None
-        if network:
-            state = network.state
-        else:
-            self.is_stopped = True
-            return
+        self.state_str: str     = state_str
+        self.since: float       = timestamp if timestamp else time.time()
+        # (timestamp, state, state_str), oldest first.
+        self.history: Tuple     = history
 
         if not state or state == ZWaveNetwork.STATE_STOPPED:
             self.is_stopped = True
@@ -66,33 +99,185 @@ class NetworkState:
         else:
             self.is_stopped = True # assume default state is stopped.
 
-        self.state_str = network.state_str
+    def is_available(self) -> bool:
+        return self.is_ready or self.is_awake or self.is_started
+
+    """
+        Returns the state we'd be in after transitioning to 'state'; that
+        is, a new state, or this very one if nothing changed.
+    """
+    def transition(self, state: int, state_str: str) -> 'NetworkState':
+        if state == self.state and state_str == self.state_str:
+            return self
+        now = time.time()
+        history = self.history + ((now, state, state_str),)
+        return NetworkState(state, state_str, now,
+                            history[-self.max_history:])
 
     def to_dict(self):
-        return self.__dict__
+        return {
+            'is_stopped': self.is_stopped,
+            'is_failed': self.is_failed,
+            'is_resetted': self.is_resetted,
+            'is_started': self.is_started,
+            'is_awake': self.is_awake,
+            'is_ready': self.is_ready,
+            'state_str': self.state_str,
+            'since': self.since,
+            'history': [
+                {'timestamp': ts, 'state': st, 'state_str': st_str}
+                for ts, st, st_str in self.history
+            ]
+        }
 
     @classmethod
     def obtain(cls, network: ZWaveNetwork):
-        state = cls()
-        state.update(network)
-        return state
+        if not network:
+            return cls()
+        return cls(network.state, network.state_str)
 
 
 class NetworkController:
 
-    def __init__(self):
+    # seconds we give the controller to finish a command.
+    command_timeout: float = 60.0
+
+    # libopenzwave has the one Manager, and the one set of Options, per
+    # process, whatever python-openzwave makes it look like; stopping a
+    # network tears the Manager down, whoever else is on it. So only the
+    # one network may run off a real device at a time: this one.
+    driver_owner: Optional['NetworkController'] = None
+    driver_owner_lock = threading.Lock()
+
+    def __init__(self, name: str = 'default'):
+        # what we go by until we know the network's home id, if ever.
+        self.name = name
+        # the network's home id, once it told us; kept after it stops.
+        self.home_id: Optional[int] = None
         self.network = None
         self.network_device = None
         self.network_is_running = False
         self.network_is_starting = False
         self.network_is_stopping = False
         self.network_lock = threading.Lock()
+        # when set, we run against a simulated network instead of a device.
+        self.simulation: sim.SimConfig = None
+        # replaced, never modified; see NetworkState.
+        self.network_state = NetworkState()
+        self.network_state_lock = threading.Lock()
+        # long operations, be it on the network or the controller, are run
+        # as jobs, one at a time.
+        self.jobs = JobManager(f'ozw-jobs-{name}')
+        # the mesh, as last seen; rebuilt whenever it may have changed,
+        # replaced, never modified.
+        self.neighbor_graph: NeighborGraph = None
+        # nodes a running heal has got to, as the controller tells us.
+        self.healing: Set[int] = set()
+
+        for signal in [ZWaveNetwork.SIGNAL_NETWORK_STARTED,
+                       ZWaveNetwork.SIGNAL_NETWORK_AWAKED,
+                       ZWaveNetwork.SIGNAL_NETWORK_READY,
+                       ZWaveNetwork.SIGNAL_NETWORK_FAILED,
+                       ZWaveNetwork.SIGNAL_NETWORK_RESETTED,
+                       ZWaveNetwork.SIGNAL_NETWORK_STOPPED]:
+            dispatcher.connect(self.handle_network_event, signal)
+
+
+    def get_network_state(self) -> NetworkState:
+        return self.network_state
+
+    def _set_network_state(self, state: int = None, state_str: str = None,
+                           network: ZWaveNetwork = None):
+        with self.network_state_lock:
+            # read it under the lock, lest we go back to an older state.
+            if network:
+                state, state_str = network.state, network.state_str
+                if network.home_id:
+                    self.home_id = network.home_id
+            new_state = self.network_state.transition(state, state_str)
+            if new_state is self.network_state:
+                return
+            self.network_state = new_state
+        logger.info(f"network state: {state_str}")
 
+    """
+        Keeps our state in step with the network's. Runs on openzwave's
+        notification thread, straight from the signal; it's cheap enough.
+    """
+    def handle_network_event(self, signal, **kwargs):
+        network = kwargs.get('network')
+        if not self.owns(network):
+            return
+        self._set_network_state(network=network)
+
+    def set_name(self, name: str):
+        self.name = name
+        self.jobs.name = f'ozw-jobs-{name}'
+
+    """
+        Whether a signal, from 'network', about 'node' or 'value', is ours.
+        Each controller only ever handles its own network's signals. With
+        only the one real network (see 'driver_owner'), whatever reaches
+        it is its own; the rest are simulated, and only ever hear from
+        their own.
+    """
+    def owns(self, network, node=None, value=None) -> bool:
+        if network is None or network is not self.network:
+            return False
+        if not self.home_id:
+            return True
+        for obj in (value, node):
+            home_id = getattr(obj, 'home_id', None)
+            if home_id and home_id != self.home_id:
+                return False
+        return True
 
-    def get_network_state(self):
-        return NetworkState.obtain(self.network)
+    """
+        Take libopenzwave's Manager for ourselves, if no one else has it.
+        Simulated networks don't need it.
+    """
+    def _claim_driver(self) -> bool:
+        cls = NetworkController
+        with cls.driver_owner_lock:
+            owner = cls.driver_owner
+            if owner is not None and owner is not self:
+                logger.error(f"unable to start network '{self.name}': "
+                             f"network '{owner.name}' runs off a device "
+                             f"already, and there's only the one driver")
+                return False
+            cls.driver_owner = self
+        return True
 
+    def _release_driver(self):
+        cls = NetworkController
+        with cls.driver_owner_lock:
+            if cls.driver_owner is self:
+                cls.driver_owner = None
 
+    """
+        What we go by: the network's home id, in hex, once we know it; our
+        name until then.
+    """
+    def get_key(self) -> str:
+        if self.home_id:
+            return f"{self.home_id:08x}"
+        return self.name
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'home_id': self.get_key() if self.home_id else None,
+            'server': {
+                'is_running': self.is_server_running(),
+                'is_starting': self.is_server_starting(),
+                'is_stopping': self.is_server_stopping(),
+                'device': self.get_device()
+            },
+            'network': self.get_network_state().to_dict()
+        }
+
+
+    @timed('network.start')
     def _ozw_start(self):
 
         logger.info("starting ozw network")
@@ -107,8 +292,19 @@ class NetworkController:
 
         self.network_is_starting = True
         self.network_is_running = True
+        option_cls, network_cls = ZWaveOption, ZWaveNetwork
+        if self.simulation:
+            option_cls, network_cls = sim.SimOption, sim.SimNetwork
+        elif not self._claim_driver():
+            self.network_is_starting = False
+            self.network_is_running = False
+            self.network_lock.release()
+            return False
+
         try:
-            options = ZWaveOption(self.network_device)
+            options = option_cls(self.network_device)
+            if self.simulation:
+                options.config = self.simulation
             options.set_log_file('ozw-rest.ozw.log')
             options.set_append_log_file(True)
             options.set_console_output(False)
@@ -116,16 +312,23 @@ class NetworkController:
             options.lock()
         except Exception as e:
             logger.error("unable to start network: {}".format(e))
+            self._release_driver()
+            self.network_is_starting = False
             self.network_is_running = False
-            self.network_is_running = False
+            self.network_lock.release()
             return False
 
-        self.network = ZWaveNetwork(options, autostart=True)
+        # hold on to it before it starts, so we know its signals for ours
+        # right from the first one.
+        self.network = network_cls(options, autostart=False)
+        self.network.start()
+        self._set_network_state(network=self.network)
         self.network_is_starting = False
         logger.info("started z-wave network")
         self.network_lock.release()
         pass
 
+    @timed('network.stop')
     def _ozw_stop(self):
         logger.info("stopping ozw network")
 
@@ -144,9 +347,11 @@ class NetworkController:
 
         self.network_is_stopping = True
         self.network.stop()
+        self._release_driver()
         self.network_is_stopping = False
         self.network_is_running = False
         self.network = None
+        self._set_network_state(ZWaveNetwork.STATE_STOPPED, 'Network stopped')
         logger.info("stopped z-wave network")
         self.network_lock.release()
 
@@ -174,14 +379,13 @@ class NetworkController:
         # (say, ttyACM0) while the "new" device is now living on with a new
         # name (say, ttyACM1).
         #
-        # At the moment we won't support multiple devices because
+        # We won't guess when there's more than one stick because
         #   1) we have no idea how to differentiate a real device
         #      from an artifact;
-        #   2) we really don't want to ask the user to tell us.
+        #   2) we have no idea which stick is which network.
         #
-        # For now this works for our intended purposes, as we only
-        # have one device and shows as an ACM. once we get our hands
-        # on a second controller, we can play a bit more with this.
+        # Not that we could run more than one network off a device anyway
+        # (see 'driver_owner').
         self.network_device = str(potential_matches[-1])
         logger.info(f"found potential candidate: {self.network_device}")
         return True
@@ -198,34 +402,39 @@ class NetworkController:
         if self.is_server_running():
             raise NetworkRunningException("can't start a running network")
 
-        if not self.network_device:
+        if not self.network_device and self.simulation:
+            self.network_device = 'simulated'
+        elif not self.network_device:
             logger.info("attempt to find best candidate device!")
             if not self._find_best_device():
                 raise DeviceNotSetException(
                     "can't start network without a device")
 
-        if self.is_server_starting():
-            # someone else is already doing the same, leave.
-            return True
-
         if self.is_server_stopping():
             raise TryAgainLaterException("network being stopped")
 
-        thread = threading.Thread(target=self._ozw_start)
-        thread.start()
-        return True
-        
+        # if someone else is already starting it, we join them.
+        return self.jobs.submit('network_start', self._start_job,
+                                key='network_start')
+
+    def _start_job(self, job: Job):
+        if self._ozw_start() is False:
+            raise NetworkException("unable to start network")
 
-    def stop(self):
+    def stop(self) -> Job:
 
         logger.info("stopping z-wave network")
-        thread = threading.Thread(target=self._ozw_stop)
-        thread.start()
-        return True
+        # whatever the controller was up to, it won't be finishing it.
+        self.jobs.cancel_all(kinds=self.controller_job_kinds)
+        return self.jobs.submit('network_stop', lambda job: self._ozw_stop(),
+                                key='network_stop')
 
-    def restart(self):
+    def restart(self) -> Job:
         self.stop()
-        self.start()
+        # queued behind the stop; checking whether we're running makes no
+        # sense until then.
+        return self.jobs.submit('network_start', self._start_job,
+                                key='network_start')
 
     def set_device(self, device: str):
         netdev_path = Path('/dev') / device
@@ -240,6 +449,15 @@ class NetworkController:
         assert not self.network
         self.network_device = str(netdev_path)
 
+    def set_simulation(self, config: sim.SimConfig):
+        if self.network_is_running:
+            raise NetworkRunningException(
+                "can't set simulation while network is running")
+        self.simulation = config
+
+    def is_simulated(self):
+        return self.simulation is not None
+
     def get_device(self):
         return self.network_device if self.network_device else ''
 
@@ -257,30 +475,43 @@ class NetworkController:
             not self.is_server_starting() and not self.is_server_stopping()
 
     def is_ready(self):
-        return self.get_network_state().is_ready
+        return self.network_state.is_ready
 
     def is_stopped(self):
-        return self.get_network_state().is_stopped
+        return self.network_state.is_stopped
 
     def is_started(self):
-        return self.get_network_state().is_started
+        return self.network_state.is_started
 
     def is_awake(self):
-        return self.get_network_state().is_awake
+        return self.network_state.is_awake
 
     def is_available(self):
-        return self.is_ready() or self.is_awake() or self.is_started()
+        return self.network_state.is_available()
+
+    """
+        Whether the network is there for the asking, without raising nor
+        saying why not.
+    """
+    def is_network_available(self):
+        return self.is_server_running() and self.is_available() and \
+            self.network is not None
 
     def get_controller(self):
         if not self.is_server_running():
             raise NetworkRunningException("network is not running")
-        if not self.is_available():
+        # we may know it's started before we get hold of it.
+        if not self.is_available() or not self.network:
             raise NetworkNotReadyException("network hasn't started yet")
         assert self.network
         return self.network.controller
 
-    @property
-    def nodes(self):
+    """
+        Raise if the network is not in a state where its nodes can be
+        obtained. Shared by whoever needs to know whether the nodes are
+        there, without necessarily wanting the nodes themselves.
+    """
+    def check_available(self):
         if not self.is_server_running():
             logger.info("nodes > server not running!")
             server_state = {
@@ -296,23 +527,241 @@ class NetworkController:
             logger.info(" net state: {}".format(state))
             assert(self.is_stopped())
             raise NetworkRunningException("network is not running")
-    
-        if self.is_available():
-            assert self.network
-            assert self.is_server_running()
-            return self.network.nodes
-        else:
+
+        if not self.is_available() or not self.network:
             logger.info("nodes > can't obtain nodes yet!")
             logger.info(" net state: {}".format(
                 self.get_network_state().to_dict()))
             raise NetworkNotReadyException("network is not ready yet")
+
+    @property
+    def nodes(self):
+        self.check_available()
+        assert self.network
+        assert self.is_server_running()
+        return self.network.nodes
     
 
-    def heal(self):
+    controller_job_kinds = ['heal', 'add_node', 'remove_node',
+                            'update_neighbors', 'refresh']
+
+    """
+        Controller operations. Each one checks whether it can be done at
+        all, raising if not, and then returns a job doing it; none of them
+        wait for the controller.
+    """
+    def heal(self) -> Job:
         if not self.is_server_running():
             raise NetworkRunningException("network is not running")
         if not (self.is_ready() or self.is_awake()):
             raise NetworkNotReadyException("network hasn't started yet")
         assert self.network
-        self.network.heal(upNodeRoute=False)
+        return self.jobs.submit('heal', self._heal_job, key='heal',
+                                on_cancel=self._cancel_command)
+
+    def add_node(self, secure: bool = False) -> Job:
+        self.get_controller()
+        return self.jobs.submit('add_node', self._add_node_job,
+                                key='add_node', params={'secure': secure},
+                                on_cancel=self._cancel_command)
+
+    def remove_node(self) -> Job:
+        self.get_controller()
+        return self.jobs.submit('remove_node', self._remove_node_job,
+                                key='remove_node',
+                                on_cancel=self._cancel_command)
+
+    def update_neighbors(self, node_id: int = None) -> Job:
+        self.check_available()
+        target = node_id if node_id is not None else 'all'
+        return self.jobs.submit('update_neighbors',
+                                self._update_neighbors_job,
+                                key=f"update_neighbors-{target}",
+                                params={'node_id': node_id},
+                                on_cancel=self._cancel_command)
+
+    def refresh(self, node_id: int = None) -> Job:
+        self.check_available()
+        target = node_id if node_id is not None else 'all'
+        return self.jobs.submit('refresh', self._refresh_job,
+                                key=f"refresh-{target}",
+                                params={'node_id': node_id})
+
+    def get_job(self, job_id: int) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def get_jobs(self) -> List[Job]:
+        return self.jobs.get_jobs()
+
+    def cancel_job(self, job_id: int) -> Optional[Job]:
+        return self.jobs.cancel(job_id)
+
+    """
+        Feed a controller command notification to whichever job is
+        waiting on the controller. Cheap enough to be called from the
+        notification thread.
+    """
+    def handle_controller_command(self, **kwargs):
+        cmd_state = kwargs.get('state')
+        job = self.jobs.current
+        if job and job.kind == 'heal' and kwargs.get('node_id') is not None:
+            self.healing.add(kwargs['node_id'])
+        self.jobs.report(
+            cmd_state in COMMAND_FINAL_STATES,
+            state=cmd_state,
+            is_success=cmd_state in COMMAND_SUCCESS_STATES,
+            node_id=kwargs.get('node_id'),
+            message=kwargs.get('state_full'),
+            error=kwargs.get('error'))
+
+    """
+        A node got through its queries. Only a heal cares: that's how
+        openzwave tells us a node is done with it, once it got its new
+        neighbors. Nodes the heal hasn't got to yet are only being
+        interviewed, say after waking up; that's no news for the heal.
+    """
+    def handle_node_queries_complete(self, node_id: int):
+        job = self.jobs.current
+        if job and job.kind == 'heal' and node_id in self.healing:
+            job.report(True, state=NODE_QUERIES_COMPLETE, is_success=True,
+                       node_id=node_id, message=None, error=None)
+
+    def _cancel_command(self):
+        if self.network:
+            self.network.controller.cancel_command()
+
+    def _run_command(self, job: Job, command, *args):
+        job.expect_report()
+        if not command(*args):
+            raise ControllerCommandException("controller refused command")
+        try:
+            report = job.wait_for_report(self.command_timeout)
+        except JobTimeoutException:
+            self._cancel_command()
+            raise
+        return report
+
+    """
+        Build the neighbor graph anew, out of the nodes' current neighbor
+        lists. Called once the network is ready, and after whatever might
+        have changed the mesh.
+    """
+    def rebuild_neighbor_graph(self) -> Optional[NeighborGraph]:
+        network = self.network
+        if not network:
+            return None
+        self.neighbor_graph = NeighborGraph.obtain(network.nodes)
+        return self.neighbor_graph
+
+    def clear_neighbor_graph(self):
+        self.neighbor_graph = None
+
+    def get_neighbor_graph(self) -> NeighborGraph:
+        graph = self.neighbor_graph
+        if graph is None:
+            self.check_available()
+            graph = self.rebuild_neighbor_graph()
+        return graph
+
+    def _get_job_nodes(self, job: Job) -> List[int]:
+        node_id = job.params.get('node_id')
+        nodes = self.nodes
+        if node_id is None:
+            return sorted(nodes.keys())
+        if node_id not in nodes:
+            raise NetworkException(f"node {node_id} not found")
+        return [node_id]
+
+    """
+        A heal only asks the controller to get going; it then has each
+        node update its neighbors in turn, reporting on each through
+        controller command notifications, and queries the node again.
+        We're done once every node's been heard from, or nothing's been
+        heard for 'command_timeout'.
+    """
+    def _heal_job(self, job: Job):
+        controller_id = self.get_controller().node_id
+        node_ids = [n for n in self._get_job_nodes(job) if n != controller_id]
+        results: Dict[int, str] = {}
+        job.set_steps(0, len(node_ids))
+        job.expect_report()
+        self.healing = set()
+        try:
+            if not self.network.heal(upNodeRoute=False):
+                raise ControllerCommandException(
+                    "controller refused command")
+            self._wait_for_heal(job, node_ids, results)
+        finally:
+            self.healing = set()
+        # the mesh only changed if some node got through; otherwise the
+        # graph we have is as good as any.
+        if results:
+            self.rebuild_neighbor_graph()
+        for node_id in node_ids:
+            results.setdefault(node_id, 'NoAnswer')
+        return results
+
+    def _wait_for_heal(self, job: Job, node_ids: List[int],
+                       results: Dict[int, str]):
+        while len(results) < len(node_ids):
+            try:
+                report = job.wait_for_report(self.command_timeout)
+            except JobTimeoutException:
+                logger.warning(f"heal: no word from nodes "
+                               f"{[n for n in node_ids if n not in results]}"
+                               f" after {self.command_timeout}s")
+                break
+            node_id = report.get('node_id')
+            if node_id not in node_ids:
+                continue
+            # the neighbor update's outcome beats the queries that follow.
+            if node_id not in results or \
+               results[node_id] == NODE_QUERIES_COMPLETE:
+                results[node_id] = report['state']
+            job.set_steps(len(results))
+
+    def _add_node_job(self, job: Job):
+        controller = self.get_controller()
+        report = self._run_command(job, controller.add_node,
+                                   job.params['secure'])
+        if not report['is_success']:
+            raise ControllerCommandException(
+                f"unable to add node: {report['state']}")
+        self.rebuild_neighbor_graph()
+        return report['node_id']
+
+    def _remove_node_job(self, job: Job):
+        controller = self.get_controller()
+        report = self._run_command(job, controller.remove_node)
+        if not report['is_success']:
+            raise ControllerCommandException(
+                f"unable to remove node: {report['state']}")
+        self.rebuild_neighbor_graph()
+        return report['node_id']
+
+    def _update_neighbors_job(self, job: Job):
+        node_ids = self._get_job_nodes(job)
+        controller = self.get_controller()
+        results = {}
+        job.set_steps(0, len(node_ids))
+        for i, node_id in enumerate(node_ids):
+            # a node failing to update doesn't fail the others.
+            try:
+                report = self._run_command(
+                    job, controller.request_node_neighbor_update, node_id)
+                results[node_id] = report['state']
+            except ControllerCommandException as e:
+                results[node_id] = str(e)
+            job.set_steps(i + 1)
+        self.rebuild_neighbor_graph()
+        return results
+
+    def _refresh_job(self, job: Job):
+        node_ids = self._get_job_nodes(job)
+        nodes = self.nodes
+        job.set_steps(0, len(node_ids))
+        for i, node_id in enumerate(node_ids):
+            if node_id in nodes:
+                nodes[node_id].refresh_info()
+            job.set_steps(i + 1)
         
\ No newline at end of file
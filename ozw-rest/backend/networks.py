@@ -0,0 +1,196 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import sim
+from .jobs import Job
+from .state import State, StateException, state
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Every network we run, each with a State of its own: its own network
+controller (and job thread), ingestion thread, snapshot and so on.
+Networks don't know about each other; only signals from a State's own
+network are handled by it.
+
+Only one of them may run off a controller stick, though; the rest must be
+simulated. libopenzwave has the one Manager per process, which every
+python-openzwave network takes for its own, and tears down on stopping.
+Until networks share it, driver by driver, a second stick is refused.
+
+Networks are known by name, as configured, and by home id once they've
+started and told us. The first network is the one the plain '/api/...'
+routes serve, as they did when there was only ever one.
+
+Node ids are only unique within a network; across networks, nodes go by
+'<network key>:<node id>' (see 'node_key()'), where the network key is
+the home id, in hex, or the name if we don't know the home id yet.
+"""
+
+
+class NetworksException(StateException):
+    pass
+
+class UnknownNetworkException(NetworksException):
+    pass
+
+class DuplicateNetworkException(NetworksException):
+    pass
+
+class TooManyDevicesException(NetworksException):
+    pass
+
+
+def node_key(network: State, node_id: int) -> str:
+    return f"{network.get_key()}:{node_id}"
+
+
+def parse_node_key(key: str) -> Tuple[str, int]:
+    network_key, sep, node_id = key.rpartition(':')
+    if not sep or not network_key:
+        raise ValueError(f"malformed node key '{key}'")
+    return network_key, int(node_id)
+
+
+class Networks:
+
+    def __init__(self, default: State, max_workers: int = 8):
+        self.states: Dict[str, State] = OrderedDict()
+        self.states[default.name] = default
+        self.lock = threading.Lock()
+        # fans requests out to every network at once.
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='ozw-fanout')
+
+    """
+        Add a network, run off 'device' or simulated as 'simulation'.
+        Unlike with a single network, the device is not guessed.
+    """
+    def add(self, name: str, device: Optional[str] = None,
+            simulation: Optional[sim.SimConfig] = None) -> State:
+        if not device and not simulation:
+            raise NetworksException(f"network '{name}' needs a device")
+        with self.lock:
+            if name in self.states:
+                raise DuplicateNetworkException(
+                    f"network '{name}' already exists")
+            network = State(name)
+            self._configure(network, device, simulation)
+            self.states[name] = network
+        logger.info(f"added network '{name}'")
+        return network
+
+    """
+        Give the default network a name, and maybe a device, as configured.
+    """
+    def configure_default(self, name: str, device: Optional[str] = None,
+                          simulation: Optional[sim.SimConfig] = None
+                          ) -> State:
+        with self.lock:
+            default = self.get_default()
+            if name != default.name and name in self.states:
+                raise DuplicateNetworkException(
+                    f"network '{name}' already exists")
+            self._configure(default, device, simulation)
+            del self.states[default.name]
+            default.get_network_controller().set_name(name)
+            default.ingest.name = f'ozw-ingest-{name}'
+            self.states[name] = default
+            self.states.move_to_end(name, last=False)
+        return default
+
+    def _configure(self, network: State, device: Optional[str],
+                   simulation: Optional[sim.SimConfig]):
+        netctrl = network.get_network_controller()
+        if simulation:
+            netctrl.set_simulation(simulation)
+            return
+        # without a device, it'll find one when started.
+        for other in self.states.values():
+            if other is not network and \
+               not other.get_network_controller().is_simulated():
+                raise TooManyDevicesException(
+                    f"network '{other.name}' runs off a device already; "
+                    f"only one network may, the rest must be simulated")
+        if device:
+            netctrl.set_device(device)
+
+    def get_default(self) -> State:
+        return next(iter(self.states.values()))
+
+    def get_all(self) -> List[State]:
+        return list(self.states.values())
+
+    """
+        The network going by 'key': its name, or its home id, in hex, with
+        or without '0x'.
+    """
+    def get(self, key: str) -> State:
+        networks = self.get_all()
+        for network in networks:
+            if network.name == key:
+                return network
+        try:
+            home_id = int(key, 16)
+        except ValueError:
+            home_id = None
+        for network in networks:
+            if home_id is not None and \
+               network.get_network_controller().home_id == home_id:
+                return network
+        raise UnknownNetworkException(f"unknown network '{key}'")
+
+    """
+        Jobs are numbered across networks; whichever has it.
+    """
+    def find_job(self, job_id: int) -> Optional[Job]:
+        for network in self.get_all():
+            job = network.get_network_controller().get_job(job_id)
+            if job:
+                return job
+        return None
+
+    def cancel_job(self, job_id: int) -> Optional[Job]:
+        for network in self.get_all():
+            netctrl = network.get_network_controller()
+            if netctrl.get_job(job_id):
+                return netctrl.cancel_job(job_id)
+        return None
+
+    def get_jobs(self) -> List[Job]:
+        jobs = []
+        for network in self.get_all():
+            jobs.extend(network.get_network_controller().get_jobs())
+        return sorted(jobs, key=lambda job: job.id)
+
+    """
+        Call 'fn' on every network, all at once, and wait for them all.
+        Returns what each returned, and what each raised, keyed by network
+        key.
+    """
+    def fan_out(self, fn: Callable[[State], Any]
+                ) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        networks = self.get_all()
+        futures = [(network, self.executor.submit(fn, network))
+                   for network in networks]
+        results = OrderedDict()
+        errors = OrderedDict()
+        for network, future in futures:
+            try:
+                results[network.get_key()] = future.result()
+            except Exception as e:
+                errors[network.get_key()] = e
+        return results, errors
+
+    def shutdown(self):
+        for network in self.get_all():
+            network.shutdown()
+        self.executor.shutdown(wait=False)
+
+
+networks = Networks(state)
@@ -1,3 +1,4 @@
+import copy
 import typing
 
 
@@ -5,6 +6,27 @@ class NodeInfoSimple:
     node_id: int
     product_name: str
     node_type: str
+    role: str
     state: str
     proto_stage: str
     capabilities: []
+    # whether this is what we remember, rather than what we've seen.
+    is_stale: bool
+
+    def __init__(self):
+        self.is_stale = False
+
+    def as_stale(self) -> 'NodeInfoSimple':
+        info = copy.copy(self)
+        info.is_stale = True
+        return info
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, d: typing.Dict[str, typing.Any]):
+        info = cls()
+        for k, v in d.items():
+            setattr(info, k, v)
+        return info
@@ -0,0 +1,121 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, List, Optional
+
+from .snapshot import SnapshotStore
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Keeps a copy of the node snapshot on disk, so we have something to serve
+right after starting, long before the network is done with its interview.
+
+The snapshot is written as gzip'ed json, on shutdown and at regular
+checkpoints in between -- but only if something changed since the last
+time. Writes go to a temporary file first, which then replaces the old
+one, so a crash mid-write never leaves us with half a snapshot.
+"""
+
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotPersister:
+
+    def __init__(self, snapshot: SnapshotStore, path: str,
+                 interval: float = 300.0):
+        self.snapshot = snapshot
+        self.path = Path(path)
+        # seconds between checkpoints.
+        self.interval = interval
+        self.saved_generation: Optional[int] = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread: threading.Thread = None
+        self.is_running = False
+        # whatever else should be saved along with the snapshot.
+        self.also_save: List[Callable[[], Any]] = []
+
+    """
+        Load whatever was last saved into the snapshot. Returns whether
+        there was anything to load.
+    """
+    def load(self) -> bool:
+        if not self.path.exists():
+            return False
+        start = time.perf_counter()
+        try:
+            with gzip.open(self.path, 'rt') as f:
+                dumped = json.load(f)
+            if dumped.get('version') != SNAPSHOT_VERSION:
+                logger.info(f"ignoring snapshot version "
+                            f"{dumped.get('version')} at {self.path}")
+                return False
+            self.snapshot.restore(dumped)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"unable to load snapshot from {self.path}: {e}")
+            return False
+        self.saved_generation = self.snapshot.generation
+        logger.info("loaded {} nodes from {} in {:.3f}s".format(
+            len(dumped['nodes']), self.path, time.perf_counter() - start))
+        return True
+
+    """
+        Save the snapshot, unless nothing changed since we last did.
+        Returns whether we saved it.
+    """
+    def save(self, force: bool = False) -> bool:
+        with self.lock:
+            generation = self.snapshot.generation
+            if not force and generation == self.saved_generation:
+                return False
+            dumped = self.snapshot.dump()
+            dumped['version'] = SNAPSHOT_VERSION
+            dumped['saved'] = time.time()
+
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            try:
+                with gzip.open(tmp, 'wt') as f:
+                    json.dump(dumped, f, default=str)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.error(f"unable to save snapshot to {self.path}: {e}")
+                return False
+            self.saved_generation = dumped['generation']
+        logger.debug(f"saved {len(dumped['nodes'])} nodes to {self.path}")
+        return True
+
+    def _save_all(self):
+        self.save()
+        for save in self.also_save:
+            save()
+
+    def _run(self):
+        while self.is_running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self._save_all()
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='ozw-snapshot')
+        self.thread.start()
+
+    def stop(self):
+        if not self.is_running:
+            return
+        self.is_running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+        self._save_all()
@@ -0,0 +1,74 @@
+import collections
+import logging
+import sys
+import threading
+import time
+from typing import Dict
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+A sampling profiler, for when things are slow and we'd like to know why
+without restarting anything.
+
+Every 'interval' seconds, for as long as it runs, we take a look at what
+every other thread is doing, and count each stack seen. Results come out
+as collapsed stacks, one per line, 'thread;outer;...;inner count', as
+flame graph tools take them.
+
+Only one profile may be taken at a time. Nothing runs when no profile is
+being taken.
+"""
+
+
+class ProfilerBusyException(Exception):
+    pass
+
+
+class SamplingProfiler:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def _sample(self, stacks: collections.Counter, me: int):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                module = frame.f_globals.get('__name__', '?')
+                stack.append(f"{module}:{code.co_name}")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[';'.join(reversed(stack))] += 1
+
+    """
+        Sample every thread but the caller's for 'seconds'. Returns how
+        many times each stack was seen.
+    """
+    def run(self, seconds: float, interval: float = 0.005) -> Dict[str, int]:
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusyException("already profiling")
+        try:
+            logger.info(f"profiling for {seconds}s, every {interval}s")
+            stacks = collections.Counter()
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                self._sample(stacks, me)
+                time.sleep(interval)
+            return dict(stacks)
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def collapse(stacks: Dict[str, int]) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in
+                       sorted(stacks.items(), key=lambda s: -s[1]))
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,631 @@
+import logging
+import random
+import sys
+import threading
+import time
+import types
+import importlib.util
+from typing import Dict, List, Optional
+
+# requirement for catching events from openzwave lib
+from pydispatch import dispatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+A simulated z-wave network, standing in for libopenzwave's ZWaveNetwork,
+ZWaveNode and ZWaveValue, so we can run things without a stick plugged in.
+
+It only offers the surface we actually use, but it offers it with the same
+names, the same constants, and the same pydispatch signals; thus, handlers
+written against openzwave will work against this without knowing any
+better.
+
+This module must not import openzwave: it is meant to be usable on boxes
+where libopenzwave is not installed at all (see 'install()').
+"""
+
+
+class SimConfig:
+
+    def __init__(self,
+                 num_nodes: int = 10,
+                 values_per_node: int = 8,
+                 change_rate: float = 1.0,
+                 interview_delay: float = 0.0,
+                 product_id: str = '0x0060',
+                 command_delay: float = 0.05,
+                 home_id: int = 0xc0ffee,
+                 seed: Optional[int] = None):
+        # number of nodes, not counting the controller.
+        self.num_nodes = num_nodes
+        self.values_per_node = values_per_node
+        # value changes per second, network-wide. 0 means none, unless
+        # explicitly asked for via 'SimNetwork.tick()'.
+        self.change_rate = change_rate
+        # seconds each node takes to be interviewed on start.
+        self.interview_delay = interview_delay
+        self.product_id = product_id
+        # seconds between each step of a controller command.
+        self.command_delay = command_delay
+        # only matters when simulating more than one network.
+        self.home_id = home_id
+        self.seed = seed
+
+    """
+        Parse a config from a string in the form 'nodes=40,values=8,rate=10'.
+        Used so we can be told what to simulate through the environment.
+    """
+    @classmethod
+    def from_str(cls, spec: str):
+        keys = {
+            'nodes': ('num_nodes', int),
+            'values': ('values_per_node', int),
+            'rate': ('change_rate', float),
+            'interview': ('interview_delay', float),
+            'product': ('product_id', str),
+            'command': ('command_delay', float),
+            'home': ('home_id', lambda v: int(v, 0)),
+            'seed': ('seed', int)
+        }
+        config = cls()
+        for entry in spec.split(','):
+            entry = entry.strip()
+            if not entry or '=' not in entry:
+                continue
+            k, v = entry.split('=', 1)
+            if k not in keys:
+                raise ValueError(f"unknown simulation parameter '{k}'")
+            attr, conv = keys[k]
+            setattr(config, attr, conv(v))
+        return config
+
+
+# (label, units, genre, command class, initial value)
+_METER_VALUES = [
+    ('Energy', 'kWh', 'User', 0x32, 0.0),
+    ('Power', 'W', 'User', 0x32, 0.0),
+    ('Voltage', 'V', 'User', 0x32, 230.0),
+    ('Current', 'A', 'User', 0x32, 0.0),
+]
+_OTHER_VALUES = [
+    ('Switch', '', 'User', 0x25, True),
+    ('Report Interval', 'seconds', 'Config', 0x70, 300),
+    ('Library Version', '', 'System', 0x86, '3'),
+    ('Powerlevel', 'dB', 'System', 0x73, 'Normal'),
+]
+
+
+class SimValue:
+
+    def __init__(self, node, index: int, label: str, units: str,
+                 genre: str, command_class: int, data):
+        self.node = node
+        self.index = index
+        self.value_id = (node.node_id << 32) | index
+        self.label = label
+        self.units = units
+        self.genre = genre
+        self.command_class = command_class
+        self.data = data
+        self.type = type(data).__name__.capitalize()
+        self.instance = 1
+        self.is_read_only = genre == 'System'
+        self.is_write_only = False
+        self.is_polled = False
+
+    @property
+    def data_as_string(self):
+        return str(self.data)
+
+    @property
+    def home_id(self):
+        return self.node.home_id
+
+    def refresh(self):
+        self.node.network._send_value(
+            SimNetwork.SIGNAL_VALUE_REFRESHED, self.node, self)
+        return True
+
+    def to_dict(self, extras=['all']):
+        return {
+            'label': self.label,
+            'value_id': self.value_id,
+            'node_id': self.node.node_id,
+            'units': self.units,
+            'genre': self.genre,
+            'data': self.data,
+            'data_as_string': self.data_as_string,
+            'command_class': self.command_class,
+            'type': self.type,
+            'index': self.index,
+            'instance': self.instance,
+            'readonly': self.is_read_only,
+            'writeonly': self.is_write_only,
+            'is_polled': self.is_polled
+        }
+
+    def __str__(self):
+        return f"sim value {self.value_id} {self.label}={self.data}"
+
+
+class SimNode:
+
+    def __init__(self, network, node_id: int):
+        self.network = network
+        self.node_id = node_id
+        self.home_id = network.home_id
+        self.name = f"node-{node_id}"
+        self.location = ''
+        self.manufacturer_name = 'Simulated'
+        self.product_name = 'Simulated Smart Switch'
+        self.product_id = '0x0000'
+        self.product_type = '0x0003'
+        self.type = 'Binary Power Switch'
+        self.role = 'Always On Slave'
+        self.query_stage = 'None'
+        self.is_ready = False
+        self.is_awake = True
+        self.is_failed = False
+        self.is_zwave_plus = True
+        self.is_routing_device = True
+        self.is_security_device = False
+        self.is_beaming_device = True
+        self.is_listening_device = True
+        self.is_frequent_listening_device = False
+        self.neighbors = set()
+        self.values: Dict[int, SimValue] = {}
+
+    def refresh_info(self):
+        return True
+
+    def get_values(self, class_id='All', genre='All', type='All',
+                   readonly='All', writeonly='All', index='All',
+                   label='All'):
+        res = {}
+        for vid, value in self.values.items():
+            if class_id != 'All' and value.command_class != class_id:
+                continue
+            if genre != 'All' and value.genre != genre:
+                continue
+            if index != 'All' and value.index != index:
+                continue
+            if label != 'All' and value.label != label:
+                continue
+            res[vid] = value
+        return res
+
+    def get_values_by_command_classes(self, genre='All', type='All',
+                                      readonly='All', writeonly='All'):
+        res = {}
+        for vid, value in self.get_values(genre=genre).items():
+            res.setdefault(value.command_class, {})[vid] = value
+        return res
+
+    def to_dict(self, extras=['all']):
+        d = {
+            'node_id': self.node_id,
+            'home_id': self.home_id,
+            'name': self.name,
+            'location': self.location,
+            'manufacturer_name': self.manufacturer_name,
+            'product_name': self.product_name,
+            'product_id': self.product_id,
+            'product_type': self.product_type,
+            'type': self.type,
+            'role': self.role,
+            'query_stage': self.query_stage,
+            'is_ready': self.is_ready,
+            'is_awake': self.is_awake,
+            'is_failed': self.is_failed
+        }
+        if 'all' in extras or 'capabilities' in extras:
+            caps = {
+                'zwaveplus': self.is_zwave_plus,
+                'routing': self.is_routing_device,
+                'beaming': self.is_beaming_device,
+                'listening': self.is_listening_device
+            }
+            d['capabilities'] = set(c for c, v in caps.items() if v)
+        if 'all' in extras or 'neighbors' in extras:
+            d['neighbors'] = set(self.neighbors)
+        if 'all' in extras or 'values' in extras:
+            d['values'] = \
+                {vid: v.to_dict() for vid, v in self.values.items()}
+        return d
+
+    def __str__(self):
+        return f"sim node {self.node_id}"
+
+
+class SimController:
+
+    # as libopenzwave's; reported through SIGNAL_CONTROLLER_COMMAND.
+    STATE_NORMAL = 'Normal'
+    STATE_STARTING = 'Starting'
+    STATE_CANCEL = 'Cancel'
+    STATE_ERROR = 'Error'
+    STATE_WAITING = 'Waiting'
+    STATE_SLEEPING = 'Sleeping'
+    STATE_INPROGRESS = 'InProgress'
+    STATE_COMPLETED = 'Completed'
+    STATE_FAILED = 'Failed'
+    STATE_NODEOK = 'NodeOK'
+    STATE_NODEFAILED = 'NodeFailed'
+
+    def __init__(self, node: SimNode):
+        self.node = node
+        self.node_id = node.node_id
+        self.is_primary_controller = True
+        self.is_bridge_controller = False
+        self.is_static_update_controller = True
+        self.command_lock = threading.Lock()
+        self.command_cancelled = False
+
+    def _report(self, state: str, node_id: int = None):
+        network = self.node.network
+        network._send(network.SIGNAL_CONTROLLER_COMMAND,
+                      controller=self, node_id=node_id, state=state,
+                      state_full=f"simulated: {state}", error=None,
+                      error_full=None)
+
+    def _command(self, action, node_id: int = None) -> bool:
+        # one command at a time, as a real controller would have it.
+        if not self.command_lock.acquire(blocking=False):
+            return False
+        self.command_cancelled = False
+
+        def run():
+            delay = self.node.network.config.command_delay
+            final = self.STATE_CANCEL
+            target = node_id
+            try:
+                self._report(self.STATE_STARTING, target)
+                for state in [self.STATE_WAITING, self.STATE_INPROGRESS]:
+                    time.sleep(delay)
+                    if self.command_cancelled:
+                        return
+                    self._report(state, target)
+                time.sleep(delay)
+                # whatever node the command ended up being about.
+                target = action() or target
+                final = self.STATE_COMPLETED
+            finally:
+                # free for the next command by the time we say we're done.
+                self.command_lock.release()
+                self._report(final, target)
+
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    def add_node(self, doSecurity=False):
+        return self._command(self.node.network._add_node)
+
+    def remove_node(self):
+        return self._command(self.node.network._remove_node)
+
+    def request_node_neighbor_update(self, nodeid):
+        return self._command(lambda: None, nodeid)
+
+    def cancel_command(self):
+        self.command_cancelled = True
+        return True
+
+
+class SimOption:
+
+    def __init__(self, device: str = None, config_path: str = None,
+                 user_path: str = None, cmd_line: str = None,
+                 config: SimConfig = None):
+        self.device = device
+        self.config = config if config else SimConfig()
+
+    def set_log_file(self, logfile):
+        pass
+
+    def set_append_log_file(self, status):
+        pass
+
+    def set_console_output(self, status):
+        pass
+
+    def set_logging(self, status):
+        pass
+
+    def lock(self):
+        return True
+
+
+class SimNetwork:
+
+    # these match libopenzwave's, so both can be used interchangeably.
+    STATE_STOPPED = 0
+    STATE_FAILED = 1
+    STATE_RESETTED = 3
+    STATE_STARTED = 5
+    STATE_AWAKED = 7
+    STATE_READY = 10
+
+    SIGNAL_NETWORK_FAILED = 'NetworkFailed'
+    SIGNAL_NETWORK_STARTED = 'NetworkStarted'
+    SIGNAL_NETWORK_READY = 'NetworkReady'
+    SIGNAL_NETWORK_STOPPED = 'NetworkStopped'
+    SIGNAL_NETWORK_RESETTED = 'DriverResetted'
+    SIGNAL_NETWORK_AWAKED = 'DriverAwaked'
+    SIGNAL_DRIVER_FAILED = 'DriverFailed'
+    SIGNAL_DRIVER_READY = 'DriverReady'
+    SIGNAL_DRIVER_RESET = 'DriverReset'
+    SIGNAL_DRIVER_REMOVED = 'DriverRemoved'
+    SIGNAL_NODE = 'Node'
+    SIGNAL_NODE_ADDED = 'NodeAdded'
+    SIGNAL_NODE_EVENT = 'NodeEvent'
+    SIGNAL_NODE_NAMING = 'NodeNaming'
+    SIGNAL_NODE_NEW = 'NodeNew'
+    SIGNAL_NODE_PROTOCOL_INFO = 'NodeProtocolInfo'
+    SIGNAL_NODE_READY = 'NodeReady'
+    SIGNAL_NODE_REMOVED = 'NodeRemoved'
+    SIGNAL_VALUE = 'Value'
+    SIGNAL_VALUE_ADDED = 'ValueAdded'
+    SIGNAL_VALUE_CHANGED = 'ValueChanged'
+    SIGNAL_VALUE_REFRESHED = 'ValueRefreshed'
+    SIGNAL_VALUE_REMOVED = 'ValueRemoved'
+    SIGNAL_ESSENTIAL_NODE_QUERIES_COMPLETE = 'EssentialNodeQueriesComplete'
+    SIGNAL_NODE_QUERIES_COMPLETE = 'NodeQueriesComplete'
+    SIGNAL_AWAKE_NODES_QUERIED = 'AwakeNodesQueried'
+    SIGNAL_ALL_NODES_QUERIED = 'AllNodesQueried'
+    SIGNAL_ALL_NODES_QUERIED_SOME_DEAD = 'AllNodesQueriedSomeDead'
+    SIGNAL_NOTIFICATION = 'Notification'
+    SIGNAL_CONTROLLER_COMMAND = 'ControllerCommand'
+    SIGNAL_CONTROLLER_WAITING = 'ControllerWaiting'
+
+    _STATE_STR = {
+        STATE_STOPPED: 'Network stopped',
+        STATE_FAILED: 'Driver failed',
+        STATE_RESETTED: 'Driver reset',
+        STATE_STARTED: 'Driver initialised',
+        STATE_AWAKED: 'Topology loaded',
+        STATE_READY: 'Network ready'
+    }
+
+    def __init__(self, options: SimOption, autostart: bool = True):
+        self.options = options
+        self.config: SimConfig = getattr(options, 'config', SimConfig())
+        self.home_id = self.config.home_id
+        self.state = self.STATE_STOPPED
+        self.nodes: Dict[int, SimNode] = {}
+        # our own list of nodes, which we know no one else touches.
+        self.sim_nodes: List[SimNode] = []
+        self.controller: SimController = None
+        self.random = random.Random(self.config.seed)
+        self.lock = threading.Lock()
+        self.is_running = False
+        self.changes_thread: threading.Thread = None
+        if autostart:
+            self.start()
+
+    @property
+    def state_str(self):
+        return self._STATE_STR.get(self.state, 'Unknown')
+
+    @property
+    def nodes_count(self):
+        return len(self.nodes)
+
+    def _send(self, signal, **kwargs):
+        kwargs['network'] = self
+        dispatcher.send(signal, **kwargs)
+
+    def _send_value(self, signal, node: SimNode, value: SimValue):
+        self._send(signal, node=node, value=value)
+        self._send(self.SIGNAL_VALUE, node=node, value=value)
+
+    def _create_node(self, node_id: int) -> SimNode:
+        node = SimNode(self, node_id)
+        if node_id == 1:
+            node.product_name = 'Simulated Z-Stick'
+            node.type = 'Static PC Controller'
+            node.role = 'Central Controller'
+            return node
+
+        node.product_id = self.config.product_id
+        templates = _METER_VALUES + _OTHER_VALUES
+        for idx in range(self.config.values_per_node):
+            label, units, genre, cc, data = templates[idx % len(templates)]
+            if idx >= len(templates):
+                label = f"{label} {idx // len(templates)}"
+            value = SimValue(node, idx, label, units, genre, cc, data)
+            node.values[value.value_id] = value
+        return node
+
+    def _build_topology(self):
+        self.nodes = {}
+        for node_id in range(1, self.config.num_nodes + 2):
+            self.nodes[node_id] = self._create_node(node_id)
+        self.sim_nodes = list(self.nodes.values())
+        self.controller = SimController(self.nodes[1])
+
+        # a mostly-linear mesh, with the odd shortcut; enough for anything
+        # that wants to walk neighbors.
+        ids = sorted(self.nodes.keys())
+        for a, b in zip(ids, ids[1:]):
+            self.nodes[a].neighbors.add(b)
+            self.nodes[b].neighbors.add(a)
+        for node_id in ids[2::3]:
+            self.nodes[node_id].neighbors.add(1)
+            self.nodes[1].neighbors.add(node_id)
+
+    def _interview(self):
+        self._send(self.SIGNAL_DRIVER_READY,
+                   controller=self.controller, home_id=self.home_id,
+                   node_id=self.controller.node_id)
+        self.state = self.STATE_STARTED
+        self._send(self.SIGNAL_NETWORK_STARTED)
+
+        for node in self.sim_nodes:
+            if not self.is_running:
+                return
+            self._send(self.SIGNAL_NODE_ADDED, node=node)
+            for value in list(node.values.values()):
+                self._send_value(self.SIGNAL_VALUE_ADDED, node, value)
+            if self.config.interview_delay > 0:
+                time.sleep(self.config.interview_delay)
+            node.query_stage = 'Complete'
+            node.is_ready = True
+            self._send(self.SIGNAL_NODE_QUERIES_COMPLETE, node=node)
+
+        self.state = self.STATE_AWAKED
+        self._send(self.SIGNAL_NETWORK_AWAKED)
+        self.state = self.STATE_READY
+        self._send(self.SIGNAL_NETWORK_READY)
+
+        if self.config.change_rate > 0:
+            # stopped while interviewing, maybe; then there's no one to
+            # stop it.
+            with self.lock:
+                if not self.is_running:
+                    return
+                self.changes_thread = threading.Thread(
+                    target=self._changes_loop, daemon=True)
+                self.changes_thread.start()
+
+    def _changes_loop(self):
+        period = 1.0 / self.config.change_rate
+        while self.is_running:
+            self.tick()
+            time.sleep(period)
+
+    def _next_data(self, value: SimValue):
+        if value.units == 'kWh':
+            return value.data + self.random.uniform(0.0, 0.01)
+        elif value.units == 'W':
+            return max(0.0, value.data + self.random.uniform(-50.0, 50.0))
+        elif value.units == 'V':
+            return 230.0 + self.random.uniform(-5.0, 5.0)
+        elif value.units == 'A':
+            return max(0.0, value.data + self.random.uniform(-0.2, 0.2))
+        elif isinstance(value.data, bool):
+            return not value.data
+        return value.data
+
+    """
+        Synchronously change 'count' random values, sending the signals
+        libopenzwave would have sent. This is what the background thread
+        drives, but it can also be called directly so changes happen in a
+        deterministic, measurable fashion.
+    """
+    def tick(self, count: int = 1):
+        candidates = [n for n in self.sim_nodes if n.values]
+        if not candidates:
+            return
+        for _ in range(count):
+            node = self.random.choice(candidates)
+            value = self.random.choice(list(node.values.values()))
+            value.data = self._next_data(value)
+            self._send_value(self.SIGNAL_VALUE_CHANGED, node, value)
+
+    def start(self):
+        with self.lock:
+            if self.is_running:
+                return
+            self.is_running = True
+            self._build_topology()
+        thread = threading.Thread(target=self._interview, daemon=True)
+        thread.start()
+
+    def stop(self, fire=True):
+        with self.lock:
+            self.is_running = False
+            self.state = self.STATE_STOPPED
+            changes_thread, self.changes_thread = self.changes_thread, None
+        if changes_thread:
+            changes_thread.join()
+        if fire:
+            self._send(self.SIGNAL_NETWORK_STOPPED)
+
+    """
+        As openzwave's: each node updates its neighbors in turn, reporting
+        on it through the controller, then gets queried again.
+    """
+    def heal(self, upNodeRoute=False):
+        if self.state < self.STATE_AWAKED:
+            return False
+        controller = self.controller
+
+        def run():
+            delay = self.config.command_delay
+            for node in list(self.sim_nodes):
+                if node is controller.node or not self.is_running:
+                    continue
+                controller._report(controller.STATE_STARTING, node.node_id)
+                time.sleep(delay)
+                controller._report(controller.STATE_INPROGRESS, node.node_id)
+                time.sleep(delay)
+                controller._report(controller.STATE_COMPLETED, node.node_id)
+                self._send(self.SIGNAL_NODE_QUERIES_COMPLETE, node=node)
+
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    def _add_node(self):
+        with self.lock:
+            node = self._create_node(max(self.nodes.keys()) + 1)
+            node.is_ready = True
+            node.query_stage = 'Complete'
+            node.neighbors.add(1)
+            self.nodes[1].neighbors.add(node.node_id)
+            self.nodes[node.node_id] = node
+            self.sim_nodes = self.sim_nodes + [node]
+        self._send(self.SIGNAL_NODE_ADDED, node=node)
+        for value in list(node.values.values()):
+            self._send_value(self.SIGNAL_VALUE_ADDED, node, value)
+        self._send(self.SIGNAL_NODE_QUERIES_COMPLETE, node=node)
+        return node.node_id
+
+    def _remove_node(self):
+        with self.lock:
+            if len(self.sim_nodes) < 2:
+                return
+            node = self.sim_nodes[-1]
+            self.sim_nodes = self.sim_nodes[:-1]
+            del self.nodes[node.node_id]
+            for other in self.sim_nodes:
+                other.neighbors.discard(node.node_id)
+        self._send(self.SIGNAL_NODE_REMOVED, node=node)
+        return node.node_id
+
+    def write_config(self):
+        pass
+
+
+"""
+    Register this module as 'openzwave', so code doing 'from openzwave.x
+    import y' ends up with our simulated classes. Only does so if the real
+    library is not around, unless forced to. Installing again is a no-op.
+"""
+def install(force: bool = False) -> bool:
+    if getattr(sys.modules.get('openzwave'), 'simulated', False):
+        return True
+    if not force and importlib.util.find_spec('openzwave') is not None:
+        return False
+
+    mods = {
+        'openzwave.network': {'ZWaveNetwork': SimNetwork},
+        'openzwave.option': {'ZWaveOption': SimOption},
+        'openzwave.node': {'ZWaveNode': SimNode},
+        'openzwave.value': {'ZWaveValue': SimValue},
+        'openzwave.controller': {'ZWaveController': SimController},
+    }
+    pkg = types.ModuleType('openzwave')
+    pkg.__path__ = []
+    pkg.simulated = True
+    sys.modules['openzwave'] = pkg
+    for name, attrs in mods.items():
+        mod = types.ModuleType(name)
+        for k, v in attrs.items():
+            setattr(mod, k, v)
+        sys.modules[name] = mod
+        setattr(pkg, name.split('.')[1], mod)
+    logger.info("using simulated openzwave")
+    return True
@@ -0,0 +1,488 @@
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime as dt, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from openzwave.node import ZWaveNode
+from openzwave.value import ZWaveValue
+
+from .encoding import encode
+from .timing import timed
+from .node import NodeInfoSimple
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+A snapshot of a value, as last seen by us. The static bits (label, units,
+genre, command class) are read once, when the value is first seen; only
+the data is updated afterwards, on value changes.
+"""
+class ValueSnapshot:
+
+    def __init__(self):
+        self.value_id: int = None
+        self.node_id: int = None
+        self.label: str = None
+        self.units: str = None
+        self.genre: str = None
+        self.command_class: int = None
+        # which of a node's channels (endpoints) it's of, 1 unless it has
+        # more than one; and which of the command class's values it is.
+        self.instance: int = 1
+        self.index: int = 0
+        self.data: Any = None
+        # always UTC, and saying so: a naive one would be taken as local
+        # time by 'timestamp()'.
+        self.last_update: dt = None
+        # 'to_api()', encoded, for as long as the data stays the same.
+        self.encoded: bytes = None
+
+    def update(self, data: Any) -> bool:
+        changed = data != self.data
+        self.data = data
+        self.last_update = dt.now(timezone.utc)
+        if changed:
+            self.encoded = None
+        return changed
+
+    def to_list(self) -> List[Any]:
+        return [self.value_id, self.label, self.units, self.genre,
+                self.command_class, self.data,
+                self.last_update.timestamp() if self.last_update else None,
+                self.instance, self.index]
+
+    @classmethod
+    def from_list(cls, node_id: int, lst: List[Any]):
+        snap = cls()
+        snap.node_id = node_id
+        snap.value_id, snap.label, snap.units, snap.genre, \
+            snap.command_class, snap.data, last_update = lst[:7]
+        # saved before instances and indexes were kept, if not there.
+        if len(lst) > 7:
+            snap.instance, snap.index = lst[7:9]
+        if last_update is not None:
+            snap.last_update = dt.fromtimestamp(last_update, timezone.utc)
+        return snap
+
+    @classmethod
+    @timed('ozw.read_value')
+    def obtain(cls, value: ZWaveValue):
+        snap = cls()
+        snap.value_id = value.value_id
+        snap.node_id = value.node.node_id
+        snap.label = str(value.label)
+        snap.units = str(value.units)
+        snap.genre = str(value.genre).lower()
+        snap.command_class = value.command_class
+        snap.instance = value.instance
+        snap.index = value.index
+        snap.update(value.data)
+        return snap
+
+
+    def to_api(self) -> Dict[str, str]:
+        return {
+            'label': self.label,
+            'units': self.units,
+            'data': str(self.data),
+            'genre': self.genre
+        }
+
+    def to_api_bytes(self) -> bytes:
+        encoded = self.encoded
+        if encoded is None:
+            encoded = encode(self.to_api())
+            self.encoded = encoded
+        return encoded
+
+
+"""
+A node's info and its values. Values are indexed by genre, units and
+command class, so looking them up by any of those is a set lookup rather
+than a pass over all of them.
+"""
+class NodeSnapshot:
+
+    def __init__(self, info: NodeInfoSimple):
+        self.info: NodeInfoSimple = info
+        self.values: Dict[int, ValueSnapshot] = {}
+        self.generation: int = 0
+        self.by_genre: Dict[str, Set[int]] = {}
+        self.by_units: Dict[str, Set[int]] = {}
+        self.by_class: Dict[int, Set[int]] = {}
+        # (info, info encoded); infos are replaced, never changed, so it's
+        # good for as long as it's the same info.
+        self.info_encoded: Tuple[NodeInfoSimple, bytes] = None
+
+    def get_info_bytes(self) -> bytes:
+        info = self.info
+        cached = self.info_encoded
+        if cached and cached[0] is info:
+            return cached[1]
+        encoded = encode(info)
+        self.info_encoded = (info, encoded)
+        return encoded
+
+    def _indexes(self, vsnap: ValueSnapshot):
+        return [(self.by_genre, vsnap.genre),
+                (self.by_units, vsnap.units),
+                (self.by_class, vsnap.command_class)]
+
+    def add_value(self, vsnap: ValueSnapshot):
+        self.values[vsnap.value_id] = vsnap
+        for index, key in self._indexes(vsnap):
+            index.setdefault(key, set()).add(vsnap.value_id)
+
+    def remove_value(self, value_id: int) -> Optional[ValueSnapshot]:
+        vsnap = self.values.pop(value_id, None)
+        if not vsnap:
+            return None
+        for index, key in self._indexes(vsnap):
+            ids = index.get(key)
+            if ids is None:
+                continue
+            ids.discard(value_id)
+            if not ids:
+                del index[key]
+        return vsnap
+
+    def set_values(self, values: List[ValueSnapshot]):
+        self.values = {}
+        self.by_genre = {}
+        self.by_units = {}
+        self.by_class = {}
+        for vsnap in values:
+            self.add_value(vsnap)
+
+    def find_values(self, genre: str = None, units: str = None,
+                    command_class: int = None) -> List[ValueSnapshot]:
+        ids = None
+        for index, key in [(self.by_genre, genre),
+                           (self.by_units, units),
+                           (self.by_class, command_class)]:
+            if key is None:
+                continue
+            found = index.get(key, set())
+            ids = found if ids is None else ids & found
+        if ids is None:
+            return list(self.values.values())
+        return [self.values[vid] for vid in sorted(ids)]
+
+
+"""
+Secondary indexes over node infos: for each indexed attribute, which
+nodes have which value of it. Filtered queries intersect these sets,
+costing time in proportion to what's found rather than to how many nodes
+there are. String keys are kept lowercase, so lookups aren't case
+sensitive.
+
+Not thread-safe on its own; it's kept under the snapshot store's lock.
+"""
+class NodeIndex:
+
+    # index name -> the keys a node info is indexed under.
+    fields = {
+        'state': lambda info: [info.state],
+        'type': lambda info: [info.node_type],
+        'product': lambda info: [info.product_name],
+        'role': lambda info: [getattr(info, 'role', None)],
+        'capability': lambda info: [
+            k for k, v in (info.capabilities or {}).items() if v is True],
+    }
+
+    def __init__(self):
+        self.indexes: Dict[str, Dict[Any, Set[int]]] = \
+            {name: {} for name in self.fields}
+        # node id -> [(index name, key)], so it can be taken out again.
+        self.entries: Dict[int, List[Tuple[str, Any]]] = {}
+
+    @staticmethod
+    def normalize(key: Any) -> Any:
+        return key.lower() if isinstance(key, str) else key
+
+    def add(self, info: NodeInfoSimple):
+        self.remove(info.node_id)
+        entries = []
+        for name, keys_of in self.fields.items():
+            for key in keys_of(info):
+                if key is None:
+                    continue
+                key = self.normalize(key)
+                self.indexes[name].setdefault(key, set()).add(info.node_id)
+                entries.append((name, key))
+        self.entries[info.node_id] = entries
+
+    def remove(self, node_id: int):
+        for name, key in self.entries.pop(node_id, []):
+            ids = self.indexes[name].get(key)
+            if ids is None:
+                continue
+            ids.discard(node_id)
+            if not ids:
+                del self.indexes[name][key]
+
+    def clear(self):
+        self.indexes = {name: {} for name in self.fields}
+        self.entries = {}
+
+    def lookup(self, name: str, key: Any) -> Set[int]:
+        return self.indexes[name].get(self.normalize(key), set())
+
+    def get_keys(self, name: str) -> List[Any]:
+        return list(self.indexes[name].keys())
+
+
+"""
+In-memory view of every node in the network, kept up to date from the
+openzwave signals by whoever owns it (that being the State). Readers
+never touch libopenzwave; they get whatever was last seen.
+
+Node infos are replaced as a whole whenever the node changes, so a reader
+holding on to one will never see it half-updated.
+
+Every change bumps a store-wide generation counter, and stamps the node it
+concerns with it. Changes to node infos (as opposed to their values) also
+bump 'info_generation'. These only ever go up, even across clears, so they
+can be used to tell whether anything changed since a reader last looked.
+
+Nodes may be stale: what we remember of them from before the network was
+last up (see 'mark_stale()', and 'restore()'). They're served as they
+are, flagged as such, until we hear from them again.
+"""
+class SnapshotStore:
+
+    def __init__(self):
+        self.nodes: Dict[int, NodeSnapshot] = {}
+        self.lock = threading.Lock()
+        self.generation: int = 0
+        self.info_generation: int = 0
+        self.index = NodeIndex()
+
+    def _bump(self, snap: Optional[NodeSnapshot] = None,
+              info: bool = False):
+        # must be called with the lock held.
+        self.generation += 1
+        if snap:
+            snap.generation = self.generation
+        if info:
+            self.info_generation = self.generation
+
+    def clear(self):
+        with self.lock:
+            self.nodes = {}
+            self.index.clear()
+            self._bump(info=True)
+
+    def update_node(self, info: NodeInfoSimple,
+                    values: Optional[Dict[int, ZWaveValue]] = None):
+        node_id = info.node_id
+        with self.lock:
+            snap = self.nodes.get(node_id)
+            if not snap:
+                snap = NodeSnapshot(info)
+                self.nodes[node_id] = snap
+            snap.info = info
+            self.index.add(info)
+            self._bump(snap, info=True)
+            if values is None:
+                return
+            snap.set_values([ValueSnapshot.obtain(v) for v in values.values()])
+
+    """
+        Flag every node we have as stale, rather than dropping them; for
+        when we lose the network.
+    """
+    def mark_stale(self):
+        with self.lock:
+            for snap in self.nodes.values():
+                snap.info = snap.info.as_stale()
+            self._bump(info=True)
+
+    def drop_stale(self) -> List[int]:
+        with self.lock:
+            stale = [node_id for node_id, snap in self.nodes.items()
+                     if snap.info.is_stale]
+            for node_id in stale:
+                del self.nodes[node_id]
+                self.index.remove(node_id)
+            if stale:
+                self._bump(info=True)
+        return stale
+
+    def is_stale(self) -> bool:
+        nodes = list(self.nodes.values())
+        return any(snap.info.is_stale for snap in nodes)
+
+    """
+        Everything we have, as plain lists and dicts, fit for persisting.
+    """
+    def dump(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'generation': self.generation,
+                'nodes': [
+                    {'info': snap.info.to_dict(),
+                     'values': [v.to_list() for v in snap.values.values()]}
+                    for snap in self.nodes.values()
+                ]
+            }
+
+    """
+        Replace whatever we have with what was once dumped. Nodes come
+        back stale. Generations carry on from where they were, so tags
+        handed out before aren't handed out again for something else.
+    """
+    def restore(self, dumped: Dict[str, Any]):
+        nodes = {}
+        for entry in dumped['nodes']:
+            info = NodeInfoSimple.from_dict(entry['info']).as_stale()
+            snap = NodeSnapshot(info)
+            snap.set_values([ValueSnapshot.from_list(info.node_id, v)
+                             for v in entry['values']])
+            nodes[info.node_id] = snap
+        with self.lock:
+            self.generation = max(self.generation, dumped['generation'])
+            self.nodes = nodes
+            self.index.clear()
+            for snap in nodes.values():
+                self.index.add(snap.info)
+            self._bump(info=True)
+            for snap in nodes.values():
+                snap.generation = self.generation
+
+    def remove_node(self, node_id: int):
+        with self.lock:
+            if self.nodes.pop(node_id, None):
+                self.index.remove(node_id)
+                self._bump(info=True)
+
+    def update_value(self, node_id: int, value: ZWaveValue,
+                     data: Any) -> Optional[ValueSnapshot]:
+        with self.lock:
+            snap = self.nodes.get(node_id)
+            if not snap:
+                # we'll pick it up once the node shows up.
+                return None
+            vsnap = snap.values.get(value.value_id)
+            if not vsnap:
+                vsnap = ValueSnapshot.obtain(value)
+                vsnap.update(data)
+                snap.add_value(vsnap)
+                self._bump(snap)
+                return vsnap
+            if vsnap.update(data):
+                self._bump(snap)
+            return vsnap
+
+    def remove_value(self, node_id: int,
+                     value_id: int) -> Optional[ValueSnapshot]:
+        with self.lock:
+            snap = self.nodes.get(node_id)
+            if not snap:
+                return None
+            vsnap = snap.remove_value(value_id)
+            if vsnap:
+                self._bump(snap)
+            return vsnap
+
+    def has_node(self, node_id: int) -> bool:
+        return node_id in self.nodes
+
+    def get_node(self, node_id: int) -> Optional[NodeSnapshot]:
+        return self.nodes.get(node_id)
+
+    def find_values(self, node_id: int, genre: str = None,
+                    units: str = None, command_class: int = None
+                    ) -> Optional[List[ValueSnapshot]]:
+        with self.lock:
+            snap = self.nodes.get(node_id)
+            if not snap:
+                return None
+            return snap.find_values(genre, units, command_class)
+
+    def get_generation(self, node_id: int = None) -> Optional[int]:
+        if node_id is None:
+            return self.generation
+        snap = self.nodes.get(node_id)
+        return snap.generation if snap else None
+
+    """
+        All values of a given genre, across all nodes, as a list of
+        (node id, value) tuples.
+    """
+    def get_values(self,
+                   genre: str = None) -> List[Tuple[int, ValueSnapshot]]:
+        res = []
+        with self.lock:
+            for node_id, snap in self.nodes.items():
+                for vsnap in snap.values.values():
+                    if genre and vsnap.genre != genre:
+                        continue
+                    res.append((node_id, vsnap))
+        return res
+
+    def get_nodes_simple(self) -> List[NodeInfoSimple]:
+        with self.lock:
+            return [snap.info for snap in self.nodes.values()]
+
+    """
+        Nodes matching every (index name, key) in 'filters', sorted by
+        'sort' (one of SORT_KEYS), and only those past 'after' -- the sort
+        key of the last node of a previous page, as given by
+        'sort_key()'. At most 'limit' of them, if given.
+    """
+    def query_nodes(self, filters: List[Tuple[str, Any]],
+                    sort: str = 'id', reverse: bool = False,
+                    after: Optional[Tuple[Any, int]] = None,
+                    limit: Optional[int] = None) -> List[NodeSnapshot]:
+        with self.lock:
+            if filters:
+                sets = [self.index.lookup(name, key) for name, key in filters]
+                sets.sort(key=len)
+                ids = set(sets[0])
+                for other in sets[1:]:
+                    ids &= other
+                snaps = [self.nodes[i] for i in ids if i in self.nodes]
+            else:
+                snaps = list(self.nodes.values())
+
+        keyed = sorted(((self.sort_key(snap.info, sort), snap)
+                        for snap in snaps),
+                       key=lambda e: e[0], reverse=reverse)
+        if after is not None:
+            after = tuple(after)
+            keys = [k for k, _ in keyed]
+            if reverse:
+                # bisect wants ascending; count those still before 'after'.
+                start = len(keys) - bisect_left(keys[::-1], after)
+            else:
+                start = bisect_right(keys, after)
+            keyed = keyed[start:]
+        if limit is not None:
+            keyed = keyed[:limit]
+        return [snap for _, snap in keyed]
+
+    SORT_KEYS = {
+        'id': 'node_id',
+        'product': 'product_name',
+        'type': 'node_type',
+        'state': 'state',
+        'role': 'role',
+        'stage': 'proto_stage',
+    }
+
+    @classmethod
+    def sort_key(cls, info: NodeInfoSimple, sort: str) -> Tuple[Any, int]:
+        if sort == 'id':
+            return (info.node_id, info.node_id)
+        value = getattr(info, cls.SORT_KEYS[sort], None)
+        return (str(value).lower() if value is not None else '',
+                info.node_id)
+
+    def get_nodes_simple_bytes(self) -> List[bytes]:
+        with self.lock:
+            snaps = list(self.nodes.values())
+        return [snap.get_info_bytes() for snap in snaps]
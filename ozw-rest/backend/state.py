@@ -1,6 +1,7 @@
 import logging
 import signal
-from typing import Dict, List, Optional
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 # requirerments for openzwave integration
 from openzwave.controller import ZWaveController
@@ -11,9 +12,16 @@ from openzwave.value import ZWaveValue
 # requirement for catching events from openzwave lib
 from pydispatch import dispatcher
 
+from .encoding import encode, join_dict, join_list
 from .eventhandler import EventHandler
+from .energy import EnergyAccounts
+from .history import HistoryStore
 from .node import NodeInfoSimple
-from .network import NetworkController
+from .network import NetworkController, NetworkException
+from .persist import SnapshotPersister
+from .snapshot import NodeSnapshot, SnapshotStore, ValueSnapshot
+from .stream import EventStream
+from .timing import histogram, timed
 
 
 logger = logging.getLogger(__name__)
@@ -23,30 +31,212 @@ logger = logging.getLogger(__name__)
 class StateException(Exception):
     pass
 
+class UnknownFieldException(StateException):
+    pass
+
+
+# what 'ZWaveNode.to_dict()' knows as extras, rather than as attributes.
+NODE_DICT_EXTRAS = ['capabilities', 'neighbors', 'groups', 'values']
+# node attributes that may be asked for, on top of the extras.
+NODE_DICT_FIELDS = [
+    'node_id', 'home_id', 'name', 'location', 'product_name', 'product_id',
+    'product_type', 'manufacturer_name', 'manufacturer_id', 'type', 'role',
+    'device_type', 'query_stage', 'is_ready', 'is_awake', 'is_failed',
+    'is_sleeping', 'is_zwave_plus', 'is_routing_device',
+    'is_security_device', 'is_beaming_device', 'is_listening_device',
+    'is_frequent_listening_device', 'basic', 'generic', 'specific',
+    'version', 'max_baud_rate'
+]
+
 
 class State(EventHandler):
 
-    def __init__(self):
-        super().__init__()
-        self.networkctrl = NetworkController()
+    def __init__(self, name: str = 'default'):
+        super().__init__(name=f'ozw-ingest-{name}')
+        self.networkctrl = NetworkController(name)
+        self.snapshot = SnapshotStore()
+        self.stream = EventStream()
+        # past readings of user values, for charts.
+        self.history = HistoryStore()
+        self.history_path: Optional[str] = None
+        # energy consumed, per node and period, off kWh and W readings.
+        self.energy = EnergyAccounts()
+        self.energy_path: Optional[str] = None
+        # keeps the snapshot on disk, if we've been told where.
+        self.persister: SnapshotPersister = None
+        # node id -> (snapshot generation, full node dict, the dict
+        # encoded); good for as long as the node's generation stays the
+        # same.
+        self.node_dicts: Dict[int, Tuple[int, Dict[str, Any], bytes]] = {}
+        # (controller node id, controller capabilities), obtained once per
+        # network start instead of once per node.
+        self.controller_caps = None
+
 
+    def _is_ours(self, network, node=None, value=None) -> bool:
+        return self.networkctrl.owns(network, node, value)
+
+    @property
+    def name(self) -> str:
+        return self.networkctrl.name
+
+    """
+        The network's home id, in hex, if we know it, or its name; see
+        'NetworkController.get_key()'.
+    """
+    def get_key(self) -> str:
+        return self.networkctrl.get_key()
 
     def handle_signal(signum, frame):
         if signum == signal.SIGINT:
             raise StateException
     ()
 
-    def _handle_node(self, node_id, node):
+    def _handle_node(self, signal, node_id, node):
         logger.debug(f"handle node {node_id}")
-        pass
+        if signal == ZWaveNetwork.SIGNAL_NODE_REMOVED:
+            self.snapshot.remove_node(node_id)
+            self.node_dicts.pop(node_id, None)
+            self.stream.publish('node_removed', node_id=node_id)
+            return
+        if signal == ZWaveNetwork.SIGNAL_NODE_QUERIES_COMPLETE:
+            self.networkctrl.handle_node_queries_complete(node_id)
+        info = self._update_node_snapshot(node)
+
+        event_type = 'node_updated'
+        if signal in (ZWaveNetwork.SIGNAL_NODE_ADDED,
+                      ZWaveNetwork.SIGNAL_NODE_NEW):
+            event_type = 'node_added'
+        self.stream.publish(event_type, node_id=node_id, state=info.state,
+                            proto_stage=info.proto_stage)
 
-    def _handle_value(self, node_id, node, value):
+    def _handle_value(self, signal, node_id, node, value, data,
+                      timestamp: float = None):
         logger.debug(f"handle value for node {node_id}")
-        pass
+        if not self.snapshot.has_node(node_id):
+            self._update_node_snapshot(node)
+            return
+
+        if signal == ZWaveNetwork.SIGNAL_VALUE_REMOVED:
+            event_type = 'value_removed'
+            vsnap = self.snapshot.remove_value(node_id, value.value_id)
+        else:
+            event_type = 'value_added' \
+                if signal == ZWaveNetwork.SIGNAL_VALUE_ADDED \
+                else 'value_changed'
+            vsnap = self.snapshot.update_value(node_id, value, data)
+            if vsnap:
+                self._record_reading(vsnap, data, timestamp)
+
+        if vsnap and self.stream.has_subscribers():
+            self._publish_value(event_type, vsnap)
+
+    def _record_reading(self, vsnap: ValueSnapshot, data: Any,
+                        timestamp: float = None):
+        if vsnap.genre != 'user' or not vsnap.units or \
+           isinstance(data, bool) or not isinstance(data, (int, float)):
+            return
+        # as of when we were told, not when we got around to it.
+        ts = int((timestamp if timestamp is not None else time.time())
+                 * 1000)
+        self.history.record(vsnap.node_id, vsnap.units, float(data), ts,
+                            vsnap.instance)
+        self.energy.feed(vsnap.node_id, vsnap.units, float(data), ts,
+                         vsnap.instance)
+
+    def _publish_value(self, event_type: str, vsnap: ValueSnapshot):
+        self.stream.publish(event_type,
+                            node_id=vsnap.node_id,
+                            value_id=vsnap.value_id,
+                            label=vsnap.label,
+                            units=vsnap.units,
+                            genre=vsnap.genre,
+                            data=vsnap.data,
+                            timestamp=vsnap.last_update)
+
+    def _handle_network(self, signal, network):
+        self.stream.publish('network_state', signal=signal)
+
+        if signal in (ZWaveNetwork.SIGNAL_NETWORK_STOPPED,
+                      ZWaveNetwork.SIGNAL_NETWORK_FAILED,
+                      ZWaveNetwork.SIGNAL_NETWORK_RESETTED):
+            self.controller_caps = None
+            self.node_dicts = {}
+            self.networkctrl.clear_neighbor_graph()
+            # keep what we know around, for as long as we have nothing
+            # better, but say it might no longer be true.
+            self.checkpoint()
+            self.snapshot.mark_stale()
+            return
+
+        if not network or \
+           signal == ZWaveNetwork.SIGNAL_NETWORK_STARTED:
+            return
+
+        # network is now awake or ready: take a full pass over the nodes,
+        # so whatever state changes we missed are accounted for. This is
+        # the only time we walk every node.
+        self.controller_caps = None
+        for node in list(network.nodes.values()):
+            self._update_node_snapshot(node)
+
+        if signal == ZWaveNetwork.SIGNAL_NETWORK_READY:
+            # every node has been heard from by now; those we remember
+            # but haven't heard from are gone.
+            dropped = self.snapshot.drop_stale()
+            if dropped:
+                logger.info(f"dropped stale nodes: {dropped}")
+            self.networkctrl.rebuild_neighbor_graph()
+        self.checkpoint()
+
+    def _handle_controller_cmd(self, **kwargs):
+        self.networkctrl.handle_controller_command(**kwargs)
+
+    def _update_node_snapshot(self, node: ZWaveNode) -> NodeInfoSimple:
+        info = self._get_node_info(node)
+        self.snapshot.update_node(info, dict(node.values))
+        return info
 
     def get_network_controller(self):
         return self.networkctrl
 
+    """
+        Load the snapshot from 'path', if there's one, and keep saving it
+        there every 'interval' seconds, and on shutdown. Likewise for the
+        values' history, if given 'history_path', and energy accounts, if
+        given 'energy_path'.
+    """
+    def enable_persistence(self, path: str, interval: float = 300.0,
+                           history_path: Optional[str] = None,
+                           energy_path: Optional[str] = None):
+        self.persister = SnapshotPersister(self.snapshot, path, interval)
+        self.persister.load()
+        if history_path:
+            self.history_path = history_path
+            self.history.load(history_path)
+            self.persister.also_save.append(self.save_history)
+        if energy_path:
+            self.energy_path = energy_path
+            self.energy.load(energy_path)
+            self.persister.also_save.append(self.save_energy)
+        self.persister.start()
+
+    def save_history(self):
+        if self.history_path:
+            self.history.save(self.history_path)
+
+    def save_energy(self):
+        if self.energy_path:
+            self.energy.save(self.energy_path)
+
+    def checkpoint(self):
+        if self.persister:
+            self.persister.save()
+
+    def shutdown(self):
+        if self.persister:
+            self.persister.stop()
+
     def _get_state_str(self, node: ZWaveNode):
 
         state = "unknown"
@@ -59,6 +249,22 @@ class State(EventHandler):
 
         return state
 
+    def _get_controller_caps(self):
+        if self.controller_caps:
+            return self.controller_caps
+
+        try:
+            ozw_controller = self.networkctrl.get_controller()
+        except NetworkException:
+            return None
+        ctrl_caps = {
+            "is_primary": ozw_controller.is_primary_controller,
+            "is_bridge": ozw_controller.is_bridge_controller,
+            "is_static_update": ozw_controller.is_static_update_controller
+        }
+        self.controller_caps = (ozw_controller.node_id, ctrl_caps)
+        return self.controller_caps
+
     def _get_node_capabilities(self, node: ZWaveNode):
         caps = {
             "is_zwaveplus": node.is_zwave_plus,
@@ -68,49 +274,152 @@ class State(EventHandler):
             "is_listening": node.is_listening_device,
             "is_frequent_listening": node.is_frequent_listening_device
         }
-        ozw_controller = self.networkctrl.get_controller()
-        if node.node_id == ozw_controller.node_id:
-            ctrl_caps = {
-                "is_primary": ozw_controller.is_primary_controller,
-                "is_bridge": ozw_controller.is_bridge_controller,
-                "is_static_update": ozw_controller.is_static_update_controller
-            }
+        ctrl = self._get_controller_caps()
+        if ctrl and node.node_id == ctrl[0]:
             caps["is_controller"] = True
-            caps["controller"] = ctrl_caps
+            caps["controller"] = ctrl[1]
 
         return caps
 
+    @timed('ozw.read_node_info')
+    def _get_node_info(self, node: ZWaveNode) -> NodeInfoSimple:
+        info = NodeInfoSimple()
+        info.node_id = node.node_id
+        info.product_name = node.product_name
+        info.node_type = node.type
+        info.role = node.role
+        info.state = self._get_state_str(node)
+        info.proto_stage = node.query_stage
+        info.capabilities = self._get_node_capabilities(node)
+        return info
         
     def get_nodes(self) -> Dict[int, ZWaveNode]:
         # this can throw. let the caller handle it.
         return self.networkctrl.nodes
 
+    """
+        Raise if there's nothing to be served. Unlike the network
+        controller's 'check_available()', nodes we remember from before
+        are good enough. Returns whether any of what we'd serve is stale.
+    """
+    def check_readable(self) -> bool:
+        if self.networkctrl.is_network_available():
+            return self.snapshot.is_stale()
+        if not self.snapshot.nodes:
+            # raises, telling why.
+            self.networkctrl.check_available()
+        return True
+
     def get_nodes_simple(self) -> List[NodeInfoSimple]:
-        lst = []
+        # this can throw. let the caller handle it.
+        self.check_readable()
+        return self.snapshot.get_nodes_simple()
+
+    def _get_node_entry(self, node: ZWaveNode
+                        ) -> Tuple[int, Dict[str, Any], bytes]:
+        generation = self.snapshot.get_generation(node.node_id)
+        cached = self.node_dicts.get(node.node_id)
+        if cached and generation is not None and cached[0] == generation:
+            return cached
+        # should it change while we're at it, the generation we're keeping
+        # is already behind, and the next one to ask will redo it.
+        with histogram('ozw.read_node_dict').time():
+            node_dict = node.to_dict(extras=['all'])
+        entry = (generation, node_dict, encode(node_dict))
+        if generation is not None:
+            self.node_dicts[node.node_id] = entry
+        return entry
 
+    def _get_node_dict(self, node: ZWaveNode) -> Dict[str, Any]:
+        return self._get_node_entry(node)[1]
+
+    """
+        Only the fields asked for, and only reading those, unless we
+        already have the whole thing at hand. Either way, every field
+        asked for is there: 'to_dict()' doesn't have most attributes, so
+        those not in it are read off the node.
+    """
+    def _get_node_fields(self, node: ZWaveNode,
+                         fields: List[str]) -> Dict[str, Any]:
+        generation = self.snapshot.get_generation(node.node_id)
+        cached = self.node_dicts.get(node.node_id)
+        if cached and generation is not None and cached[0] == generation:
+            node_dict = cached[1]
+            return {f: node_dict[f] if f in node_dict
+                    else None if f in NODE_DICT_EXTRAS
+                    else getattr(node, f, None)
+                    for f in fields}
+
+        node_dict = {}
+        extras = [f for f in fields if f in NODE_DICT_EXTRAS]
+        if extras:
+            with histogram('ozw.read_node_dict').time():
+                node_dict = node.to_dict(extras=extras)
+        return {f: node_dict.get(f) if f in NODE_DICT_EXTRAS
+                else getattr(node, f, None)
+                for f in fields}
+
+    """
+        Check 'fields' names things we're willing to read off a node.
+        Raises UnknownFieldException otherwise.
+    """
+    def check_node_fields(self, fields: List[str]):
+        for field in fields:
+            if field not in NODE_DICT_EXTRAS and \
+               field not in NODE_DICT_FIELDS:
+                raise UnknownFieldException(f"unknown field '{field}'")
+
+    """
+        Every node, as a dict, keyed by node id. Only 'fields', if given.
+        Nodes' full dicts are kept until they change, so asking again is
+        cheap.
+    """
+    def get_nodes_dict(self, fields: Optional[List[str]] = None
+                       ) -> Dict[int, Dict[str, Any]]:
+        if fields is not None:
+            self.check_node_fields(fields)
+
+        # libopenzwave's own map; we only ever read from it.
         nodes = self.get_nodes()
+
+        res = {}
         node: ZWaveNode
-        for nid, node in nodes.items():
-            info = NodeInfoSimple()
-            info.node_id = nid
-            info.product_name = node.product_name
-            info.node_type = node.type
-            info.state = self._get_state_str(node)
-            info.proto_stage = node.query_stage
-            info.capabilities = \
-                self._get_node_capabilities(node)
-            lst.append(info)
-        return lst          
-
-    def get_nodes_dict(self):
+        for node_id, node in list(nodes.items()):
+            if fields is None:
+                res[node_id] = self._get_node_dict(node)
+            else:
+                res[node_id] = self._get_node_fields(node, fields)
+        return res
 
+    """
+        As 'get_nodes_dict()', but already encoded. Full dicts are put
+        together out of each node's cached encoding, so unless nodes
+        changed, nothing is encoded at all.
+    """
+    def get_nodes_dict_bytes(self, fields: Optional[List[str]] = None
+                             ) -> bytes:
+        if fields is not None:
+            return encode(self.get_nodes_dict(fields))
         nodes = self.get_nodes()
+        return join_dict({node_id: self._get_node_entry(node)[2]
+                          for node_id, node in list(nodes.items())})
 
-        node: ZWaveNode
-        for node in nodes.values():
-            nodes[node.node_id] = node.to_dict(extras=["all"])
+    def get_nodes_simple_bytes(self) -> bytes:
+        # this can throw. let the caller handle it.
+        self.check_readable()
+        return join_list(self.snapshot.get_nodes_simple_bytes())
 
-        return nodes
+    """
+        Nodes we know of, filtered and sorted, off the snapshot's indexes;
+        see 'SnapshotStore.query_nodes()'.
+    """
+    def query_nodes(self, filters: List[Tuple[str, Any]],
+                    sort: str = 'id', reverse: bool = False,
+                    after: Optional[Tuple[Any, int]] = None,
+                    limit: Optional[int] = None) -> List[NodeSnapshot]:
+        # this can throw. let the caller handle it.
+        self.check_readable()
+        return self.snapshot.query_nodes(filters, sort, reverse, after, limit)
 
 
 # create global controller instance
@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional, Set
+
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber:
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 nodes: Optional[Set[int]] = None,
+                 units: Optional[Set[str]] = None,
+                 max_pending: int = 256):
+        self.loop = loop
+        self.nodes = nodes
+        self.units = units
+        # oldest events go first once full; a slow client loses updates
+        # rather than holding anyone up.
+        self.pending = deque(maxlen=max_pending)
+        self.dropped = 0
+        self.wakeup = asyncio.Event()
+
+    def wants(self, event: Dict[str, Any]) -> bool:
+        node_id = event.get('node_id')
+        if self.nodes and node_id is not None and node_id not in self.nodes:
+            return False
+        units = event.get('units')
+        if self.units and units is not None and units not in self.units:
+            return False
+        return True
+
+    def push(self, event: Dict[str, Any]):
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append(event)
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def get(self, timeout: float) -> List[Dict[str, Any]]:
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.wakeup.clear()
+        events = []
+        while self.pending:
+            events.append(self.pending.popleft())
+        return events
+
+
+"""
+Fans events out to whoever is listening on the event stream endpoint.
+
+Events are published from openzwave's notification thread, and must never
+block it: publishing only appends to each subscriber's bounded buffer and
+pokes its event loop. Sending is left to the subscribers themselves.
+"""
+class EventStream:
+
+    def __init__(self):
+        self.subscribers: List[Subscriber] = []
+        self.lock = threading.Lock()
+
+    def has_subscribers(self) -> bool:
+        return len(self.subscribers) > 0
+
+    def subscribe(self, subscriber: Subscriber):
+        with self.lock:
+            self.subscribers = self.subscribers + [subscriber]
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self.lock:
+            self.subscribers = \
+                [s for s in self.subscribers if s is not subscriber]
+
+    def publish(self, event_type: str, **kwargs):
+        # copy-on-write list; no need for the lock to iterate it.
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        event = {'type': event_type, **kwargs}
+        for sub in subscribers:
+            if not sub.wants(event):
+                continue
+            try:
+                sub.push(event)
+            except RuntimeError:
+                # its loop is gone; it'll be unsubscribed soon enough.
+                pass
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    return "event: {}\ndata: {}\n\n".format(
+        event['type'], json.dumps(event, default=str))
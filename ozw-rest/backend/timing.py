@@ -0,0 +1,158 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List
+
+
+"""
+Latency histograms for our hot paths: signal handling, REST handlers,
+reads off libopenzwave, network start and stop.
+
+Buckets are fixed, on a log scale, four to an octave, from 1us to about
+two minutes; anything slower lands in a last, open-ended, bucket. Each
+thread records into counters of its own, so recording takes no lock and
+threads never contend; counters are only merged when read. A thread's
+counters outlive it, so nothing recorded is lost.
+
+Percentiles are read off the buckets, and are thus given as the upper
+bound of the bucket they fall in -- never off by more than ~19%.
+"""
+
+
+BUCKET_BOUNDS: List[float] = [1e-6 * 2 ** (i / 4) for i in range(108)]
+
+
+class _Shard:
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+
+class Histogram:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.local = threading.local()
+        self.shards: List[_Shard] = []
+        # only taken when a thread records for the first time, and on read.
+        self.lock = threading.Lock()
+
+    def _new_shard(self) -> _Shard:
+        shard = _Shard()
+        with self.lock:
+            self.shards.append(shard)
+        self.local.shard = shard
+        return shard
+
+    def observe(self, seconds: float):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self._new_shard()
+        shard.counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        shard.total += seconds
+        if seconds > shard.max:
+            shard.max = seconds
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def reset(self):
+        with self.lock:
+            for shard in self.shards:
+                shard.counts = [0] * len(shard.counts)
+                shard.total = 0.0
+                shard.max = 0.0
+
+    def _percentile(self, counts: List[int], total: int, pct: float):
+        wanted = pct / 100 * total
+        seen = 0
+        for idx, count in enumerate(counts):
+            seen += count
+            if seen >= wanted and count:
+                return BUCKET_BOUNDS[idx] if idx < len(BUCKET_BOUNDS) \
+                    else float('inf')
+        return 0.0
+
+    """
+        Merge every thread's counters. Times are in milliseconds; buckets
+        are only those with anything in them, keyed by their upper bound.
+    """
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            shards = list(self.shards)
+        counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        total = 0.0
+        slowest = 0.0
+        for shard in shards:
+            for idx, count in enumerate(shard.counts):
+                counts[idx] += count
+            total += shard.total
+            slowest = max(slowest, shard.max)
+        n = sum(counts)
+        ms = 1000.0
+        return {
+            'count': n,
+            'mean_ms': total / n * ms if n else 0.0,
+            'p50_ms': self._percentile(counts, n, 50) * ms,
+            'p95_ms': self._percentile(counts, n, 95) * ms,
+            'p99_ms': self._percentile(counts, n, 99) * ms,
+            'max_ms': slowest * ms,
+            'buckets': {
+                ('{:.6g}'.format(BUCKET_BOUNDS[idx] * ms)
+                 if idx < len(BUCKET_BOUNDS) else 'inf'): count
+                for idx, count in enumerate(counts) if count
+            }
+        }
+
+
+_histograms: Dict[str, Histogram] = {}
+_histograms_lock = threading.Lock()
+
+
+def histogram(name: str) -> Histogram:
+    hist = _histograms.get(name)
+    if hist is None:
+        with _histograms_lock:
+            hist = _histograms.setdefault(name, Histogram(name))
+    return hist
+
+
+"""
+    Decorate a function so each call is timed into histogram 'name'.
+"""
+def timed(name: str) -> Callable:
+    hist = histogram(name)
+
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    with _histograms_lock:
+        hists = sorted(_histograms.values(), key=lambda h: h.name)
+    return {hist.name: hist.get_stats() for hist in hists}
+
+
+def reset():
+    with _histograms_lock:
+        hists = list(_histograms.values())
+    for hist in hists:
+        hist.reset()
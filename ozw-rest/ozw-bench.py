@@ -0,0 +1,398 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks for ozw-rest and ozw-cli, run against a simulated network so
+they can be run anywhere, with or without a z-wave stick (or libopenzwave,
+for that matter).
+
+We measure
+
+  * REST endpoint latency, through the actual fastapi app;
+  * signal handling throughput, as in how many value changes per second
+    we're able to push through our handlers (the rest state's, and the
+    cli's DataStore);
+  * memory growth across those value changes;
+  * ozw-cli's remote write exporter, against a stand-in receiver: how
+    fast samples get through, and how many bytes each one costs.
+
+Results are printed, and optionally written out as json so runs can be
+compared against each other.
+"""
+
+import argparse
+import contextlib
+import http.server
+import importlib.util
+import io
+import json
+import logging
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List
+
+from backend import sim, timing
+
+
+logger = logging.getLogger(__name__)
+
+HERE = Path(__file__).resolve().parent
+
+
+def _load_module(name: str, path: Path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    idx = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[idx]
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    # everything in milliseconds.
+    ms = [s * 1000 for s in samples]
+    return {
+        'count': len(ms),
+        'mean': statistics.mean(ms) if ms else 0.0,
+        'p50': _percentile(ms, 50),
+        'p95': _percentile(ms, 95),
+        'p99': _percentile(ms, 99),
+        'max': max(ms) if ms else 0.0
+    }
+
+
+class _GatewayHandler(http.server.BaseHTTPRequestHandler):
+
+    def _ok(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.send_response(200)
+        self.end_headers()
+
+    do_PUT = _ok
+    do_POST = _ok
+
+    def log_message(self, format, *args):
+        pass
+
+
+"""
+A local stand-in for a push gateway, accepting anything we throw at it.
+"""
+class StandInGateway:
+
+    def __init__(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _GatewayHandler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        host, port = self.server.server_address
+        return f"{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+
+
+class _ReceiverHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        length = int(self.headers.get('Content-Length', 0))
+        payload = self.rfile.read(length)
+        with receiver.lock:
+            fail = receiver.failures > 0
+            if fail:
+                receiver.failures -= 1
+        if fail:
+            status = 503
+        else:
+            status = receiver.receive(payload)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+"""
+A local stand-in for a remote write receiver: decodes what it gets, and
+keeps count. Answers the first 'failures' requests with a 503, for our
+retries to deal with.
+"""
+class StandInReceiver:
+
+    def __init__(self, failures: int = 0):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _ReceiverHandler)
+        self.server.receiver = self
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.lock = threading.Lock()
+        self.failures = failures
+        self.requests = 0
+        self.bytes = 0
+        self.samples = 0
+        self.series: Dict[tuple, list] = {}
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/api/v1/write"
+
+    def receive(self, payload: bytes) -> int:
+        import snappy
+        from remotewrite import decode_write_request
+        try:
+            series = decode_write_request(snappy.decompress(payload))
+        except Exception:
+            return 400
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(payload)
+            for labels, samples in series:
+                key = tuple(sorted(labels.items()))
+                self.series.setdefault(key, []).extend(samples)
+                self.samples += len(samples)
+        return 204
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+
+
+def wait_for_network(netctrl, timeout: float = 60.0):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if netctrl.network and \
+           netctrl.network.state == netctrl.network.STATE_READY:
+            return time.monotonic() - start
+        time.sleep(0.01)
+    raise TimeoutError("simulated network never became ready")
+
+
+def bench_rest(client, node_ids: List[int], requests: int):
+    node_id = node_ids[len(node_ids) // 2]
+    endpoints = [
+        '/api/network/status',
+        '/api/nodes/',
+        '/api/nodes/roles',
+        f'/api/nodes/{node_id}/values',
+        f'/api/nodes/{node_id}/scope/user',
+        f'/api/nodes/{node_id}/history?unit=W',
+        '/api/controller/neighbors',
+        '/api/networks/nodes',
+        '/api/energy/',
+        '/api/nodes/?all=true',
+        '/api/nodes/?fields=node_id,product_name,is_ready',
+        '/api/nodes/?capabilities=listening&sort=product&limit=10',
+    ]
+    results = {}
+    for ep in endpoints:
+        samples = []
+        errors = 0
+        for _ in range(requests):
+            t = time.perf_counter()
+            try:
+                res = client.get(ep)
+                if res.status_code != 200:
+                    errors += 1
+            except Exception:
+                errors += 1
+            samples.append(time.perf_counter() - t)
+        results[ep] = _summary(samples)
+        results[ep]['errors'] = errors
+    return results
+
+
+def bench_signals(network, state, events: int, queues=()):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    t = time.perf_counter()
+    network.tick(events)
+    # signal handlers only queue; count what it takes to handle it all.
+    enqueued = time.perf_counter() - t
+    state.ingest.wait_idle()
+    for queue in queues:
+        queue.wait_idle()
+    elapsed = time.perf_counter() - t
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'events': events,
+        'seconds': elapsed,
+        'events_per_sec': events / elapsed if elapsed else 0.0,
+        'enqueue_secs': enqueued,
+        'ingest': state.get_ingest_stats(),
+        'mem_growth_bytes': after - before,
+        'mem_growth_per_event': (after - before) / events,
+        'mem_peak_bytes': peak
+    }
+
+
+def attach_cli_datastore(network, gateway: StandInGateway):
+    # ozw-cli's modules expect to be found next to it.
+    sys.path.insert(0, str(HERE.parent / 'ozw-cli'))
+    cli = _load_module('ozw_cli', HERE.parent / 'ozw-cli' / 'test.py')
+    cli.PrometheusExporter.gateway_url = gateway.address
+    data_dir = tempfile.mkdtemp(prefix='ozw-bench-')
+    cli.prometheus.spool_dir = str(Path(data_dir) / 'spool')
+    cli.prometheus.start()
+    ds = cli.DataStore(data_dir=data_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for node in network.sim_nodes:
+            ds.handle_node_event(network.SIGNAL_NODE_ADDED, node=node)
+        ds.ingest.wait_idle()
+    return cli, ds
+
+
+def bench_remote_write(cli, samples: int, nodes: int = 40):
+    with StandInReceiver(failures=3) as receiver:
+        exporter = cli.RemoteWriteExporter(
+            receiver.url,
+            spool_dir=tempfile.mkdtemp(prefix='ozw-bench-rw-'),
+            flush_interval=0.05, min_backoff=0.01)
+        units = ['kWh', 'W', 'V', 'A']
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(samples):
+                exporter.handle(f"node_{i % nodes}", units[i % 4],
+                                float(i), 1_600_000_000_000 + i)
+            handled = time.perf_counter() - start
+            exporter.stop()
+        elapsed = time.perf_counter() - start
+        stats = exporter.get_stats()
+        # every sample, once: a failing shard mustn't cost us any, nor
+        # have the others send theirs again.
+        assert receiver.samples == samples, \
+            f"remote write: {receiver.samples} of {samples} received"
+        return {
+            'samples': samples,
+            'received': receiver.samples,
+            'seconds': elapsed,
+            'samples_per_sec': samples / elapsed if elapsed else 0.0,
+            'handle_usecs': handled / samples * 1e6,
+            'requests': receiver.requests,
+            'retries': stats['retries'],
+            'bytes': receiver.bytes,
+            'bytes_per_sample': receiver.bytes / max(1, receiver.samples),
+            'bytes_raw_per_sample':
+                stats['bytes_raw'] / max(1, stats['samples_sent'])
+        }
+
+
+def print_results(results):
+    print(f"-- network: {results['config']}")
+    print(f"-- startup: {results['startup_secs']:.3f}s")
+    print("-- rest latency (ms):")
+    print("   {:58s} {:>8s} {:>8s} {:>8s} {:>8s} {:>6s}".format(
+        "endpoint", "mean", "p50", "p95", "p99", "errors"))
+    for ep, r in results['rest'].items():
+        print("   {:58s} {:8.3f} {:8.3f} {:8.3f} {:8.3f} {:6d}".format(
+            ep, r['mean'], r['p50'], r['p95'], r['p99'], r['errors']))
+    for name in ['signals', 'signals_with_cli']:
+        if name not in results:
+            continue
+        r = results[name]
+        print(f"-- {name}: {r['events_per_sec']:.0f} events/s, "
+              f"memory growth {r['mem_growth_bytes']} bytes "
+              f"({r['mem_growth_per_event']:.1f} bytes/event)")
+        for unit, f in r.get('cli_filter', {}).items():
+            print(f"   {unit:>6s}: {f['stored']} of {f['seen']} samples kept")
+    if 'remote_write' in results:
+        r = results['remote_write']
+        print(f"-- remote_write: {r['samples_per_sec']:.0f} samples/s, "
+              f"{r['received']} of {r['samples']} received in "
+              f"{r['requests']} requests ({r['retries']} retries), "
+              f"{r['bytes_per_sample']:.2f} bytes/sample "
+              f"({r['bytes_raw_per_sample']:.2f} uncompressed), "
+              f"{r['handle_usecs']:.1f}us/sample handled")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ozw-thingy benchmarks")
+    parser.add_argument('--nodes', type=int, default=40)
+    parser.add_argument('--values', type=int, default=8)
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-cli', action='store_true',
+                        help="don't benchmark ozw-cli's DataStore")
+    parser.add_argument('--json', type=str, default=None,
+                        help="write results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    sim.install()
+
+    from fastapi.testclient import TestClient
+    from backend.state import state
+
+    # the background value changes would make the numbers noisy; we drive
+    # changes ourselves.
+    config = sim.SimConfig(num_nodes=args.nodes,
+                           values_per_node=args.values,
+                           change_rate=0, seed=args.seed)
+    netctrl = state.get_network_controller()
+    netctrl.set_simulation(config)
+    netctrl.start()
+    startup = wait_for_network(netctrl)
+    network = netctrl.network
+
+    app = _load_module('ozw_rest', HERE / 'ozw-rest.py').app
+    client = TestClient(app, raise_server_exceptions=False)
+
+    results = {
+        'config': vars(config),
+        'startup_secs': startup,
+        'rest': bench_rest(client, sorted(network.nodes.keys()),
+                           args.requests),
+        'signals': bench_signals(network, state, args.events)
+    }
+
+    if not args.no_cli:
+        with StandInGateway() as gateway:
+            cli, ds = attach_cli_datastore(network, gateway)
+            with contextlib.redirect_stdout(io.StringIO()):
+                results['signals_with_cli'] = \
+                    bench_signals(network, state, args.events, [ds.ingest])
+            results['signals_with_cli']['cli_ingest'] = ds.ingest.get_stats()
+            results['signals_with_cli']['cli_filter'] = ds.get_filter_stats()
+            ds.ingest.stop()
+            with contextlib.redirect_stdout(io.StringIO()):
+                cli.prometheus.stop()
+        results['remote_write'] = bench_remote_write(cli, args.events * 10)
+
+    # our own histograms, as '/api/debug/stats' has them.
+    results['timing'] = timing.get_stats()
+    netctrl.stop()
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,33 @@
 #!/usr/bin/python
 
+import os
 import time
 import logging
 import signal
 import threading
+from pathlib import Path
 from typing import Dict, List
 from abc import ABC, abstractmethod
 
+# setting OZW_REST_SIMULATE (e.g., to 'nodes=40,values=8,rate=10') runs us
+# against a simulated network. Must happen before anything pulls openzwave.
+#
+# setting OZW_REST_NETWORKS runs more than one network, as in
+# 'house=ttyACM0;workshop=sim:nodes=10,home=0xbeef'; only one of them may
+# run off a stick, the rest must be simulated (see 'backend/networks.py').
+# The first one is the one the plain '/api/...' routes serve;
+# '/api/networks' serves them all.
+from backend import sim
+simulation = os.environ.get('OZW_REST_SIMULATE')
+network_specs = [
+    tuple(entry.strip().split('=', 1))
+    for entry in os.environ.get('OZW_REST_NETWORKS', '').split(';')
+    if '=' in entry
+]
+if simulation is not None or \
+   any(spec.startswith('sim:') for _, spec in network_specs):
+    sim.install()
+
 # requirerments for openzwave integration
 from openzwave.network import ZWaveNetwork
 from openzwave.option import ZWaveOption
@@ -17,12 +38,35 @@ from pydispatch import dispatcher
 
 from typing import Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 from backend.api import nodes as api_nodes
 from backend.api import network as api_network
 from backend.api import controller as api_controller
+from backend.api import metrics as api_metrics
+from backend.api import events as api_events
+from backend.api import jobs as api_jobs
+from backend.api import networks as api_networks
+from backend.api import debug as api_debug
+from backend.api import energy as api_energy
+from backend.networks import networks
+from backend.state import state
+from backend.timing import histogram
+
+
+if simulation is not None:
+    state.get_network_controller().set_simulation(
+        sim.SimConfig.from_str(simulation))
+
+for i, (name, spec) in enumerate(network_specs):
+    device, sim_config = spec, None
+    if spec.startswith('sim:'):
+        device, sim_config = None, sim.SimConfig.from_str(spec[4:])
+    if i == 0:
+        networks.configure_default(name, device, sim_config)
+    else:
+        networks.add(name, device, sim_config)
 
 
 app = FastAPI()
@@ -45,6 +89,21 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# time every request, by handler (e.g., 'rest.nodes.get_node_values'),
+# so we know where time goes; see '/api/debug/stats'.
+@app.middleware('http')
+async def time_request(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    endpoint = request.scope.get('endpoint')
+    name = 'unmatched'
+    if endpoint:
+        name = "{}.{}".format(endpoint.__module__.rsplit('.', 1)[-1],
+                              endpoint.__name__)
+    histogram(f"rest.{name}").observe(time.perf_counter() - start)
+    return response
+
+
 app.include_router(
     api_nodes.router,
     prefix='/api/nodes'
@@ -60,18 +119,82 @@ app.include_router(
     prefix='/api/controller'
 )
 
+app.include_router(
+    api_metrics.router,
+    prefix='/metrics'
+)
+
+app.include_router(
+    api_events.router,
+    prefix='/api/events'
+)
+
+app.include_router(
+    api_jobs.router,
+    prefix='/api/jobs'
+)
+
+app.include_router(
+    api_networks.router,
+    prefix='/api/networks'
+)
+
+app.include_router(
+    api_energy.router,
+    prefix='/api/energy'
+)
+
+app.include_router(
+    api_debug.router,
+    prefix='/api/debug'
+)
+
 @app.get('/api/')
 def read_root():
     return { 'hello': 'world' }
 
 
+"""
+    Where a network keeps its files: networks other than the first keep
+    theirs alongside the first's, by name.
+"""
+def _network_path(path: str, network) -> str:
+    if network is state:
+        return path
+    p = Path(path)
+    return str(p.with_name(f"{p.name.split('.')[0]}.{network.name}"
+                           f"{''.join(p.suffixes)}"))
+
+
 @app.on_event("startup")
 def on_startup():
 
+    # serve what we knew last time, until the network tells us otherwise.
+    # OZW_REST_SNAPSHOT sets where that's kept; empty to not keep it.
+    snapshot_path = os.environ.get('OZW_REST_SNAPSHOT',
+                                   'ozw-rest.snapshot.gz')
+    # values' history is kept along with it, at OZW_REST_HISTORY.
+    history_path = os.environ.get('OZW_REST_HISTORY',
+                                  'ozw-rest.history.npz')
+    # and so are energy accounts, at OZW_REST_ENERGY.
+    energy_path = os.environ.get('OZW_REST_ENERGY', 'ozw-rest.energy.json')
+    if snapshot_path:
+        for network in networks.get_all():
+            network.enable_persistence(
+                _network_path(snapshot_path, network),
+                history_path=_network_path(history_path, network)
+                if history_path else None,
+                energy_path=_network_path(energy_path, network)
+                if energy_path else None)
+
     logger.info("starting openzwave")
     thread = threading.Thread(target=main)
     thread.start()
 
+@app.on_event("shutdown")
+def on_shutdown():
+    networks.shutdown()
+
 def main():
     # we know this function is not needed, nor is its thread.
     # we're leaving it though, so we don't forget how to run an
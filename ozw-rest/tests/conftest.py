@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the backend package lives next to ozw-rest.py, not installed.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
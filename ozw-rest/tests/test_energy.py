@@ -0,0 +1,274 @@
+import time
+
+import pytest
+
+from backend.energy import HOUR_MS, MAX_SPREAD_MS, ChannelMeter, \
+                           EnergyAccounts, Totals, _spread
+
+DAY_MS = 24 * HOUR_MS
+# 2023-11-20T00:00:00Z, a Monday.
+T0 = 1_700_438_400_000
+
+
+@pytest.fixture(autouse=True)
+def utc(monkeypatch):
+    # periods are in local time; make that UTC, whatever the machine's.
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def _hours(accounts: EnergyAccounts, node_id=None):
+    return accounts.get_totals('hour', node_id)
+
+
+def test_counter_deltas_go_to_their_hour():
+    accounts = EnergyAccounts()
+    accounts.feed(2, 'kWh', 100.0, T0 + 60_000)
+    accounts.feed(2, 'kWh', 100.5, T0 + 120_000)
+    accounts.feed(2, 'kWh', 101.0, T0 + HOUR_MS + 60_000)
+    assert _hours(accounts, 2) == pytest.approx({
+        # 00:02 to 01:01: 58 minutes in the first hour, one in the next.
+        '2023-11-20T00': 0.5 + 0.5 * 58 / 59,
+        '2023-11-20T01': 0.5 * 1 / 59})
+    assert accounts.get_totals('day') == pytest.approx({'2023-11-20': 1.0})
+    assert accounts.get_meter(2).consumed == pytest.approx(1.0)
+
+
+def test_first_reading_is_the_baseline():
+    meter = ChannelMeter(2)
+    assert meter.add_counter(T0, 1234.0) == (0.0, T0)
+    assert meter.add_counter(T0 + 1000, 1234.0) == (0.0, T0)
+
+
+def test_out_of_order_reading_is_dropped():
+    meter = ChannelMeter(2)
+    meter.add_counter(T0 + 1000, 10.0)
+    assert meter.add_counter(T0, 9.0) == (0.0, T0 + 1000)
+    assert (meter.counter, meter.counter_ts) == (10.0, T0 + 1000)
+    assert meter.resets == 0
+
+
+def test_out_of_order_reading_is_not_counted_again():
+    accounts = EnergyAccounts()
+    accounts.feed(2, 'kWh', 5.0, T0)
+    accounts.feed(2, 'kWh', 6.0, T0 + 2 * HOUR_MS)
+    accounts.feed(2, 'kWh', 5.5, T0 + HOUR_MS)
+    accounts.feed(2, 'kWh', 7.0, T0 + 3 * HOUR_MS)
+    assert accounts.get_meter(2).consumed == pytest.approx(2.0)
+    assert accounts.get_totals('day') == pytest.approx({'2023-11-20': 2.0})
+
+
+def test_out_of_order_power_is_dropped():
+    accounts = EnergyAccounts()
+    accounts.feed(3, 'W', 1000.0, T0)
+    accounts.feed(3, 'W', 1000.0, T0 + HOUR_MS)
+    accounts.feed(3, 'W', 5000.0, T0 + HOUR_MS // 2)
+    accounts.feed(3, 'W', 0.0, T0 + 2 * HOUR_MS)
+    assert accounts.get_meter(3).consumed == pytest.approx(2.0)
+
+
+def test_jitter_keeps_the_higher_baseline():
+    meter = ChannelMeter(2)
+    meter.add_counter(T0, 10.0)
+    assert meter.add_counter(T0 + 1000, 9.995) == (0.0, T0)
+    assert meter.counter == 10.0
+    kwh, since = meter.add_counter(T0 + HOUR_MS, 10.5)
+    assert (kwh, since) == (pytest.approx(0.5), T0)
+    assert meter.resets == 0
+
+
+def test_reset_starts_from_zero():
+    meter = ChannelMeter(2)
+    meter.add_counter(T0, 500.0)
+    kwh, since = meter.add_counter(T0 + HOUR_MS, 0.3)
+    assert (kwh, since) == (pytest.approx(0.3), T0)
+    assert meter.resets == 1 and meter.wraps == 0
+
+
+@pytest.mark.parametrize('last, reading, consumed', [
+    (99_999.5, 0.2, 0.7),
+    (9.95, 0.05, 0.1),
+    (950.0, 10.0, 60.0),
+])
+def test_wrap_around(last, reading, consumed):
+    meter = ChannelMeter(2)
+    meter.add_counter(T0, last)
+    kwh, _ = meter.add_counter(T0 + 2 * HOUR_MS, reading)
+    assert kwh == pytest.approx(consumed)
+    assert meter.wraps == 1 and meter.resets == 0
+
+
+def test_far_from_a_power_of_ten_is_a_reset():
+    meter = ChannelMeter(2)
+    meter.add_counter(T0, 5000.0)
+    meter.add_counter(T0 + HOUR_MS, 1.0)
+    assert meter.resets == 1 and meter.wraps == 0
+
+
+def test_glitch_becomes_the_baseline():
+    meter = ChannelMeter(2)
+    meter.add_counter(T0, 10.0)
+    # 1000 kWh in a minute: no meter draws that.
+    assert meter.add_counter(T0 + 60_000, 1010.0) == (0.0, T0 + 60_000)
+    assert meter.glitches == 1
+    kwh, _ = meter.add_counter(T0 + 120_000, 1010.1)
+    assert kwh == pytest.approx(0.1)
+
+
+def test_small_jumps_close_together_are_no_glitch():
+    meter = ChannelMeter(2)
+    meter.add_counter(T0, 10.0)
+    kwh, _ = meter.add_counter(T0 + 1000, 10.5)
+    assert kwh == pytest.approx(0.5) and meter.glitches == 0
+
+
+def test_power_is_integrated_without_a_counter():
+    accounts = EnergyAccounts()
+    accounts.feed(3, 'W', 1000.0, T0)
+    accounts.feed(3, 'W', 2000.0, T0 + HOUR_MS // 2)
+    accounts.feed(3, 'W', 0.0, T0 + HOUR_MS)
+    assert _hours(accounts, 3) == pytest.approx({'2023-11-20T00': 1.5})
+
+
+def test_power_is_ignored_with_a_counter():
+    accounts = EnergyAccounts()
+    accounts.feed(3, 'kWh', 1.0, T0)
+    accounts.feed(3, 'W', 1000.0, T0)
+    accounts.feed(3, 'W', 1000.0, T0 + HOUR_MS)
+    assert _hours(accounts, 3) == {}
+    assert accounts.get_meter(3).get_channel(1).to_dict()['source'] == \
+        'counter'
+
+
+def test_channels_are_accounted_for_apart():
+    accounts = EnergyAccounts()
+    counters = {1: 100.0, 2: 60.0, 3: 40.0}
+    # three clamps, reporting in turn, 0.1 kWh each every 15 minutes.
+    for step in range(8):
+        for instance, start in counters.items():
+            accounts.feed(2, 'kWh', start + step * 0.1,
+                          T0 + step * HOUR_MS // 4 + instance * 1000,
+                          instance)
+    meter = accounts.get_meter(2)
+    assert sorted(meter.channels) == [1, 2, 3]
+    assert meter.consumed == pytest.approx(3 * 0.7)
+    assert (meter.resets, meter.wraps, meter.glitches) == (0, 0, 0)
+    assert accounts.get_totals('day', 2) == \
+        pytest.approx({'2023-11-20': 2.1})
+    channels = accounts.get_summary()['nodes'][2]['channels']
+    assert channels[3]['counter'] == pytest.approx(40.7)
+
+
+def test_power_pairs_with_the_counter_of_its_channel():
+    accounts = EnergyAccounts()
+    accounts.feed(3, 'kWh', 1.0, T0, instance=1)
+    accounts.feed(3, 'W', 1000.0, T0, instance=2)
+    accounts.feed(3, 'W', 1000.0, T0 + HOUR_MS, instance=2)
+    channels = accounts.get_summary()['nodes'][3]['channels']
+    assert (channels[1]['source'], channels[2]['source']) == \
+        ('counter', 'power')
+    assert accounts.get_meter(3).consumed == pytest.approx(1.0)
+
+
+def test_other_units_are_ignored():
+    accounts = EnergyAccounts()
+    accounts.feed(3, 'V', 230.0, T0)
+    assert accounts.get_meter(3) is None
+
+
+def test_totals_add_up_over_nodes():
+    accounts = EnergyAccounts()
+    for node_id, (a, b) in {2: (1.0, 2.0), 3: (5.0, 5.5)}.items():
+        accounts.feed(node_id, 'kWh', a, T0 + 1000)
+        accounts.feed(node_id, 'kWh', b, T0 + 2000)
+    assert accounts.get_totals('month') == \
+        pytest.approx({'2023-11': 1.5})
+
+
+def test_spread_over_hours_days_and_months():
+    totals = Totals()
+    # 10 days, across the end of November.
+    start = T0 + 6 * DAY_MS
+    _spread([totals], start, start + 10 * DAY_MS, 240.0)
+    assert len(totals.get('hour')) == 240
+    assert all(v == pytest.approx(1.0) for v in totals.get('hour').values())
+    assert totals.get('month') == pytest.approx(
+        {'2023-11': 120.0, '2023-12': 120.0})
+    assert list(totals.get('day')) == sorted(totals.get('day'))
+
+
+def test_spread_within_an_hour_is_a_single_add():
+    totals = Totals()
+    _spread([totals], T0 + 1000, T0 + 2000, 0.5)
+    assert totals.get('hour') == {'2023-11-20T00': 0.5}
+
+
+def test_spread_back_in_time_keeps_order_and_retention():
+    totals = Totals()
+    totals.add(T0 + 40 * DAY_MS, 1.0)
+    _spread([totals], T0, T0 + 35 * DAY_MS, 35 * 24.0)
+    hours = totals.get('hour')
+    assert list(hours) == sorted(hours)
+    assert len(hours) == Totals.retention['hour']
+    # the newest hours are kept, the oldest dropped.
+    assert list(hours)[-1] == '2023-12-30T00'
+    assert sum(totals.get('month').values()) == pytest.approx(35 * 24 + 1)
+
+
+def test_too_long_a_span_is_unattributed():
+    accounts = EnergyAccounts()
+    accounts.feed(2, 'kWh', 10.0, T0)
+    accounts.feed(2, 'kWh', 510.0, T0 + MAX_SPREAD_MS + HOUR_MS)
+    meter = accounts.get_meter(2)
+    assert meter.unattributed == pytest.approx(500.0)
+    assert meter.consumed == pytest.approx(500.0)
+    assert accounts.get_totals('month') == {}
+
+
+def test_get_totals_last():
+    accounts = EnergyAccounts()
+    accounts.feed(2, 'W', 1000.0, T0)
+    accounts.feed(2, 'W', 1000.0, T0 + 5 * HOUR_MS)
+    last = accounts.get_totals('hour', 2, last=2)
+    assert list(last) == ['2023-11-20T03', '2023-11-20T04']
+    assert accounts.get_totals('hour', 9) == {}
+
+
+def test_save_load(tmp_path):
+    accounts = EnergyAccounts()
+    accounts.feed(2, 'kWh', 99_999.9, T0)
+    accounts.feed(2, 'kWh', 0.1, T0 + HOUR_MS)
+    accounts.feed(2, 'kWh', 1.1, T0 + MAX_SPREAD_MS + 2 * HOUR_MS)
+    path = str(tmp_path / 'energy.json')
+    assert accounts.save(path)
+
+    loaded = EnergyAccounts()
+    assert loaded.load(path)
+    assert loaded.dump() == accounts.dump()
+    meter = loaded.get_meter(2)
+    assert (meter.wraps, meter.unattributed) == (1, pytest.approx(1.0))
+    # and carries on off the restored counter.
+    loaded.feed(2, 'kWh', 1.6, T0 + MAX_SPREAD_MS + 3 * HOUR_MS)
+    assert meter.consumed == pytest.approx(1.7)
+
+
+def test_restore_from_before_channels():
+    accounts = EnergyAccounts()
+    accounts.restore({'totals': {}, 'nodes': {'2': {
+        'counter': 10.0, 'counter_ts': T0, 'wraps': 1, 'consumed': 3.0,
+        'totals': {'day': {'2023-11-19': 3.0}}}}})
+    meter = accounts.get_meter(2)
+    assert list(meter.channels) == [1]
+    assert meter.totals.get('day') == {'2023-11-19': 3.0}
+    accounts.feed(2, 'kWh', 10.5, T0 + HOUR_MS)
+    assert (meter.consumed, meter.wraps) == (pytest.approx(3.5), 1)
+
+
+def test_load_missing_or_broken(tmp_path):
+    accounts = EnergyAccounts()
+    assert not accounts.load(str(tmp_path / 'nope.json'))
+    (tmp_path / 'bad.json').write_text('{')
+    assert not accounts.load(str(tmp_path / 'bad.json'))
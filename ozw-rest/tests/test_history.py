@@ -0,0 +1,227 @@
+import numpy as np
+import pytest
+
+from backend.history import HistoryException, HistoryStore, Series, \
+                            format_step, parse_step
+
+MINUTE = 60_000
+HOUR = 3_600_000
+DAY = 86_400_000
+# a Monday, midnight UTC.
+T0 = 1_700_438_400_000
+
+
+def _store(**retention) -> HistoryStore:
+    store = HistoryStore()
+    store.retention = dict(HistoryStore.retention, **retention)
+    return store
+
+
+@pytest.mark.parametrize('step, ms', [('5s', 5_000), ('15m', 900_000),
+                                      ('1h', HOUR), ('1d', DAY),
+                                      ('30', 30_000), ('250ms', 250),
+                                      ('1.5h', 5_400_000)])
+def test_parse_step(step, ms):
+    assert parse_step(step) == ms
+
+
+@pytest.mark.parametrize('step', ['', 'abc', '5w', '-1s', '0s', '0.1ms'])
+def test_parse_step_refuses(step):
+    with pytest.raises(HistoryException):
+        parse_step(step)
+
+
+def test_format_step():
+    assert [format_step(ms) for ms in [250, 5_000, 900_000, 5_400_000,
+                                       DAY]] == \
+        ['250ms', '5s', '15m', '90m', '1d']
+
+
+def test_buckets():
+    store = _store()
+    for i in range(120):
+        store.record(1, 'W', float(i), T0 + i * 1_000)
+    res = store.query(1, 'W', T0, T0 + 120_000, MINUTE)
+    assert res['source'] == '1m'
+    assert res['ts'] == [T0, T0 + MINUTE]
+    assert res['min'] == [0.0, 60.0]
+    assert res['max'] == [59.0, 119.0]
+    assert res['avg'] == [29.5, 89.5]
+    assert res['last'] == [59.0, 119.0]
+    assert res['count'] == [60, 60]
+
+
+def test_step_finer_than_rollups_reads_raw():
+    store = _store()
+    for i in range(60):
+        store.record(1, 'W', float(i), T0 + i * 1_000)
+    res = store.query(1, 'W', T0, T0 + MINUTE, 10_000)
+    assert res['source'] == 'raw'
+    assert res['avg'] == [4.5, 14.5, 24.5, 34.5, 44.5, 54.5]
+
+
+def test_coarsest_fitting_source_is_picked():
+    store = _store()
+    for i in range(48 * 60):
+        store.record(1, 'W', 1.0, T0 + i * MINUTE)
+    assert store.query(1, 'W', T0, T0 + DAY, HOUR)['source'] == '1h'
+    assert store.query(1, 'W', T0, T0 + DAY, 1_800_000)['source'] == '15m'
+    assert store.query(1, 'W', T0, T0 + DAY, 5 * MINUTE)['source'] == '1m'
+
+
+def test_rollups_agree_with_raw():
+    store = _store()
+    values = [float(i % 37) for i in range(6 * 60)]
+    for i, v in enumerate(values):
+        store.record(1, 'W', v, T0 + i * MINUTE + 7_000)
+    res = store.query(1, 'W', T0, T0 + 6 * HOUR, 2 * HOUR)
+    assert res['source'] == '1h'
+    hours = [values[i:i + 120] for i in range(0, len(values), 120)]
+    assert res['count'] == [120, 120, 120]
+    assert res['min'] == [min(h) for h in hours]
+    assert res['max'] == [max(h) for h in hours]
+    assert res['avg'] == pytest.approx([sum(h) / len(h) for h in hours])
+    assert res['last'] == [h[-1] for h in hours]
+
+
+def test_query_start_is_aligned_to_the_step():
+    store = _store()
+    for i in range(10):
+        store.record(1, 'W', float(i), T0 + i * MINUTE)
+    res = store.query(1, 'W', T0 + 90_000, T0 + 10 * MINUTE, 5 * MINUTE)
+    assert res['from'] == T0
+    assert res['ts'] == [T0, T0 + 5 * MINUTE]
+
+
+def test_source_not_reaching_back_is_skipped():
+    # a day of minutes, but the query starts two days back.
+    store = _store(raw=100, **{'1m': 24 * 60})
+    for i in range(3 * 24 * 60):
+        store.record(1, 'W', 1.0, T0 + i * MINUTE)
+    end = T0 + 3 * DAY
+    res = store.query(1, 'W', end - 2 * DAY, end, 15 * MINUTE)
+    assert res['source'] == '15m'
+    assert sum(res['count']) == 2 * 24 * 60
+    with pytest.raises(HistoryException, match='multiple of 15m'):
+        store.query(1, 'W', end - 2 * DAY, end, 5 * MINUTE)
+    # recent enough, minutes do.
+    assert store.query(1, 'W', end - HOUR, end, 5 * MINUTE)['source'] == '1m'
+
+
+def test_everything_there_is_counts_as_reaching_back():
+    store = _store()
+    for i in range(10):
+        store.record(1, 'W', 1.0, T0 + i * 1_000)
+    res = store.query(1, 'W', T0 - 5 * DAY, T0 + DAY, MINUTE)
+    assert res['source'] == '1m'
+    assert res['count'] == [10]
+
+
+def test_auto_step():
+    store = _store(raw=100, **{'1m': 24 * 60})
+    for i in range(3 * 24 * 60):
+        store.record(1, 'W', 1.0, T0 + i * MINUTE)
+    end = T0 + 3 * DAY
+    assert store.query(1, 'W', end - HOUR, end)['step'] == 10_000
+    # two days back, only quarters reach: no 5m step, however close.
+    res = store.query(1, 'W', end - 2 * DAY, end)
+    assert res['step'] % (15 * MINUTE) == 0
+
+
+def test_too_many_buckets():
+    store = _store()
+    store.record(1, 'W', 1.0, T0)
+    with pytest.raises(HistoryException, match='too many'):
+        store.query(1, 'W', T0, T0 + DAY, 1_000)
+
+
+def test_unknown_series_and_empty_range():
+    store = _store()
+    store.record(1, 'W', 1.0, T0)
+    with pytest.raises(HistoryException):
+        store.query(2, 'W', T0, T0 + 1)
+    with pytest.raises(HistoryException):
+        store.query(1, 'W', T0, T0)
+    assert store.get_units(1) == ['W']
+    assert not store.has_series(1, 'kWh')
+
+
+def test_channels_are_series_apart():
+    store = _store()
+    # two clamps, reporting in turn.
+    for i in range(10):
+        store.record(1, 'W', 100.0, T0 + i * 1_000, instance=2)
+        store.record(1, 'W', 5.0, T0 + i * 1_000 + 500, instance=3)
+    assert store.get_units(1) == ['W']
+    assert store.get_instances(1, 'W') == [2, 3]
+    assert not store.has_series(1, 'W')
+    res = store.query(1, 'W', T0, T0 + MINUTE, MINUTE, instance=3)
+    assert res['instance'] == 3
+    assert (res['min'], res['max'], res['count']) == ([5.0], [5.0], [10])
+    with pytest.raises(HistoryException, match='instance 1'):
+        store.query(1, 'W', T0, T0 + MINUTE, MINUTE)
+
+
+def test_empty_range_has_no_buckets():
+    store = _store()
+    store.record(1, 'W', 1.0, T0)
+    res = store.query(1, 'W', T0 + DAY, T0 + 2 * DAY, HOUR)
+    assert res['ts'] == [] and res['count'] == []
+
+
+def test_retention_drops_oldest():
+    series = Series(dict(HistoryStore.retention, raw=8))
+    for i in range(20):
+        series.add(T0 + i, float(i))
+    rows = series.raw.view()
+    assert len(rows) <= 8
+    assert rows['ts'][-1] == T0 + 19
+    assert list(rows['ts']) == sorted(rows['ts'])
+
+
+def test_save_load(tmp_path):
+    store = _store()
+    for i in range(200):
+        store.record(1, 'W', float(i), T0 + i * 10_000)
+        store.record(2, 'kWh', i / 10, T0 + i * 10_000)
+    path = str(tmp_path / 'history.npz')
+    assert store.save(path)
+    # nothing new, nothing to save.
+    assert not store.save(path)
+
+    loaded = _store()
+    assert loaded.load(path)
+    for node_id, unit in [(1, 'W'), (2, 'kWh')]:
+        for step in [10_000, MINUTE, HOUR]:
+            assert loaded.query(node_id, unit, T0, T0 + DAY, step) == \
+                store.query(node_id, unit, T0, T0 + DAY, step)
+    # the open buckets carry on where they were.
+    store.record(1, 'W', 500.0, T0 + 200 * 10_000)
+    loaded.record(1, 'W', 500.0, T0 + 200 * 10_000)
+    assert loaded.query(1, 'W', T0, T0 + DAY, HOUR) == \
+        store.query(1, 'W', T0, T0 + DAY, HOUR)
+
+
+def test_load_from_before_instances(tmp_path):
+    store = _store()
+    for i in range(20):
+        store.record(1, 'W', float(i), T0 + i * 10_000)
+    path = str(tmp_path / 'history.npz')
+    assert store.save(path)
+    with np.load(path) as data:
+        old = {name.replace('|1|', '|'): data[name] for name in data.files}
+    old_path = str(tmp_path / 'old.npz')
+    np.savez_compressed(old_path, **old)
+
+    loaded = _store()
+    assert loaded.load(old_path)
+    assert loaded.get_instances(1, 'W') == [1]
+    assert loaded.query(1, 'W', T0, T0 + DAY, MINUTE) == \
+        store.query(1, 'W', T0, T0 + DAY, MINUTE)
+
+
+def test_load_missing_or_broken(tmp_path):
+    store = _store()
+    assert not store.load(str(tmp_path / 'nope.npz'))
+    (tmp_path / 'bad.npz').write_bytes(b'not a zip')
+    assert not store.load(str(tmp_path / 'bad.npz'))
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from backend.ingest import POLICY_COALESCE, POLICY_DROP_OLDEST, \
+                           IngestEvent, IngestQueue
+
+
+def _event(key=None, data=None) -> IngestEvent:
+    return IngestEvent('value', 'ValueChanged', node_id=1, value_id=key,
+                       data=data, key=key)
+
+
+def test_coalesce_only_when_full():
+    seen = []
+    queue = IngestQueue(lambda e: seen.append((e.key, e.data)), max_size=4,
+                        policy=POLICY_COALESCE)
+    for key, data in [('a', 1), ('a', 2), ('b', 3), ('c', 4),
+                      # full from here on.
+                      ('a', 5), ('d', 6)]:
+        queue.put(_event(key, data))
+    queue.drain()
+    # 'a' 2 was the latest 'a', replaced by 5; 'd' made room by dropping
+    # the oldest, 'a' 1.
+    assert seen == [('a', 5), ('b', 3), ('c', 4), ('d', 6)]
+    stats = queue.get_stats()
+    assert (stats['enqueued'], stats['processed'], stats['coalesced'],
+            stats['dropped']) == (6, 4, 1, 1)
+
+
+def test_drop_oldest():
+    seen = []
+    queue = IngestQueue(lambda e: seen.append(e.data), max_size=3)
+    for i in range(5):
+        queue.put(_event(data=i))
+    assert queue.get_stats()['dropped'] == 2
+    queue.drain()
+    assert seen == [2, 3, 4]
+    stats = queue.get_stats()
+    assert (stats['processed'], stats['dropped'], stats['depth']) == \
+        (3, 2, 0)
+
+
+@pytest.mark.parametrize('policy', [POLICY_DROP_OLDEST, POLICY_COALESCE])
+def test_counts_add_up_across_threads(policy):
+    def slow(event):
+        if event.data % 100 == 0:
+            time.sleep(0.0001)
+
+    queue = IngestQueue(slow, max_size=50, policy=policy)
+    queue.start()
+    producers, per_thread = 4, 5000
+
+    def produce(n):
+        for i in range(per_thread):
+            queue.put(_event(key=(n, i % 7), data=i))
+
+    threads = [threading.Thread(target=produce, args=(n,))
+               for n in range(producers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert queue.wait_idle(30)
+    queue.stop()
+    stats = queue.get_stats()
+    assert stats['enqueued'] == producers * per_thread
+    assert stats['processed'] + stats['dropped'] + stats['coalesced'] == \
+        stats['enqueued']
+    assert stats['depth'] == 0
+
+
+def test_handler_errors_are_counted():
+    def fail(event):
+        raise ValueError("no")
+
+    queue = IngestQueue(fail)
+    queue.put(_event(data=1))
+    queue.drain()
+    stats = queue.get_stats()
+    assert (stats['processed'], stats['failed']) == (1, 1)
@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from backend.jobs import JOB_CANCELLED, JOB_DONE, JobManager, \
+                         JobTimeoutException
+
+
+def test_jobs_run_in_order_and_join_by_key():
+    jobs = JobManager('test')
+    gate = threading.Event()
+    first = jobs.submit('a', lambda job: gate.wait(5) and 'a', key='a')
+    second = jobs.submit('b', lambda job: 'b')
+    assert jobs.submit('a', lambda job: 'other', key='a') is first
+    gate.set()
+    assert jobs.wait(second)
+    assert (first.status, first.result) == (JOB_DONE, 'a')
+    assert (second.status, second.result) == (JOB_DONE, 'b')
+    jobs.stop()
+
+
+def test_reports_are_queued_in_order():
+    jobs = JobManager('test')
+    got = []
+
+    def fn(job):
+        job.expect_report()
+        started.set()
+        for _ in range(3):
+            got.append(job.wait_for_report(5)['n'])
+        with pytest.raises(JobTimeoutException):
+            job.wait_for_report(0.01)
+
+    started = threading.Event()
+    job = jobs.submit('reports', fn)
+    started.wait(5)
+    for n in range(3):
+        jobs.report(False, n=-1)
+        jobs.report(True, n=n)
+    assert jobs.wait(job)
+    assert job.status == JOB_DONE and got == [0, 1, 2]
+    jobs.stop()
+
+
+def test_stop_cancels_queued_jobs():
+    jobs = JobManager('test')
+    running = threading.Event()
+
+    def wait_forever(job):
+        running.set()
+        job.expect_report()
+        job.wait_for_report(60)
+
+    current = jobs.submit('running', wait_forever)
+    running.wait(5)
+    queued = [jobs.submit('queued', lambda job: None) for _ in range(3)]
+    jobs.stop()
+    assert current.status == JOB_CANCELLED
+    assert [job.status for job in queued] == [JOB_CANCELLED] * 3
+    assert all(job.finished for job in queued)
@@ -0,0 +1,37 @@
+from backend import sim
+
+sim.install()
+
+from prometheus_client import generate_latest
+
+from backend.metrics import create_registry
+from backend.snapshot import ValueSnapshot
+
+
+class _Snapshot:
+
+    def __init__(self, values):
+        self.values = values
+
+    def get_values(self, genre=None):
+        return [(v.node_id, v) for v in self.values if v.genre == genre]
+
+
+def _value(instance: int, index: int, units: str, data) -> ValueSnapshot:
+    vsnap = ValueSnapshot()
+    vsnap.node_id, vsnap.label, vsnap.units = 2, 'Power', units
+    vsnap.genre, vsnap.instance, vsnap.index = 'user', instance, index
+    vsnap.update(data)
+    return vsnap
+
+
+def test_channels_are_samples_apart():
+    registry = create_registry(_Snapshot([
+        _value(1, 8, 'W', 100.0), _value(2, 8, 'W', 60.0),
+        _value(3, 8, 'W', 40.0), _value(3, 2, 'V', True)]))
+    lines = [line for line in generate_latest(registry).decode().split('\n')
+             if line.startswith('home_consumption_W{')]
+    assert sorted(lines) == [
+        f'home_consumption_W{{index="8",instance="{i}",label="Power",'
+        f'node="node_2"}} {w}'
+        for i, w in [(1, 100.0), (2, 60.0), (3, 40.0)]]
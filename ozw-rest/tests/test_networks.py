@@ -0,0 +1,50 @@
+import pytest
+
+from backend import sim
+
+sim.install()
+
+from backend.network import NetworkController
+from backend.networks import Networks, TooManyDevicesException
+from backend.state import State
+
+
+def test_only_one_network_runs_off_a_device():
+    networks = Networks(State('house'))
+    networks.configure_default('house', 'null')
+    with pytest.raises(TooManyDevicesException):
+        networks.add('workshop', 'null')
+    assert networks.add('garage', simulation=sim.SimConfig(num_nodes=2))
+    assert [n.name for n in networks.get_all()] == ['house', 'garage']
+
+
+def test_a_device_next_to_simulated_ones():
+    networks = Networks(State('house'))
+    networks.configure_default('house',
+                               simulation=sim.SimConfig(num_nodes=2))
+    assert networks.add('workshop', 'null')
+    # the default one finds a device of its own when started.
+    networks = Networks(State('house'))
+    with pytest.raises(TooManyDevicesException):
+        networks.add('workshop', 'null')
+
+
+def test_only_one_controller_has_the_driver():
+    house, workshop = NetworkController('house'), NetworkController('workshop')
+    garage = NetworkController('garage')
+    garage.set_simulation(sim.SimConfig(num_nodes=2))
+    for netctrl in (house, workshop, garage):
+        netctrl.network_device = '/dev/null'
+    try:
+        assert house._ozw_start() is None
+        assert workshop._ozw_start() is False
+        assert not workshop.is_server_running()
+        # simulated ones don't need it.
+        assert garage._ozw_start() is None
+        house._ozw_stop()
+        assert workshop._ozw_start() is None
+        assert NetworkController.driver_owner is workshop
+    finally:
+        for netctrl in (house, workshop, garage):
+            netctrl._ozw_stop()
+    assert NetworkController.driver_owner is None
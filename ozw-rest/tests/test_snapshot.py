@@ -0,0 +1,60 @@
+import time
+from datetime import datetime as dt, timedelta, timezone
+
+import pytest
+
+from backend import sim
+
+sim.install()
+
+from backend.snapshot import ValueSnapshot
+
+
+@pytest.fixture(params=['UTC', 'America/New_York', 'Asia/Kolkata'])
+def tz(request, monkeypatch):
+    monkeypatch.setenv('TZ', request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+def _snap() -> ValueSnapshot:
+    snap = ValueSnapshot()
+    snap.value_id, snap.label, snap.units = 72057594076463106, 'Power', 'W'
+    snap.genre, snap.command_class = 'user', 50
+    snap.update(12.5)
+    return snap
+
+
+def test_last_update_is_utc(tz):
+    snap = _snap()
+    assert snap.last_update.utcoffset() == timedelta(0)
+    assert abs(snap.last_update.timestamp() - time.time()) < 5
+
+
+def test_round_trip_keeps_the_time(tz):
+    snap = _snap()
+    restored = ValueSnapshot.from_list(3, snap.to_list())
+    assert restored.last_update == snap.last_update
+    assert restored.last_update.timestamp() == snap.last_update.timestamp()
+    assert (restored.node_id, restored.value_id, restored.data) == \
+        (3, snap.value_id, 12.5)
+
+
+def test_saved_timestamp_is_seconds_since_the_epoch(tz):
+    snap = _snap()
+    snap.last_update = dt(2024, 1, 1, tzinfo=timezone.utc)
+    assert snap.to_list()[6] == 1_704_067_200.0
+    restored = ValueSnapshot.from_list(3, snap.to_list())
+    assert restored.last_update == dt(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def test_round_trip_keeps_the_channel():
+    snap = _snap()
+    snap.instance, snap.index = 3, 8
+    restored = ValueSnapshot.from_list(3, snap.to_list())
+    assert (restored.instance, restored.index) == (3, 8)
+    # saved before channels were kept.
+    restored = ValueSnapshot.from_list(3, snap.to_list()[:7])
+    assert (restored.instance, restored.index) == (1, 0)
@@ -1,10 +1,20 @@
 #!/usr/bin/python3
 
+import os
+import sys
 import time
 from datetime import datetime as dt, timedelta
 from typing import Dict, List
 from threading import Lock
 
+# setting OZW_TUI_SIMULATE (e.g., to 'nodes=40,values=8,rate=10') runs us
+# against a simulated network, as OZW_REST_SIMULATE does for ozw-rest.
+# Must happen before anything pulls openzwave.
+simulation = os.environ.get('OZW_TUI_SIMULATE')
+if simulation is not None:
+    import sim
+    sim.install(force=True)
+
 from openzwave.controller import ZWaveController
 from openzwave.network import ZWaveNetwork
 from openzwave.option import ZWaveOption
@@ -47,11 +57,9 @@ class BufferController:
         
 
     def add_node(self, node: ZWaveNode):
-
-        with self.update_lock:
-            self.nodes[node.node_id] = node
-            self.update_buffer()
-        pass
+        # called from openzwave's notification thread; just take note, the
+        # main loop's update() redraws soon enough.
+        self.nodes[node.node_id] = node
 
     def update_value(self, node, value):
         pass
@@ -137,7 +145,8 @@ class BufferController:
         self.buffer_lst.append(f"{term.bold_slategray2}{header}")
         self.buffer_lst.append('-'*term.width)
 
-        for nid in self.nodes.keys():
+        # nodes may be added under us by the notification thread.
+        for nid in list(self.nodes.keys()):
             node = "node #{0:=03d}".format(nid)
             msg = f"{term.bold_white}{node:9}"
             node = self.nodes[nid]
@@ -201,7 +210,9 @@ class EventHandler:
         self.controller = None      # type: BufferController
 
     def handle_value(self, signal, **kwargs):
-        
+        if not self.controller:
+            return
+
         node: ZWaveNode = kwargs['node']
         value: ZWaveValue = kwargs['value']
         self.controller.add_node(node)
@@ -248,7 +259,10 @@ def main():
 
     term = Terminal()
 
-    options = ZWaveOption(device='/dev/ttyACM0')
+    if simulation is not None:
+        options = ZWaveOption(config=sim.SimConfig.from_str(simulation))
+    else:
+        options = ZWaveOption(device='/dev/ttyACM0')
     options.set_log_file('test.log')
     options.set_append_log_file(True)
     options.set_console_output(False)